@@ -1,13 +1,59 @@
 # flake8: noqa
+"""
+The submodules are imported when first used, so importing the package and
+parsing script arguments does not load numpy, numba or fitsio
+"""
 
 __version__ = '0.9.1'
 
-from . import imagemaker
-from .imagemaker import (
-    make_image_auto,
-    make_image_fromfiles,
-)
+import importlib
 
-from . import batch
-from . import images
-from . import files
+_submodules = [
+    'imagemaker',
+    'batch',
+    'images',
+    'pyramid',
+    'files',
+    'manifest',
+    'transfer',
+    'imagecache',
+    'server',
+    'tileindex',
+    'flistindex',
+    'benchmark',
+    'instrument',
+    'worker',
+    'bigtiff',
+    'mosaic',
+    'stretch',
+    'skystats',
+    'rendercache',
+    'stripwriter',
+    'sourcecache',
+]
+
+_functions = {
+    'make_image_auto': 'imagemaker',
+    'make_images_auto': 'imagemaker',
+    'make_image_fromfiles': 'imagemaker',
+    'make_cutout': 'imagemaker',
+}
+
+__all__ = list(_functions) + _submodules
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module('.' + name, __name__)
+
+    if name in _functions:
+        module = importlib.import_module('.' + _functions[name], __name__)
+        func = getattr(module, name)
+        globals()[name] = func
+        return func
+
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -1,12 +1,97 @@
 from __future__ import print_function
 import os
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from . import imagemaker
+from . import images
 from . import files
+from . import manifest
+from . import rendercache
+from . import sourcecache
+from . import transfer as transfer_mod
+from . import instrument
+from . import worker
+
+logger = logging.getLogger(__name__)
+
+# time limit for each tile in a slurm array task
+SLURM_MINUTES_PER_TILE = 25
+
+# largest slurm job array, below the default MaxArraySize of 1001
+SLURM_MAX_ARRAY_SIZE = 1000
 
 
 class ScriptMaker(object):
-    def __init__(self, system, types=None, bands=None, campaign=None):
+    """
+    write scripts and batch files for the tiles that have not been made yet,
+    or with system "local", make them directly using a pool of worker
+    processes, or with system "queue", add them to the campaign queue for
+    des-image-worker
+
+    With system "slurm" a single job array script is written, with a file
+    listing the tiles for each array task.  Each task makes tiles_per_task
+    tiles in one process, so the startup is paid once per task and the
+    files for the next tile are fetched while the current one is made.  If
+    there are too many tiles for an array of max_array_size tasks, more
+    tiles are made by each task
+
+    parameters
+    ----------
+    system: string
+        batch system, wq, lsf, slurm, local or queue
+    types: list, optional
+        image types to make, default jpg
+    bands: list, optional
+        bands to use, default g,r,i
+    campaign: string, optional
+        campaign, e.g. y6a1_coadd
+    nthreads: int, optional
+        number of threads for the image processing kernels
+    njobs: int, optional
+        for system local, the number of worker processes, default the
+        number of cpus
+    use_manifest: bool, optional
+        If True, use the campaign manifest to find the tiles to make, which
+        includes tiles made from out of date inputs or parameters.  The
+        images are recorded in the manifest as they are made
+    check_inputs: bool, optional
+        With use_manifest, also find tiles whose input files have changed
+        size or modification time since they were made.  This lists the
+        input files of every tile using the transfer
+    transfer: transfer object, optional
+        used to list the input files for check_inputs, and with system
+        local to get the coadd files, default is a transfer.RsyncTransfer
+    stretch: string, optional
+        The stretch, e.g. asinh or gamma:2.2, default asinh
+    autoscale: bool, optional
+        If True, set the scales for each tile from its sky noise
+    render_cache: bool, optional
+        If True, take images made before from the same inputs and
+        parameters from the render cache in the default location, and add
+        new images to it
+    source_cache: bool, optional
+        If True, keep the source files in the shared source cache in the
+        default location rather than fetching them for each tile
+    tiles_per_task: int, optional
+        For system slurm, the number of tiles made by each array task,
+        default 1
+    max_array_size: int, optional
+        For system slurm, the largest number of array tasks, default
+        SLURM_MAX_ARRAY_SIZE.  This must be below the MaxArraySize of the
+        cluster
+    max_running: int, optional
+        For system slurm, the number of array tasks allowed to run at once,
+        default no limit
+    """
+    def __init__(
+        self, system, types=None, bands=None, campaign=None, nthreads=None,
+        njobs=None, use_manifest=False, stretch=None, autoscale=False,
+        render_cache=False, source_cache=False, tiles_per_task=1,
+        check_inputs=False, transfer=None,
+        max_array_size=SLURM_MAX_ARRAY_SIZE, max_running=None,
+    ):
         self._system = system
 
         if campaign is None:
@@ -20,21 +105,195 @@ class ScriptMaker(object):
         if bands is None:
             bands = ["g", "r", "i"]
 
+        if tiles_per_task < 1:
+            raise ValueError(
+                "tiles_per_task must be at least 1, got %d" % tiles_per_task
+            )
+        if max_array_size < 1:
+            raise ValueError(
+                "max_array_size must be at least 1, got %d" % max_array_size
+            )
+        if max_running is not None and max_running < 1:
+            raise ValueError(
+                "max_running must be at least 1, got %d" % max_running
+            )
+
         self._campaign = campaign
         self._types = types
         self._bands = bands
+        self._nthreads = nthreads
+        self._njobs = njobs
+        self._use_manifest = use_manifest
+        self._check_inputs = check_inputs
+        self._transfer = transfer
+        self._stretch = stretch
+        self._autoscale = autoscale
+        self._render_cache = render_cache
+        self._source_cache = source_cache
+        self._tiles_per_task = tiles_per_task
+        self._max_array_size = max_array_size
+        self._max_running = max_running
 
     def go(self):
         """
-        write all scripts and batch files
+        write all scripts and batch files, or for system local make the
+        images
+
+        returns
+        -------
+        failed: list or None
+            For system local, the tilenames for which making the images
+            failed
         """
+        if self._system == "local":
+            return self._run_local()
+
+        if self._system == "queue":
+            self._fill_queue()
+            return
+
         script_dir = files.get_script_dir(self._campaign)
         if not os.path.exists(script_dir):
-            print("making dir:", script_dir)
+            logger.info("making dir: %s", script_dir)
             os.makedirs(script_dir)
 
         flist = imagemaker.get_flist(self._campaign)
 
+        tilenames = list(self._get_tilenames(flist))
+        to_make = set(self._get_tilenames_to_make(flist, tilenames))
+
+        if self._system == "slurm":
+            self._write_slurm(
+                [tilename for tilename in tilenames if tilename in to_make]
+            )
+            return
+
+        for tilename in tilenames:
+            if tilename in to_make:
+                self._write_script(tilename)
+                self._write_batch(tilename)
+            else:
+                self._clear_batch(tilename)
+
+    def _run_local(self):
+        """
+        make the missing images in a pool of worker processes.  Results are
+        reported as each tile finishes, and failures do not stop the run
+        """
+        flist = imagemaker.get_flist(self._campaign)
+
+        tilenames = self._get_tilenames_to_make(
+            flist, list(self._get_tilenames(flist)),
+        )
+        ntiles = len(tilenames)
+        logger.info("making %d tiles", ntiles)
+
+        failed = []
+        with ProcessPoolExecutor(
+            max_workers=self._njobs,
+            initializer=_init_worker,
+        ) as pool:
+            futures = {}
+            for tilename in tilenames:
+                future = pool.submit(
+                    _make_tile,
+                    tilename,
+                    campaign=self._campaign,
+                    types=self._types,
+                    bands=self._bands,
+                    nthreads=self._nthreads,
+                    use_manifest=self._use_manifest,
+                    stretch=self._stretch,
+                    autoscale=self._autoscale,
+                    render_cache=self._render_cache,
+                    source_cache=self._source_cache,
+                    transfer=self._transfer,
+                )
+                futures[future] = tilename
+
+            for i, future in enumerate(as_completed(futures)):
+                tilename = futures[future]
+                try:
+                    tm = future.result()
+                    logger.info(
+                        "%d/%d done %s in %.1f seconds",
+                        i + 1, ntiles, tilename, tm,
+                    )
+                except Exception as err:
+                    failed.append(tilename)
+                    logger.warning(
+                        "%d/%d failed %s: %r", i + 1, ntiles, tilename, err,
+                    )
+
+        logger.info(
+            "made %d tiles, %d failed", ntiles - len(failed), len(failed),
+        )
+        for tilename in failed:
+            logger.warning("failed: %s", tilename)
+
+        return failed
+
+    def _fill_queue(self):
+        """
+        add the tiles to make to the campaign queue, to be made by workers
+        started with des-image-worker
+        """
+        flist = imagemaker.get_flist(self._campaign)
+
+        tilenames = self._get_tilenames_to_make(
+            flist, list(self._get_tilenames(flist)),
+        )
+
+        queue = worker.get_queue(self._campaign)
+        nadded = queue.add(tilenames)
+        logger.info("added %d tiles to %s", nadded, queue.queue_dir)
+        logger.info("counts: %s", queue.get_counts())
+
+    def reconcile(self, nthreads=8):
+        """
+        bring the campaign manifest in sync with the images on disk, adding
+        existing images for these bands and types
+        """
+        flist = imagemaker.get_flist(self._campaign)
+        with manifest.RenderManifest(self._campaign) as man:
+            return man.reconcile(
+                nthreads=nthreads,
+                flist=flist,
+                bands=self._bands,
+                types=self._types,
+            )
+
+    def _get_tilenames_to_make(self, flist, tilenames):
+        """
+        get the tiles for which images need to be made
+        """
+        if self._use_manifest:
+            stat_inputs = None
+            if self._check_inputs:
+                transfer = self._transfer
+                if transfer is None:
+                    transfer = transfer_mod.RsyncTransfer()
+                stat_inputs = transfer.stat_files
+
+            with manifest.RenderManifest(self._campaign) as man:
+                return man.get_stale(
+                    flist, tilenames, self._bands, self._types,
+                    params=manifest.get_params(
+                        stretch=self._stretch, autoscale=self._autoscale,
+                        campaign=self._campaign,
+                    ),
+                    stat_inputs=stat_inputs,
+                )
+        else:
+            return [
+                tilename for tilename in tilenames
+                if self._needs_image(tilename)
+            ]
+
+    def _get_tilenames(self, flist):
+        """
+        get the tilenames for which all bands are present
+        """
         tilenames = {}
         for key in flist:
             tilename = key[0:-2]
@@ -43,32 +302,30 @@ class ScriptMaker(object):
         for tilename in tilenames:
 
             # make sure all bands are present
-            if not self._bands_present(tilename, flist):
-                continue
+            if self._bands_present(tilename, flist):
+                yield tilename
 
-            doprint = False
-            for type in self._types:
-                image_file = files.get_output_file(
-                    self._campaign,
-                    tilename,
-                    self._bands,
-                    ext=type,
-                )
-                if not os.path.exists(image_file):
-                    doprint = True
-                    break
-
-            if doprint:
-                self._write_script(tilename)
-                self._write_batch(tilename)
-            else:
-                self._clear_batch(tilename)
+    def _needs_image(self, tilename):
+        """
+        check if any of the image types are missing for this tile
+        """
+        for type in self._types:
+            image_file = files.get_output_file(
+                self._campaign,
+                tilename,
+                self._bands,
+                ext=type,
+            )
+            if not os.path.exists(image_file):
+                return True
+
+        return False
 
     def _bands_present(self, tilename, flist):
         for band in self._bands:
             key = "%s-%s" % (tilename, band)
             if key not in flist:
-                print("missing %s" % key)
+                logger.warning("missing %s", key)
                 return False
 
         return True
@@ -140,7 +397,7 @@ bash %(script_file)s \n"""
             oefile=oefile,
         )
 
-        print("writing:", lsf_file)
+        logger.info("writing: %s", lsf_file)
         with open(lsf_file, "w") as fobj:
             fobj.write(text)
 
@@ -198,35 +455,198 @@ job_name: "%(job_name)s"
         if os.path.exists(wqlog):
             os.remove(wqlog)
 
-        print("writing:", wq_file)
+        logger.info("writing: %s", wq_file)
         with open(wq_file, "w") as fobj:
             fobj.write(text)
 
+    def _write_slurm(self, tilenames):
+        """
+        write the job array script and the list of tiles for each task, or
+        remove them if there are no tiles to make
+        """
+        slurm_file = files.get_slurm_file(self._campaign, self._bands)
+        tiles_file = files.get_slurm_tiles_file(self._campaign, self._bands)
+
+        if len(tilenames) == 0:
+            logger.info("no tiles to make")
+            for fname in [slurm_file, tiles_file]:
+                if os.path.exists(fname):
+                    os.remove(fname)
+            return
+
+        tiles_per_task = get_tiles_per_task(
+            len(tilenames), self._tiles_per_task, self._max_array_size,
+        )
+        if tiles_per_task > self._tiles_per_task:
+            logger.info(
+                "using %d tiles per task to fit in %d array tasks",
+                tiles_per_task, self._max_array_size,
+            )
+        tasks = pack_tiles(tilenames, tiles_per_task)
+
+        log_dir = files.get_slurm_log_dir(self._campaign)
+        if not os.path.exists(log_dir):
+            logger.info("making dir: %s", log_dir)
+            os.makedirs(log_dir)
+
+        logger.info("writing: %s", tiles_file)
+        with open(tiles_file, "w") as fobj:
+            for task_tiles in tasks:
+                fobj.write(" ".join(task_tiles) + "\n")
+
+        ncpus = 1 if self._nthreads is None else self._nthreads
+
+        throttle = ""
+        if self._max_running is not None:
+            throttle = "%%%d" % self._max_running
+
+        # the task id is the line number in the tiles file, from zero
+        text = """#!/bin/bash
+#SBATCH --job-name=%(job_name)s
+#SBATCH --array=0-%(last_task)d%(throttle)s
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task=%(ncpus)d
+#SBATCH --time=%(minutes)d
+#SBATCH --output=%(log_dir)s/%%A_%%a.log
+
+tiles=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" %(tiles_file)s)
+
+%(command)s $tiles
+"""
+        text = text % dict(
+            job_name="%s-rgb" % self._campaign,
+            last_task=len(tasks) - 1,
+            throttle=throttle,
+            ncpus=ncpus,
+            minutes=SLURM_MINUTES_PER_TILE * tiles_per_task,
+            log_dir=log_dir,
+            tiles_file=tiles_file,
+            command=self._get_command(),
+        )
+
+        logger.info("writing: %s", slurm_file)
+        with open(slurm_file, "w") as fobj:
+            fobj.write(text)
+
+        logger.info(
+            "%d tiles in %d array tasks, submit with: sbatch %s",
+            len(tilenames), len(tasks), slurm_file,
+        )
+
+    def _get_command(self):
+        """
+        get the des-make-image command, without the tilenames
+        """
+        command = "des-make-image --types=%s --campaign=%s --bands=%s" % (
+            ",".join(self._types), self._campaign, ",".join(self._bands),
+        )
+
+        if self._nthreads is not None:
+            command += " --nthreads=%d" % self._nthreads
+        if self._use_manifest:
+            command += " --manifest"
+        if self._stretch is not None:
+            command += " --stretch=%s" % self._stretch
+        if self._autoscale:
+            command += " --autoscale"
+        if self._render_cache:
+            command += " --render-cache"
+        if self._source_cache:
+            command += " --source-cache"
+
+        return command
+
     def _write_script(self, tilename):
         """
         write the basic script
         """
 
-        bstr = ",".join(self._bands)
-
         script_file = files.get_script_file(
             self._campaign,
             tilename,
             self._bands,
         )
 
-        typestring = ",".join(self._types)
-
         text = """
-des-make-image --types=%(types)s --campaign=%(campaign)s --bands=%(bands)s %(tilename)s
-        \n"""  # noqa
+%(command)s %(tilename)s
+        \n"""
         text = text % dict(
-            campaign=self._campaign,
+            command=self._get_command(),
             tilename=tilename,
-            types=typestring,
-            bands=bstr,
         )
 
-        print("writing:", script_file)
+        logger.info("writing: %s", script_file)
         with open(script_file, "w") as fobj:
             fobj.write(text)
+
+
+def get_tiles_per_task(ntiles, tiles_per_task, max_array_size):
+    """
+    get the number of tiles for each task, at least tiles_per_task and
+    enough that the tiles fit in max_array_size tasks
+    """
+    return max(tiles_per_task, -(-ntiles // max_array_size))
+
+
+def pack_tiles(tilenames, tiles_per_task):
+    """
+    group the tiles into tasks of at most tiles_per_task tiles, keeping
+    their order
+
+    returns
+    -------
+    tasks: list
+        The list of tilenames for each task
+    """
+    return [
+        tilenames[start:start + tiles_per_task]
+        for start in range(0, len(tilenames), tiles_per_task)
+    ]
+
+
+def _init_worker():
+    """
+    compile the kernels once for each worker process
+    """
+    instrument.setup_logging()
+    images.warmup()
+
+
+def _make_tile(
+    tilename, campaign, types, bands, nthreads, use_manifest, stretch,
+    autoscale, render_cache, source_cache, transfer=None,
+):
+    """
+    make the images for a tile, returning the time taken
+    """
+    tm0 = time.time()
+
+    if render_cache:
+        render_cache = rendercache.RenderCache()
+    else:
+        render_cache = None
+
+    if source_cache:
+        source_cache = sourcecache.SourceCache()
+    else:
+        source_cache = None
+
+    imagemaker.make_image_auto(
+        tilename,
+        campaign=campaign,
+        type=types,
+        bands=bands,
+        nthreads=nthreads,
+        manifest=use_manifest,
+        stretch=stretch,
+        autoscale=autoscale,
+        render_cache=render_cache,
+        source_cache=source_cache,
+        transfer=transfer,
+    )
+    if render_cache is not None:
+        render_cache.close()
+    if source_cache is not None:
+        source_cache.close()
+
+    return time.time() - tm0
@@ -0,0 +1,879 @@
+"""
+benchmarks
+
+run_benchmarks makes synthetic coadd files and times
+
+    - each stage of making a color image from them, as done by
+      RGBImageMaker: read, mask propagation, interpolation, flip, rebin,
+      stretch, bytescale and encoding
+    - the full RGBImageMaker run, making and writing each image type
+    - the kernels in images.py on arrays in memory
+    - the strip writers for each image type and encoder setting, with the
+      size of the output, and PIL encoding the whole image for reference
+
+and reports pixels per second and the peak memory use.  The results are a
+dict that can be written as json and compared with those from another
+commit using compare_results.
+
+measure_memory makes an image in a fresh process and reports the peak
+memory used per megapixel of input, so regressions in memory use can be
+caught by checking it against a limit.
+
+time_startup times the steps of starting a short job, each in a fresh
+process: importing the package, importing the kernels and the first call
+of the serial and of all kernels.  With the on-disk kernel cache populated
+the first call should not compile anything.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+
+STARTUP_STEPS = [
+    ("import", "import desimage"),
+    ("import_kernels", "from desimage import images"),
+    (
+        "first_call_serial",
+        "from desimage import images; images.warmup(parallel=False)",
+    ),
+    (
+        "first_call",
+        "from desimage import images; images.warmup()",
+    ),
+    (
+        "cli_help",
+        "import runpy, sys; sys.argv = ['des-make-image', '--help']; "
+        "runpy.run_path(%(script)r, run_name='__main__')",
+    ),
+]
+
+MEMORY_CODE = """
+import os, json
+from desimage import benchmark, images, instrument
+from desimage.imagemaker import RGBImageMaker
+images.warmup()
+instrument.reset_peak_rss()
+ifiles = benchmark._get_files(%(fnames)r)
+rebin = %(rebin)r
+maker = RGBImageMaker(
+    ifiles, rebin=rebin, nthreads=%(nthreads)r, strip_rows=%(strip_rows)r,
+)
+types = %(types)r
+fnames = [os.path.join(%(dirname)r, "bench-memory." + t) for t in types]
+base_mb = instrument.get_peak_rss_mb()
+if maker.can_stream(types):
+    maker.make_and_write(fnames)
+else:
+    maker.make_image()
+    for fname in fnames:
+        maker.write_image(fname=fname)
+nrows, ncols = maker._get_output_shape()
+if rebin is not None:
+    nrows, ncols = nrows * rebin, ncols * rebin
+print(json.dumps(dict(
+    base_mb=base_mb, peak_mb=instrument.get_peak_rss_mb(), npix=nrows * ncols,
+)))
+"""
+
+DEFAULT_NROWS = 10000
+DEFAULT_NCOLS = 10000
+
+# (name, image type, keywords for stripwriter.write_image)
+ENCODER_SETTINGS = [
+    ("jpg_q75", "jpg", {"quality": 75}),
+    ("jpg_q90", "jpg", {"quality": 90}),
+    ("jpg_q95", "jpg", {"quality": 95}),
+    ("png_level1", "png", {"compress_level": 1}),
+    ("png_level6", "png", {"compress_level": 6}),
+    ("tif_none", "tif", {}),
+    ("tif_deflate1", "tif", {"compress_level": 1}),
+    ("tif_deflate6", "tif", {"compress_level": 6}),
+]
+
+# exposure times differ by band so the scaling is exercised
+EXPTIMES = {"u": 800.0, "g": 900.0, "r": 800.0, "i": 1000.0, "z": 900.0}
+
+
+def run_benchmarks(
+    nrows=DEFAULT_NROWS,
+    ncols=DEFAULT_NCOLS,
+    nrepeat=3,
+    nthreads=None,
+    rebin=None,
+    types=("jpg",),
+    bands="gri",
+    compress=True,
+    dirname=None,
+    seed=None,
+):
+    """
+    make synthetic coadd files and run the pipeline and kernel benchmarks
+
+    parameters
+    ----------
+    nrows, ncols: int, optional
+        size of the synthetic images, default 10000 x 10000
+    nrepeat: int, optional
+        number of runs of each timing; the minimum time is reported
+    nthreads: int, optional
+        number of threads for the kernels, default 1
+    rebin: int, optional
+        rebin factor for the pipeline
+    types: list, optional
+        image types to encode, default jpg
+    bands: string, optional
+        bands for which to make files; u and z are added to g and i
+    compress: bool, optional
+        If True, write tile compressed files as for real coadds, default
+        True
+    dirname: string, optional
+        Where to write the synthetic files.  By default a temporary
+        directory is used and removed afterward
+    seed: int, optional
+        seed for the random numbers
+
+    returns
+    -------
+    results: dict
+    """
+    from . import images
+    from . import instrument
+
+    images.warmup()
+
+    remove_dir = dirname is None
+    if dirname is None:
+        dirname = tempfile.mkdtemp(prefix="desimage-bench-")
+
+    try:
+        print("making synthetic files in", dirname)
+        fnames = make_test_files(
+            dirname, nrows=nrows, ncols=ncols, bands=bands,
+            compress=compress, seed=seed,
+        )
+
+        results = {
+            "info": get_run_info(),
+            "config": {
+                "nrows": nrows,
+                "ncols": ncols,
+                "nrepeat": nrepeat,
+                "nthreads": nthreads,
+                "rebin": rebin,
+                "types": list(types),
+                "bands": bands,
+                "compress": compress,
+            },
+        }
+
+        results["stages"] = time_stages(
+            fnames, nrepeat=nrepeat, nthreads=nthreads, rebin=rebin,
+            types=types,
+        )
+        results["pipeline"] = time_pipeline(
+            fnames, dirname, nrepeat=nrepeat, nthreads=nthreads, rebin=rebin,
+            types=types,
+        )
+        results["memory"] = measure_memory(
+            fnames, dirname, nthreads=nthreads, rebin=rebin, types=types,
+        )
+        results["encoders"] = time_encoders(
+            fnames, dirname, nrepeat=nrepeat, nthreads=nthreads, rebin=rebin,
+        )
+        results["functions"] = time_functions(
+            nrows=nrows, ncols=ncols, nrepeat=nrepeat, nthreads=nthreads,
+            seed=seed,
+        )
+        # the peak is reset for each stage, so the overall peak is the
+        # largest of those
+        results["peak_rss_mb"] = max(
+            [instrument.get_peak_rss_mb()] + [
+                result["peak_rss_mb"]
+                for name in ["stages", "pipeline", "encoders", "functions"]
+                for result in results[name].values()
+            ]
+        )
+    finally:
+        if remove_dir:
+            shutil.rmtree(dirname, ignore_errors=True)
+
+    return results
+
+
+def make_test_files(
+    dirname,
+    nrows=DEFAULT_NROWS,
+    ncols=DEFAULT_NCOLS,
+    bands="gri",
+    compress=True,
+    tilename="DES0000+0000",
+    nan_frac=1.0e-4,
+    seed=None,
+):
+    """
+    write synthetic coadd files like those for a DES tile: an image HDU
+    with FILTER, EXPTIME and WCS keywords, and a msk HDU.  The images hold
+    sky noise, sources and NaNs, and the masks bad columns and a bleed
+    trail
+
+    parameters
+    ----------
+    dirname: string
+        directory for the files
+    nrows, ncols: int, optional
+        image size, default 10000 x 10000
+    bands: string, optional
+        bands to make, default gri
+    compress: bool, optional
+        If True, rice compress the images and write .fits.fz files,
+        default True
+    tilename: string, optional
+        used in the file names
+    nan_frac: float, optional
+        fraction of pixels set to NaN
+    seed: int, optional
+        seed for the random numbers
+
+    returns
+    -------
+    fnames: dict
+        file names keyed by band
+    """
+    import numpy as np
+    import fitsio
+
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+    rng = np.random.default_rng(seed)
+
+    # the same sources in each band, with different fluxes
+    nsources = max(nrows * ncols // 20000, 1)
+    src_rows = rng.integers(0, nrows, size=nsources)
+    src_cols = rng.integers(0, ncols, size=nsources)
+    src_flux = rng.exponential(scale=50.0, size=nsources).astype("f4")
+
+    fnames = {}
+    for band in bands:
+        exptime = EXPTIMES.get(band, 900.0)
+
+        image = rng.standard_normal(size=(nrows, ncols), dtype="f4")
+        image *= 0.5
+
+        flux = src_flux * rng.uniform(0.5, 1.5, size=nsources)
+        for drow, dcol, frac in _get_psf_offsets():
+            rows = np.clip(src_rows + drow, 0, nrows - 1)
+            cols = np.clip(src_cols + dcol, 0, ncols - 1)
+            np.add.at(image, (rows, cols), flux * frac)
+
+        nnan = int(nan_frac * nrows * ncols)
+        image[
+            rng.integers(0, nrows, size=nnan),
+            rng.integers(0, ncols, size=nnan),
+        ] = np.nan
+
+        mask = np.zeros((nrows, ncols), dtype="i4")
+        mask[:, rng.integers(0, ncols, size=max(ncols // 2000, 1))] = 1
+        row, col = nrows // 3, ncols // 3
+        mask[row:row + max(nrows // 10, 1), col:col + 3] = 1
+
+        if compress:
+            ext = "fits.fz"
+            compression = "rice"
+        else:
+            ext = "fits"
+            compression = None
+
+        fname = os.path.join(
+            dirname, "%s_%s.%s" % (tilename, band, ext),
+        )
+
+        header = {
+            "FILTER": "%s DECam" % band,
+            "EXPTIME": exptime,
+            "CTYPE1": "RA---TAN",
+            "CTYPE2": "DEC--TAN",
+            "CRVAL1": 0.0,
+            "CRVAL2": 0.0,
+            "CRPIX1": (ncols + 1) / 2.0,
+            "CRPIX2": (nrows + 1) / 2.0,
+            "CD1_1": -0.263 / 3600.0,
+            "CD1_2": 0.0,
+            "CD2_1": 0.0,
+            "CD2_2": 0.263 / 3600.0,
+        }
+        with fitsio.FITS(fname, "rw", clobber=True) as fits:
+            fits.write(None)
+            fits.write(
+                image, header=header, compress=compression, extname="sci",
+            )
+            fits.write(mask, compress=compression, extname="msk")
+
+        fnames[band] = fname
+
+    return fnames
+
+
+def time_stages(fnames, nrepeat=3, nthreads=None, rebin=None, types=("jpg",)):
+    """
+    time each stage of making a color image, in the order done by
+    RGBImageMaker
+
+    The stretch and bytescale stages use the original two step method; the
+    image maker does both in one pass, timed as stretch_bytescale.  When
+    not rebinning the flip is also done in that pass, and there is no
+    separate flip stage
+
+    parameters
+    ----------
+    fnames: dict
+        file names keyed by band, as returned by make_test_files
+    nrepeat: int, optional
+        number of runs; the minimum time for each stage is reported
+    nthreads: int, optional
+        number of threads for the kernels
+    rebin: int, optional
+        rebin factor
+    types: list, optional
+        image types to encode
+
+    returns
+    -------
+    stages: dict
+        For each stage the seconds, pixels per second and peak memory
+        use so far
+    """
+    from . import images
+    from .imagemaker import RGBImageMaker
+
+    ifiles = _get_files(fnames)
+    maker = RGBImageMaker(ifiles, rebin=rebin, nthreads=nthreads)
+    if nthreads is not None:
+        images.set_num_threads(nthreads)
+
+    timer = _StageTimer()
+    for irepeat in range(nrepeat):
+        timer.start("read")
+        imlist = _read_images(ifiles)
+        npix = imlist[0].image.size
+        timer.stop(npix)
+
+        timer.start("mask_propagation")
+        mask = None
+        for i, im in enumerate(imlist):
+            if im.mask is not None:
+                if mask is None:
+                    mask = im.mask.copy()
+                else:
+                    mask[im.mask > 0] = 1
+        if mask is not None:
+            maker._propagate_missing_data(
+                imlist[0].image, imlist[1].image, imlist[2].image, mask,
+            )
+        timer.stop(npix)
+
+        timer.start("interpolation")
+        if mask is not None:
+            for im in imlist:
+                maker._interpolate_bad(im.image, mask)
+        timer.stop(npix)
+
+        # if not rebinning, the flip is done when making the color image
+        if rebin is not None:
+            timer.start("flip")
+            for im in imlist:
+                im.flip_ud()
+            timer.stop(npix)
+
+            timer.start("rebin")
+            for im in imlist:
+                im.rebin(rebin)
+            timer.stop(npix)
+
+        maker.imlist = imlist
+        scales = maker._get_scales()
+        nrows, ncols = imlist[0].image.shape
+        out_npix = nrows * ncols
+
+        timer.start("stretch")
+        colorim = _zeros((nrows, ncols, 3), "f4")
+        maker._get_color_image(
+            imlist[2].image, imlist[1].image, imlist[0].image,
+            maker.stretch_table, scales, colorim,
+        )
+        timer.stop(out_npix)
+
+        timer.start("bytescale")
+        images.bytescale(colorim)
+        timer.stop(out_npix)
+        del colorim
+
+        timer.start("stretch_bytescale")
+        colorim = _zeros((nrows, ncols, 3), "u1")
+        maker._get_color_image_bytes(
+            imlist[2].image, imlist[1].image, imlist[0].image,
+            maker.stretch_table, scales, colorim, rebin is None,
+        )
+        timer.stop(out_npix)
+
+        for image_type in types:
+            if image_type == "dzi":
+                continue
+            timer.start("encode_" + image_type)
+            nbytes = _encode(colorim, image_type, os.path.dirname(fnames["g"]))
+            timer.stop(out_npix, nbytes=nbytes)
+
+        del colorim, imlist, mask
+        maker.imlist = None
+
+    return timer.results
+
+
+def time_pipeline(
+    fnames, dirname, nrepeat=3, nthreads=None, rebin=None, types=("jpg",),
+):
+    """
+    time a full run of RGBImageMaker, making the image and writing each
+    type to dirname
+
+    returns
+    -------
+    results: dict
+        seconds, pixels per second and peak memory use for make_image and
+        for writing each type
+    """
+    from .imagemaker import RGBImageMaker
+
+    ifiles = _get_files(fnames)
+
+    timer = _StageTimer()
+    for irepeat in range(nrepeat):
+        maker = RGBImageMaker(ifiles, rebin=rebin, nthreads=nthreads)
+
+        timer.start("make_image")
+        maker.make_image()
+        npix = maker.imlist[0].image.size
+        timer.stop(npix)
+
+        for image_type in types:
+            fname = os.path.join(dirname, "bench-output." + image_type)
+            timer.start("write_" + image_type)
+            maker.write_image(fname=fname)
+            timer.stop(npix)
+
+        del maker
+
+    return timer.results
+
+
+def time_encoders(
+    fnames, dirname, nrepeat=3, nthreads=None, rebin=None,
+    settings=ENCODER_SETTINGS,
+):
+    """
+    make an image and time writing it with the strip writers for each image
+    type and encoder setting.  PIL encoding the whole image with its default
+    settings, and quality 90 for jpg, is timed for reference as pil_<type>
+
+    parameters
+    ----------
+    settings: list, optional
+        (name, image type, keywords for stripwriter.write_image) for each
+        setting, default ENCODER_SETTINGS
+
+    returns
+    -------
+    results: dict
+        seconds, pixels per second and bytes written for each setting
+    """
+    from PIL import Image
+    from . import stripwriter
+    from .imagemaker import RGBImageMaker
+
+    maker = RGBImageMaker(_get_files(fnames), rebin=rebin, nthreads=nthreads)
+    maker.make_image()
+    colorim = maker.colorim
+    npix = colorim.shape[0] * colorim.shape[1]
+    del maker
+
+    image_types = []
+    for name, image_type, kw in settings:
+        if image_type not in image_types:
+            image_types.append(image_type)
+
+    timer = _StageTimer()
+    for irepeat in range(nrepeat):
+        for name, image_type, kw in settings:
+            fname = os.path.join(dirname, "bench-encode." + image_type)
+            timer.start(name)
+            stripwriter.write_image(fname, colorim, **kw)
+            timer.stop(npix, nbytes=os.path.getsize(fname))
+            os.remove(fname)
+
+        for image_type in image_types:
+            fname = os.path.join(dirname, "bench-encode." + image_type)
+            kw = {"quality": 90} if image_type == "jpg" else {}
+            timer.start("pil_" + image_type)
+            Image.fromarray(colorim).save(fname, **kw)
+            timer.stop(npix, nbytes=os.path.getsize(fname))
+            os.remove(fname)
+
+    return timer.results
+
+
+def measure_memory(
+    fnames, dirname, nthreads=None, rebin=None, types=("jpg",),
+    strip_rows=None,
+):
+    """
+    make and write an image with RGBImageMaker in a new process and measure
+    the increase in peak memory over that after importing and compiling.
+    Where the peak cannot be reset after compiling, as on macos, it includes
+    the memory used while compiling, so small images may not be measured
+
+    returns
+    -------
+    results: dict
+        peak_mb, base_mb, npix and mb_per_mpix, the peak increase per
+        million input pixels
+    """
+    code = MEMORY_CODE % dict(
+        fnames=fnames,
+        dirname=dirname,
+        nthreads=nthreads,
+        rebin=rebin,
+        types=list(types),
+        strip_rows=strip_rows,
+    )
+    output = subprocess.check_output([sys.executable, "-c", code])
+    results = json.loads(output.decode("utf-8").strip().split("\n")[-1])
+
+    results["mb_per_mpix"] = (
+        (results["peak_mb"] - results["base_mb"]) / (results["npix"] / 1.0e6)
+    )
+    return results
+
+
+def time_functions(
+    nrows=DEFAULT_NROWS,
+    ncols=DEFAULT_NCOLS,
+    nrepeat=3,
+    nthreads=None,
+    seed=None,
+):
+    """
+    time the functions in images.py on synthetic arrays in memory
+
+    returns
+    -------
+    results: dict
+        seconds and pixels per second for each function, keyed by name
+    """
+    import numpy as np
+    from . import images
+    from . import stretch
+
+    if nthreads is not None:
+        images.set_num_threads(nthreads)
+
+    table = stretch.get_table()
+    rng = np.random.default_rng(seed)
+    ims = [
+        rng.standard_normal(size=(nrows, ncols), dtype="f4")
+        for i in range(3)
+    ]
+    mask = np.zeros((nrows, ncols), dtype="i4")
+    mask[:, ::1000] = 1
+    scales = np.array([0.03, 0.03, 0.045])
+    npix = nrows * ncols
+
+    # boost makes an image twice the size in each dimension
+    small = ims[0][:nrows // 2, :ncols // 2].copy()
+
+    funcs = [
+        (
+            "get_color_image",
+            lambda: images.get_color_image(
+                ims[2], ims[1], ims[0], table, scales,
+                _zeros((nrows, ncols, 3), "f4"),
+            ),
+        ),
+        (
+            "get_color_image_bytes",
+            lambda: images.get_color_image_bytes(
+                ims[2], ims[1], ims[0], table, scales,
+                _zeros((nrows, ncols, 3), "u1"), True,
+            ),
+        ),
+        (
+            "rebin",
+            lambda: images.rebin(ims[0][:nrows // 2 * 2, :ncols // 2 * 2], 2),
+        ),
+        ("boost", lambda: images.boost(small, 2)),
+        ("interpolate_bad", lambda: images.interpolate_bad(ims[0], mask)),
+        (
+            "propagate_missing_data",
+            lambda: images.propagate_missing_data(
+                ims[0], ims[1], ims[2], mask,
+            ),
+        ),
+    ]
+
+    if nthreads is not None and nthreads > 1:
+        funcs += [
+            (
+                "get_color_image_bytes_parallel",
+                lambda: images.get_color_image_bytes_parallel(
+                    ims[2], ims[1], ims[0], table, scales,
+                    _zeros((nrows, ncols, 3), "u1"), True,
+                ),
+            ),
+            (
+                "interpolate_bad_parallel",
+                lambda: images.interpolate_bad_parallel(ims[0], mask),
+            ),
+        ]
+
+    timer = _StageTimer()
+    for name, func in funcs:
+        for irepeat in range(nrepeat):
+            timer.start(name)
+            func()
+            timer.stop(npix)
+
+    return timer.results
+
+
+def compare_results(old, new):
+    """
+    compare the times in two sets of results
+
+    returns
+    -------
+    comparison: list of (name, old_seconds, new_seconds, speedup)
+    """
+    comparison = []
+    for group in ["stages", "pipeline", "encoders", "functions"]:
+        old_group = old.get(group, {})
+        new_group = new.get(group, {})
+        for name in new_group:
+            if name not in old_group:
+                continue
+            old_time = old_group[name]["seconds"]
+            new_time = new_group[name]["seconds"]
+            speedup = old_time / new_time if new_time > 0 else float("inf")
+            comparison.append(
+                ("%s.%s" % (group, name), old_time, new_time, speedup)
+            )
+
+    return comparison
+
+
+def print_comparison(comparison):
+    """
+    print the comparison from compare_results
+    """
+    print("%-45s %10s %10s %8s" % ("name", "old", "new", "speedup"))
+    for name, old_time, new_time, speedup in comparison:
+        print(
+            "%-45s %10.4f %10.4f %8.2f" % (name, old_time, new_time, speedup)
+        )
+
+
+def get_run_info():
+    """
+    information identifying the code and machine
+    """
+    import numpy as np
+    import numba
+    from . import __version__
+
+    return {
+        "version": __version__,
+        "commit": _get_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "numba": numba.__version__,
+        "machine": platform.machine(),
+        "node": platform.node(),
+        "ncpu": os.cpu_count(),
+    }
+
+
+def time_startup(nrepeat=3, script=None):
+    """
+    time the startup steps, each in a new python process
+
+    parameters
+    ----------
+    nrepeat: int, optional
+        number of times to run each step; the minimum time is reported
+    script: string, optional
+        path to the des-make-image script, for timing --help.  If not
+        sent that step is skipped
+
+    returns
+    -------
+    times: dict
+        seconds for each step, keyed by step name
+    """
+    # the first run populates the kernel cache if needed
+    _run_python("from desimage import images; images.warmup()")
+
+    times = {}
+    for name, code in STARTUP_STEPS:
+        if "%(script)" in code:
+            if script is None:
+                continue
+            code = code % dict(script=script)
+
+        times[name] = min(_run_python(code) for i in range(nrepeat))
+
+    # the interpreter alone, for reference
+    times["python"] = min(_run_python("pass") for i in range(nrepeat))
+    return times
+
+
+class _StageTimer(object):
+    """
+    keep the minimum time for named stages over repeated runs, with the peak
+    memory during each stage.  Where the peak cannot be reset, as on macos,
+    it is the peak for the process so far
+    """
+
+    def __init__(self):
+        self.results = {}
+        self._name = None
+        self._tm0 = None
+
+    def start(self, name):
+        from . import instrument
+
+        instrument.reset_peak_rss()
+        self._name = name
+        self._tm0 = time.time()
+
+    def stop(self, npix, nbytes=None):
+        from . import instrument
+
+        seconds = time.time() - self._tm0
+        peak_rss_mb = instrument.get_peak_rss_mb()
+
+        result = self.results.get(self._name)
+        if result is not None:
+            # the largest peak over the runs
+            peak_rss_mb = max(peak_rss_mb, result["peak_rss_mb"])
+
+        if result is None or seconds < result["seconds"]:
+            result = {
+                "seconds": seconds,
+                "pixels_per_second": npix / seconds if seconds > 0 else None,
+            }
+            if nbytes is not None:
+                result["bytes"] = nbytes
+
+        result["peak_rss_mb"] = peak_rss_mb
+        self.results[self._name] = result
+
+
+def _get_files(fnames):
+    from .imagemaker import Files
+
+    return Files(
+        fnames["g"],
+        fnames["r"],
+        fnames["i"],
+        ufile=fnames.get("u"),
+        zfile=fnames.get("z"),
+        campaign="Y6A1_COADD",
+        tilename="DES0000+0000",
+    )
+
+
+def _read_images(ifiles):
+    """
+    read the images as done by RGBImageMaker, adding u and z to g and i
+    """
+    from .imagemaker import ImageTrans
+
+    imlist = [
+        ImageTrans(ifiles[key]) for key in ["gfile", "rfile", "ifile"]
+    ]
+    if ifiles["ufile"] is not None:
+        imlist[0].add_image(ImageTrans(ifiles["ufile"]))
+    if ifiles["zfile"] is not None:
+        imlist[2].add_image(ImageTrans(ifiles["zfile"]))
+
+    return imlist
+
+
+def _encode(colorim, image_type, dirname):
+    """
+    write the image to a file in dirname as done by
+    RGBImageMaker.write_image and return the number of bytes
+    """
+    from PIL import Image
+    from . import stripwriter
+
+    fname = os.path.join(dirname, "bench-encode." + image_type)
+    if image_type in stripwriter.WRITERS:
+        stripwriter.write_image(fname, colorim)
+    else:
+        Image.fromarray(colorim).save(fname)
+
+    nbytes = os.path.getsize(fname)
+    os.remove(fname)
+    return nbytes
+
+
+def _get_psf_offsets():
+    """
+    pixel offsets and flux fractions for a simple 3x3 source profile
+    """
+    weights = [[1, 2, 1], [2, 4, 2], [1, 2, 1]]
+    return [
+        (drow - 1, dcol - 1, weights[drow][dcol] / 16.0)
+        for drow in range(3)
+        for dcol in range(3)
+    ]
+
+
+def _zeros(shape, dtype):
+    import numpy as np
+    return np.zeros(shape, dtype=dtype)
+
+
+def _get_commit():
+    """
+    the git commit of the package, if it is in a git checkout
+    """
+    dname = os.path.dirname(os.path.abspath(__file__))
+    try:
+        output = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=dname,
+            stderr=subprocess.DEVNULL,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return output.decode("utf-8").strip()
+
+
+def _run_python(code):
+    """
+    run the code in a new python process and return the wall time
+    """
+    tm0 = time.time()
+    subprocess.check_call(
+        [sys.executable, "-c", code],
+        stdout=subprocess.DEVNULL,
+    )
+    return time.time() - tm0
@@ -0,0 +1,222 @@
+"""
+uncompressed tiled BigTIFF files that are filled in through a memory map
+
+The file is written with its header and tile tables up front and the pixel
+data preallocated, so separate processes can write disjoint sets of tiles
+directly into the file through numpy memory maps.  The tiles are stored in
+row-major order, each as tile_size x tile_size x 3 bytes of RGB data.
+"""
+from __future__ import print_function
+
+import struct
+import numpy as np
+
+DEFAULT_TILE_SIZE = 256
+
+# tile data starts on a page boundary
+DATA_ALIGN = 4096
+
+# tiff tags and field types
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC = 262
+IMAGE_DESCRIPTION = 270
+SAMPLES_PER_PIXEL = 277
+PLANAR_CONFIG = 284
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+
+ASCII = 2
+SHORT = 3
+LONG = 4
+LONG8 = 16
+
+TYPE_FORMATS = {ASCII: "s", SHORT: "H", LONG: "I", LONG8: "Q"}
+TYPE_SIZES = {ASCII: 1, SHORT: 2, LONG: 4, LONG8: 8}
+
+
+def create_tiled(
+    fname, nrows, ncols, tile_size=DEFAULT_TILE_SIZE, description=None,
+):
+    """
+    create a tiled RGB BigTIFF file with all pixels zero
+
+    parameters
+    ----------
+    fname: string
+        The file name
+    nrows, ncols: int
+        image size
+    tile_size: int, optional
+        size of the square tiles, a multiple of 16, default 256
+    description: string, optional
+        stored in the ImageDescription tag
+    """
+    if tile_size % 16 != 0:
+        raise ValueError(
+            "tile size must be a multiple of 16, got %d" % tile_size
+        )
+
+    ntile_rows, ntile_cols = get_tile_grid(nrows, ncols, tile_size)
+    ntiles = ntile_rows * ntile_cols
+    tile_bytes = tile_size * tile_size * 3
+
+    if description is None:
+        description = ""
+    description = description.encode("ascii") + b"\0"
+
+    entries = [
+        (IMAGE_WIDTH, LONG, [ncols]),
+        (IMAGE_LENGTH, LONG, [nrows]),
+        (BITS_PER_SAMPLE, SHORT, [8, 8, 8]),
+        (COMPRESSION, SHORT, [1]),
+        (PHOTOMETRIC, SHORT, [2]),
+        (IMAGE_DESCRIPTION, ASCII, description),
+        (SAMPLES_PER_PIXEL, SHORT, [3]),
+        (PLANAR_CONFIG, SHORT, [1]),
+        (TILE_WIDTH, LONG, [tile_size]),
+        (TILE_LENGTH, LONG, [tile_size]),
+        (TILE_OFFSETS, LONG8, None),
+        (TILE_BYTE_COUNTS, LONG8, None),
+    ]
+
+    # header, then the directory, then values too big to fit in an entry
+    ifd_offset = 16
+    ifd_size = 8 + 20 * len(entries) + 8
+    extra_offset = ifd_offset + ifd_size
+
+    extra_size = len(description) if len(description) > 8 else 0
+    if ntiles > 1:
+        extra_size += 2 * 8 * ntiles
+
+    data_offset = _align(extra_offset + extra_size, DATA_ALIGN)
+
+    tile_offsets = data_offset + tile_bytes * np.arange(ntiles, dtype="<u8")
+    byte_counts = np.zeros(ntiles, dtype="<u8") + tile_bytes
+
+    ifd = [struct.pack("<Q", len(entries))]
+    extra = []
+    for tag, ftype, values in entries:
+        if tag == TILE_OFFSETS:
+            values = tile_offsets
+        elif tag == TILE_BYTE_COUNTS:
+            values = byte_counts
+
+        data = _pack_values(ftype, values)
+        count = len(values)
+
+        if len(data) <= 8:
+            value_field = data + b"\0" * (8 - len(data))
+        else:
+            value_field = struct.pack(
+                "<Q", extra_offset + sum(len(e) for e in extra),
+            )
+            extra.append(data)
+
+        ifd.append(struct.pack("<HHQ", tag, ftype, count) + value_field)
+
+    ifd.append(struct.pack("<Q", 0))
+
+    header = b"II" + struct.pack("<HHHQ", 43, 8, 0, ifd_offset)
+
+    with open(fname, "wb") as fobj:
+        fobj.write(header)
+        fobj.write(b"".join(ifd))
+        fobj.write(b"".join(extra))
+        # preallocate the pixel data; the file is sparse where supported
+        fobj.truncate(data_offset + tile_bytes * ntiles)
+
+
+def memmap_tiles(fname, mode="r+"):
+    """
+    memory map the tiles of a file made by create_tiled
+
+    returns
+    -------
+    tiles: memmap
+        shape (ntile_rows, ntile_cols, tile_size, tile_size, 3)
+    nrows, ncols: int
+        image size
+    """
+    info = read_info(fname)
+
+    tile_size = info["tile_size"]
+    ntile_rows, ntile_cols = get_tile_grid(
+        info["nrows"], info["ncols"], tile_size,
+    )
+    tiles = np.memmap(
+        fname,
+        dtype="u1",
+        mode=mode,
+        offset=info["data_offset"],
+        shape=(ntile_rows, ntile_cols, tile_size, tile_size, 3),
+    )
+    return tiles, info["nrows"], info["ncols"]
+
+
+def read_info(fname):
+    """
+    read the image size, tile size and data offset of a file made by
+    create_tiled
+    """
+    with open(fname, "rb") as fobj:
+        header = fobj.read(16)
+        order, version, _, _, ifd_offset = struct.unpack("<2sHHHQ", header)
+        if order != b"II" or version != 43:
+            raise ValueError("not a little endian BigTIFF file: %s" % fname)
+
+        fobj.seek(ifd_offset)
+        nentries, = struct.unpack("<Q", fobj.read(8))
+
+        tags = {}
+        for i in range(nentries):
+            tag, ftype, count, value_field = struct.unpack(
+                "<HHQ8s", fobj.read(20),
+            )
+            if count == 1 and ftype in (SHORT, LONG, LONG8):
+                fmt = "<" + TYPE_FORMATS[ftype]
+                size = TYPE_SIZES[ftype]
+                tags[tag] = struct.unpack(fmt, value_field[:size])[0]
+            elif tag == TILE_OFFSETS:
+                # the first offset is enough, the tiles are contiguous
+                offset, = struct.unpack("<Q", value_field)
+                here = fobj.tell()
+                fobj.seek(offset)
+                tags[tag], = struct.unpack("<Q", fobj.read(8))
+                fobj.seek(here)
+
+    if tags.get(COMPRESSION) != 1 or tags.get(TILE_WIDTH) is None:
+        raise ValueError("not an uncompressed tiled file: %s" % fname)
+
+    return {
+        "nrows": tags[IMAGE_LENGTH],
+        "ncols": tags[IMAGE_WIDTH],
+        "tile_size": tags[TILE_WIDTH],
+        "data_offset": tags[TILE_OFFSETS],
+    }
+
+
+def get_tile_grid(nrows, ncols, tile_size):
+    """
+    get the number of rows and columns of tiles covering the image
+    """
+    return -(-nrows // tile_size), -(-ncols // tile_size)
+
+
+def _pack_values(ftype, values):
+    if ftype == ASCII:
+        return values
+
+    if ftype == LONG8:
+        return np.asarray(values, dtype="<u8").tobytes()
+
+    fmt = "<%d%s" % (len(values), TYPE_FORMATS[ftype])
+    return struct.pack(fmt, *values)
+
+
+def _align(offset, alignment):
+    return -(-offset // alignment) * alignment
@@ -19,6 +19,24 @@ def get_flist_file(campaign):
     return os.path.join(dir, fname)
 
 
+def get_flist_index_file(campaign):
+    """
+    index made from the coadd file list for fast lookups
+    """
+    return get_flist_file(campaign).replace(".fits", ".idx")
+
+
+def get_tile_index_file(campaign):
+    """
+    holds the footprints of the coadd tiles
+    """
+    dir = get_list_dir()
+    fname = "coadd-tile-index-%(campaign)s.npy" % dict(
+        campaign=campaign.upper(),
+    )
+    return os.path.join(dir, fname)
+
+
 def get_base_dir(campaign):
     """
     base directory
@@ -30,6 +48,36 @@ def get_base_dir(campaign):
     return d
 
 
+def get_render_cache_dir():
+    """
+    directory for the cache of rendered images, shared by all campaigns
+    """
+    return os.path.expandvars("$DESDATA/jpg/render-cache")
+
+
+def get_source_cache_dir():
+    """
+    default location of the cache of coadd source files
+    """
+    return os.path.expandvars("$DESDATA/jpg/source-cache")
+
+
+def get_manifest_file(campaign):
+    """
+    database recording the rendered images
+    """
+    bdir = get_base_dir(campaign)
+    return os.path.join(bdir, "manifest.sqlite")
+
+
+def get_queue_dir(campaign):
+    """
+    directory holding the queue of tiles for workers
+    """
+    bdir = get_base_dir(campaign)
+    return os.path.join(bdir, "queue")
+
+
 def get_output_dir(campaign, tilename):
     """
     location for the image and temp files
@@ -47,7 +95,9 @@ def get_temp_dir(campaign, tilename):
     return os.path.join(d, "sources")
 
 
-def get_output_file(campaign, tilename, bands, rebin=None, ext=".jpg"):
+def get_output_file(
+    campaign, tilename, bands, rebin=None, ext=".jpg", preview=None,
+):
     """
     location of a output file
     """
@@ -63,12 +113,28 @@ def get_output_file(campaign, tilename, bands, rebin=None, ext=".jpg"):
     if rebin is not None:
         parts += ["rebin%02d" % rebin]
 
+    if preview is not None:
+        parts += ["preview%02d" % preview]
+
     front = "-".join(parts)
     fname = "%s.%s" % (front, ext)
 
     return os.path.join(odir, fname)
 
 
+def get_cutout_file(campaign, tilename, bands, ra, dec, size, ext="jpg"):
+    """
+    location of a cutout around a sky position
+    """
+
+    bstr = "".join(bands)
+    odir = get_output_dir(campaign, tilename)
+
+    fname = "%s-%s-%.5f%+.5f-%d.%s" % (tilename, bstr, ra, dec, size, ext)
+
+    return os.path.join(odir, fname)
+
+
 def get_log_file(campaign, tilename, bands, rebin=None):
     """
     file holding log of processing
@@ -82,6 +148,20 @@ def get_log_file(campaign, tilename, bands, rebin=None):
     )
 
 
+def get_stage_log_file(campaign, tilename, bands, rebin=None):
+    """
+    file holding json lines with the time and memory used in each stage of
+    processing, next to the log file
+    """
+    return get_output_file(
+        campaign,
+        tilename,
+        bands,
+        rebin=rebin,
+        ext="stages.jsonl",
+    )
+
+
 #
 # batch processing
 #
@@ -136,3 +216,28 @@ def get_lsf_file(campaign, tilename, bands, missing=False):
     fname = "-".join(parts)
     fname = "%s.lsf" % fname
     return os.path.join(dir, fname)
+
+
+def get_slurm_file(campaign, bands):
+    """
+    location for the slurm job array script
+    """
+    bstr = "".join(bands)
+
+    dir = get_script_dir(campaign)
+    fname = "%s-%s.slurm" % (campaign, bstr)
+    return os.path.join(dir, fname)
+
+
+def get_slurm_tiles_file(campaign, bands):
+    """
+    location for the list of tiles for each slurm array task
+    """
+    return get_slurm_file(campaign, bands).replace(".slurm", "-tiles.txt")
+
+
+def get_slurm_log_dir(campaign):
+    """
+    location for the logs of the slurm array tasks
+    """
+    return os.path.join(get_script_dir(campaign), "slurm-logs")
@@ -0,0 +1,251 @@
+"""
+fast lookups in the coadd file list
+
+The FITS file list is compiled into a sidecar index holding the sorted keys,
+with offsets into blobs of key and path strings.  The index is memory mapped
+and searched by bisection, so nothing is loaded up front and a lookup costs
+microseconds.
+
+The index records the modification time and size of the FITS list it was
+made from, and is rebuilt when they change.  In long running processes the
+FITS list is checked every check_interval seconds.
+
+file layout, little endian
+--------------------------
+    magic        8 bytes
+    nkeys        uint64
+    mtime_ns     int64, of the FITS list
+    size         int64, of the FITS list
+    key_offsets  uint64[nkeys+1]
+    path_offsets uint64[nkeys+1]
+    key blob
+    path blob
+"""
+from __future__ import print_function
+
+import os
+import mmap
+import time
+import logging
+import struct
+import numpy as np
+import fitsio
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"DESFLIDX"
+HEADER_FORMAT = "<8sQqq"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+DEFAULT_CHECK_INTERVAL = 5.0
+
+
+class FlistIndex(object):
+    """
+    read-only mapping from coadd keys, e.g. DES0428-4748-g, to paths
+
+    parameters
+    ----------
+    flist_file: string
+        The FITS file list
+    index_file: string
+        The sidecar index.  It is made if missing or out of date
+    check_interval: float, optional
+        Seconds between checks of the FITS list for changes
+    """
+
+    def __init__(
+        self, flist_file, index_file, check_interval=DEFAULT_CHECK_INTERVAL,
+    ):
+        self.flist_file = flist_file
+        self.index_file = index_file
+        self.check_interval = check_interval
+
+        self._state = None
+        self._load()
+
+    def __len__(self):
+        return self._get_state()["nkeys"]
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def __getitem__(self, key):
+        path = self._find(key)
+        if path is None:
+            raise KeyError(key)
+        return path
+
+    def __iter__(self):
+        state = self._get_state()
+        for i in range(state["nkeys"]):
+            yield _get_string(state, "key", i).decode("utf-8")
+
+    def get(self, key, default=None):
+        path = self._find(key)
+        if path is None:
+            return default
+        return path
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def _find(self, key):
+        state = self._get_state()
+        target = key.encode("utf-8")
+
+        lo, hi = 0, state["nkeys"]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if _get_string(state, "key", mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < state["nkeys"] and _get_string(state, "key", lo) == target:
+            return _get_string(state, "path", lo).decode("utf-8")
+
+        return None
+
+    def _get_state(self):
+        state = self._state
+        if time.time() - state["checked"] > self.check_interval:
+            state["checked"] = time.time()
+            if _get_source_id(self.flist_file) != state["source_id"]:
+                logger.info("file list changed, reloading")
+                self._load()
+                state = self._state
+
+        return state
+
+    def _load(self):
+        source_id = _get_source_id(self.flist_file)
+
+        state = None
+        if os.path.exists(self.index_file):
+            state = _map_index(self.index_file)
+            if state["source_id"] != source_id:
+                state = None
+
+        if state is None:
+            data = make_index_data(self.flist_file)
+            try:
+                write_index(self.index_file, data)
+                state = _map_index(self.index_file)
+            except (IOError, OSError) as err:
+                # fall back to an index in memory
+                logger.warning("could not write %s: %s", self.index_file, err)
+                state = _get_state(data)
+
+        state["checked"] = time.time()
+        self._state = state
+
+
+def make_index_data(flist_file):
+    """
+    make the index data from the FITS file list
+
+    returns
+    -------
+    data: bytes
+    """
+    source_id = _get_source_id(flist_file)
+
+    logger.info("reading: %s", flist_file)
+    data = fitsio.read(flist_file, lower=True)
+
+    keys = _to_bytes(np.char.strip(data["key"]))
+    paths = _to_bytes(np.char.strip(data["path"]))
+
+    # sort by key, keeping the last of any duplicates as a dict would
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    paths = paths[order]
+    if keys.size > 0:
+        keep = np.ones(keys.size, dtype="bool")
+        keep[:-1] = keys[:-1] != keys[1:]
+        keys = keys[keep]
+        paths = paths[keep]
+
+    nkeys = keys.size
+
+    key_offsets = np.zeros(nkeys + 1, dtype="<u8")
+    key_offsets[1:] = np.cumsum(np.char.str_len(keys))
+    path_offsets = np.zeros(nkeys + 1, dtype="<u8")
+    path_offsets[1:] = np.cumsum(np.char.str_len(paths))
+
+    mtime_ns, size = source_id
+    header = struct.pack(HEADER_FORMAT, MAGIC, nkeys, mtime_ns, size)
+
+    return b"".join([
+        header,
+        key_offsets.tobytes(),
+        path_offsets.tobytes(),
+        b"".join(keys.tolist()),
+        b"".join(paths.tolist()),
+    ])
+
+
+def write_index(index_file, data):
+    """
+    write the index data, via a temporary file so readers never see a
+    partial index
+    """
+    logger.info("writing: %s", index_file)
+    tmp_file = "%s.%d.tmp" % (index_file, os.getpid())
+    with open(tmp_file, "wb") as fobj:
+        fobj.write(data)
+    os.rename(tmp_file, index_file)
+
+
+def _map_index(index_file):
+    with open(index_file, "rb") as fobj:
+        buff = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+    return _get_state(buff)
+
+
+def _get_state(buff):
+    magic, nkeys, mtime_ns, size = struct.unpack_from(HEADER_FORMAT, buff)
+    if magic != MAGIC:
+        raise ValueError("not a file list index")
+
+    noff = nkeys + 1
+    key_offsets = np.frombuffer(
+        buff, dtype="<u8", count=noff, offset=HEADER_SIZE,
+    )
+    path_offsets = np.frombuffer(
+        buff, dtype="<u8", count=noff, offset=HEADER_SIZE + 8 * noff,
+    )
+
+    key_start = HEADER_SIZE + 16 * noff
+    path_start = key_start + int(key_offsets[-1])
+
+    return {
+        "buff": buff,
+        "nkeys": nkeys,
+        "source_id": (mtime_ns, size),
+        "key_offsets": key_offsets,
+        "path_offsets": path_offsets,
+        "key_start": key_start,
+        "path_start": path_start,
+    }
+
+
+def _get_string(state, name, i):
+    offsets = state[name + "_offsets"]
+    start = state[name + "_start"]
+    return state["buff"][start + int(offsets[i]):start + int(offsets[i + 1])]
+
+
+def _to_bytes(strings):
+    if strings.dtype.kind == "U":
+        strings = np.char.encode(strings, "utf-8")
+    return strings
+
+
+def _get_source_id(flist_file):
+    st = os.stat(flist_file)
+    return (st.st_mtime_ns, st.st_size)
@@ -0,0 +1,186 @@
+"""
+memory bounded cache of decoded images, for long running processes that make
+many images from the same files
+"""
+from __future__ import print_function
+
+import threading
+import logging
+from collections import OrderedDict
+import numpy as np
+import fitsio
+
+from . import images
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_BYTES = 4 * 1024**3
+
+
+class ImageCache(object):
+    """
+    least recently used cache of images read from FITS files, keyed by file
+    name and HDU.  The mask is cached along with the image, if present.
+
+    The total size of the cached arrays is kept below max_bytes.  The cache
+    can be used from multiple threads; a given image is only read once even
+    if requested by several threads at the same time.
+
+    The images can be stored as float16 to fit twice as many in the cache.
+    This keeps about three significant digits, which is below the noise of
+    coadd images, and values beyond the float16 range are clipped to it.
+    The cutouts are always returned as float32
+
+    parameters
+    ----------
+    max_bytes: int, optional
+        maximum total size of the cached arrays
+    dtype: string, optional
+        type for storing the images, f4 or f2, default f4
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES, dtype="f4"):
+        dtype = np.dtype(dtype)
+        if dtype.kind != "f" or dtype.itemsize > 4:
+            raise ValueError("cache dtype should be f4 or f2, got %s" % dtype)
+
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+        self.nbytes = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, filename, image_ext=1):
+        """
+        get the image, mask and header, reading them if needed.  NaNs in the
+        image are set to zero.
+
+        The returned arrays are shared and must not be modified.  The image
+        is of the storage type of the cache
+
+        returns
+        -------
+        image, mask, header
+            mask is None if there is no mask
+        """
+        key = (filename, image_ext)
+
+        entry = self._lookup(key)
+        if entry is not None:
+            return entry
+
+        with self._get_key_lock(key):
+            # another thread may have read it while we waited
+            entry = self._lookup(key)
+            if entry is None:
+                entry = _read_image(filename, image_ext, self.dtype)
+                self._insert(key, entry)
+
+        with self._lock:
+            self._key_locks.pop(key, None)
+
+        return entry
+
+    def get_cutout(self, filename, image_ext=1, ranges=None):
+        """
+        get copies of the image, as float32, and mask, optionally for a
+        subset of the image.  The header is also returned
+
+        parameters
+        ----------
+        filename: string
+            the FITS file name
+        image_ext: int or string
+            the image HDU
+        ranges: tuple of slices, optional
+            the row and column slices
+
+        returns
+        -------
+        image, mask, header
+            mask is None if there is no mask
+        """
+        image, mask, header = self.get(filename, image_ext=image_ext)
+
+        if ranges is not None:
+            rowslice, colslice = ranges
+            image = image[rowslice, colslice]
+            if mask is not None:
+                mask = mask[rowslice, colslice]
+
+        image = image.astype("f4")
+        if mask is not None:
+            mask = mask.copy()
+
+        return image, mask, header
+
+    def clear(self):
+        """
+        remove all entries
+        """
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _get_key_lock(self, key):
+        with self._lock:
+            if key not in self._key_locks:
+                self._key_locks[key] = threading.Lock()
+            return self._key_locks[key]
+
+    def _insert(self, key, entry):
+        nbytes = _get_nbytes(entry)
+        if nbytes > self.max_bytes:
+            # too big to cache at all
+            return
+
+        with self._lock:
+            while self.nbytes + nbytes > self.max_bytes:
+                _, old_entry = self._entries.popitem(last=False)
+                self.nbytes -= _get_nbytes(old_entry)
+
+            self._entries[key] = entry
+            self.nbytes += nbytes
+
+
+def _read_image(filename, image_ext, dtype):
+    logger.info("reading: %s", filename)
+    with fitsio.FITS(filename) as fits:
+        image = fits[image_ext].read()
+        header = fits[image_ext].read_header()
+
+        mask = None
+        if "msk" in fits:
+            mask = fits["msk"].read()
+
+    images.zero_nans(image)
+
+    if image.dtype != dtype:
+        maxval = np.finfo(dtype).max
+        np.clip(image, -maxval, maxval, out=image)
+        image = image.astype(dtype)
+
+    return image, mask, header
+
+
+def _get_nbytes(entry):
+    image, mask, _ = entry
+    nbytes = image.nbytes
+    if mask is not None:
+        nbytes += mask.nbytes
+    return nbytes
@@ -1,24 +1,107 @@
 from __future__ import print_function
 
 import os
-import subprocess
+import time
 import shutil
-import numpy as np
-from numpy import array, zeros, flipud, where, sqrt, isnan
+import logging
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from numpy import array, zeros, flipud, where, sqrt
 import fitsio
 
 from . import files
 from . import images
-
+from . import pyramid
+from . import tileindex
+from . import manifest as manifest_mod
+from . import transfer as transfer_mod
+from . import rendercache
+from . import flistindex
+from . import instrument
+from . import stretch as stretch_mod
+from . import skystats
+from . import stripwriter
+
+logger = logging.getLogger(__name__)
 NOMINAL_EXPTIME = 900.0
 
 NONLINEAR = 0.12
+
+# for autoscale, the sky noise in the scaled images, which sets how visible
+# the noise is
+AUTO_NOISE = 0.03
+
+# for previews, the rows read from each block of rows.  When all are read,
+# they are read in strips of PREVIEW_STRIP_ROWS rounded to a multiple of the
+# preview factor
+DEFAULT_PREVIEW_ROWS = 1
+PREVIEW_STRIP_ROWS = 1024
 DEFAULT_CAMPAIGN = "y6a1_coadd"
 
+# held while reading with fitsio when cfitsio is not reentrant
+_FITSIO_LOCK = threading.Lock()
+
+# the scales for each campaign: the overall scale, the relative scales of
+# the i, r, g images and the exposure time they are for.  Smaller scale
+# means darker, so noise is more suppressed compared to the peak.  These
+# are part of the manifest parameters, so changing them marks the images
+# of the campaign stale
+CAMPAIGN_SCALES = {
+    # used for the big galaxy images
+    # scale=0.004
+    # scale=0.015
+    # relative_scales= [1.00, 1.2, 2.0]
+    # relative_scales= [1.0, 1.0, 1.6]
+    "ONEOFF": dict(
+        scale=0.01,
+        relative_scales=[1.0, 1.0, 1.5],
+        nominal_exptime=90.0,
+    ),
+    # scale=.015*sqrt(2.0)
+    "MACS": dict(
+        scale=0.015,
+        relative_scales=[1.0, 1.0, 1.5],
+        nominal_exptime=9000.0,
+    ),
+    # scale=.015*sqrt(2.0)
+    # relative_scales= [1.00, 1.2, 2.0]
+    "Y5A1_COADD": dict(
+        scale=0.03,
+        relative_scales=[1.0, 1.0, 1.5],
+        nominal_exptime=NOMINAL_EXPTIME,
+    ),
+    "Y6A1_COADD": dict(
+        scale=0.03,
+        relative_scales=[1.0, 1.0, 1.5],
+        nominal_exptime=NOMINAL_EXPTIME,
+    ),
+    # scale=.010*sqrt(2.0)
+    "Y3A1_COADD": dict(
+        scale=0.015 * float(sqrt(2.0)),
+        relative_scales=[1.00, 1.2, 2.0],
+        nominal_exptime=NOMINAL_EXPTIME,
+    ),
+    "Y1A1": dict(
+        scale=0.010 * float(sqrt(2.0)),
+        relative_scales=[1.00, 1.2, 2.0],
+        nominal_exptime=NOMINAL_EXPTIME,
+    ),
+    # SVA seems to require a very different scaling
+    "SVA1": dict(
+        scale=0.050 * 0.88,
+        relative_scales=[1.00, 1.2, 2.5],
+        nominal_exptime=NOMINAL_EXPTIME,
+    ),
+}
+
 
 def make_image_auto(
     tilename, campaign=None, rebin=None, clean=True, ranges=None, bands=None,
-    type="jpg"
+    type="jpg", strip_rows=None, nthreads=None, manifest=False,
+    transfer=None, stretch=None, autoscale=False, preview=None,
+    preview_rows=DEFAULT_PREVIEW_ROWS, render_cache=None, load_threads=None,
+    quality=None, compress_level=None, write_threads=None, source_cache=None,
 ):
     """
     make a color jpeg for the specified run
@@ -31,34 +114,442 @@ def make_image_auto(
         DES coadd run
     rebin: int, optional
         Amount to rebin image
+    strip_rows: int, optional
+        If sent, process the image in strips of this many rows to limit
+        memory usage
+    nthreads: int, optional
+        Number of threads for the image processing kernels, default 1
+    load_threads: int, optional
+        Number of threads for loading the band files.  Set to 1 to load them
+        one at a time.  See RGBImageMaker
+    write_threads: int, optional
+        Number of threads for writing the image types at the same time,
+        default one per type up to the number of cpus
+    manifest: bool, optional
+        If True, record the images in the campaign manifest
+    transfer: transfer object, optional
+        used to get the coadd files, default is a transfer.RsyncTransfer
+    source_cache: sourcecache.SourceCache, optional
+        If sent, the coadd files are kept in this cache, which can be shared
+        by workers, and with clean they are released to the cache rather
+        than removed
+    stretch: string, optional
+        The stretch, e.g. asinh or gamma:2.2, default asinh.  See the
+        stretch module
+    autoscale: bool, optional
+        If True, set the scales from the sky noise measured in each band,
+        and subtract the sky level, rather than using the campaign scales
+    preview: int, optional
+        If sent, make a quick preview at 1/preview of the resolution.  The
+        output file names get a preview tag and previews are not recorded
+        in the manifest
+    preview_rows: int, optional
+        Number of rows read from each block of preview rows, default 1.  Set
+        equal to preview to average all pixels
+    render_cache: rendercache.RenderCache, optional
+        If sent, images made before from the same inputs and parameters are
+        taken from the cache, without fetching the coadd files, and new
+        images are added to it
+    quality: int, optional
+        jpg quality, default 90
+    compress_level: int, optional
+        zlib compression level for png, default 6, and for tiff, default
+        uncompressed
+    """
+
+    if campaign is None:
+        campaign = DEFAULT_CAMPAIGN
+
+    ifiles = FilesAuto(
+        campaign, tilename, rebin=rebin, bands=bands, transfer=transfer,
+        preview=preview, source_cache=source_cache,
+    )
+
+    kw = dict(
+        rebin=rebin,
+        ranges=ranges,
+        strip_rows=strip_rows,
+        nthreads=nthreads,
+        manifest=manifest,
+        stretch=stretch,
+        autoscale=autoscale,
+        preview=preview,
+        preview_rows=preview_rows,
+        render_cache=render_cache,
+        load_threads=load_threads,
+        quality=quality,
+        compress_level=compress_level,
+        write_threads=write_threads,
+    )
+
+    types = _link_cached_images(ifiles, type, **kw)
+    if len(types) == 0:
+        return
+
+    ifiles.sync()
+
+    try:
+        _make_images(ifiles, types, **kw)
+    finally:
+        if clean:
+            ifiles.clean()
+
+
+def make_images_auto(
+    tilenames, campaign=None, rebin=None, clean=True, bands=None,
+    type="jpg", strip_rows=None, nthreads=None, manifest=False,
+    transfer=None, nprefetch=2, max_bytes=None, stretch=None,
+    autoscale=False, preview=None, preview_rows=DEFAULT_PREVIEW_ROWS,
+    render_cache=None, load_threads=None, quality=None, compress_level=None,
+    write_threads=None, source_cache=None,
+):
+    """
+    make color images for a set of tiles.  The coadd files for the upcoming
+    tiles are fetched in the background while the current tile is processed.
+
+    A failure for one tile does not stop processing of the others
+
+    parameters
+    ----------
+    tilenames: list
+        DES coadd tiles
+    nprefetch: int, optional
+        Number of tiles to fetch ahead of the current one, default 2
+    max_bytes: int, optional
+        Limit on the bytes of coadd files on disk at once
+
+    See make_image_auto for the other parameters
+
+    returns
+    -------
+    failed: list
+        The tiles for which making the images failed
+    """
+
+    if campaign is None:
+        campaign = DEFAULT_CAMPAIGN
+
+    kw = dict(
+        rebin=rebin,
+        strip_rows=strip_rows,
+        nthreads=nthreads,
+        manifest=manifest,
+        stretch=stretch,
+        autoscale=autoscale,
+        preview=preview,
+        preview_rows=preview_rows,
+        render_cache=render_cache,
+        load_threads=load_threads,
+        quality=quality,
+        compress_level=compress_level,
+        write_threads=write_threads,
+    )
+
+    failed = []
+    ifiles_list = []
+    types_list = []
+    for tilename in tilenames:
+        try:
+            ifiles = FilesAuto(
+                campaign, tilename, rebin=rebin, bands=bands,
+                transfer=transfer, preview=preview, source_cache=source_cache,
+            )
+        except KeyError as err:
+            logger.error(
+                "failed %s: missing from file list: %s", tilename, err,
+            )
+            failed.append(tilename)
+            continue
+
+        # tiles with all images in the render cache are not fetched
+        types = _link_cached_images(ifiles, type, **kw)
+        if len(types) > 0:
+            ifiles_list.append(ifiles)
+            types_list.append(types)
+
+    with transfer_mod.Prefetcher(
+        ifiles_list,
+        nprefetch=nprefetch,
+        max_bytes=max_bytes,
+        clean=clean,
+    ) as prefetcher:
+        for i, ifiles in enumerate(ifiles_list):
+            try:
+                prefetcher.wait(i)
+                _make_images(ifiles, types_list[i], **kw)
+            except Exception as err:
+                logger.error("failed %s: %r", ifiles["tilename"], err)
+                failed.append(ifiles["tilename"])
+            finally:
+                prefetcher.release(i)
+
+    return failed
+
+
+def _make_images(
+    ifiles, type, rebin=None, ranges=None, strip_rows=None, nthreads=None,
+    manifest=False, stretch=None, autoscale=False, preview=None,
+    preview_rows=DEFAULT_PREVIEW_ROWS, render_cache=None, load_threads=None,
+    quality=None, compress_level=None, write_threads=None,
+):
+    """
+    make and write the images for files that are already present.  In strip
+    mode the images are written as the strips are made, if possible
+    """
+
+    types = _get_types(type)
+
+    instrument.set_context(
+        campaign=ifiles["campaign"], tilename=ifiles["tilename"],
+    )
+
+    tm0 = time.time()
+    image_maker = RGBImageMaker(
+        ifiles,
+        rebin=rebin,
+        ranges=ranges,
+        strip_rows=strip_rows,
+        nthreads=nthreads,
+        stretch=stretch,
+        autoscale=autoscale,
+        preview=preview,
+        preview_rows=preview_rows,
+        load_threads=load_threads,
+        write_threads=write_threads,
+    )
+
+    # the sources may not be under the output directory, so it may not exist
+    for type in types:
+        make_dir(ifiles.get_output_file(type))
+
+    # the time to make and write each image
+    elapsed = {}
+    if image_maker.can_stream(types):
+        image_maker.make_and_write(
+            [ifiles.get_output_file(type) for type in types],
+            quality=quality,
+            compress_level=compress_level,
+        )
+        for type in types:
+            elapsed[type] = time.time() - tm0
+    else:
+        image_maker.make_image()
+        make_time = time.time() - tm0
+
+        seconds = image_maker.write_images(
+            types, quality=quality, compress_level=compress_level,
+        )
+        for type in types:
+            elapsed[type] = make_time + seconds[type]
+
+    keys = {}
+    if render_cache is not None:
+        keys = _get_render_keys(
+            ifiles, types, rebin=rebin, ranges=ranges, stretch=stretch,
+            autoscale=autoscale, preview=preview, preview_rows=preview_rows,
+            quality=quality, compress_level=compress_level,
+        )
+
+    for type in types:
+        if type in keys:
+            render_cache.put(keys[type], ifiles.get_output_file(type))
+
+        if manifest and ranges is None and preview is None:
+            _record_image(
+                ifiles, type, elapsed[type], stretch=stretch,
+                autoscale=autoscale, quality=quality,
+                compress_level=compress_level,
+            )
+
+
+def _link_cached_images(
+    ifiles, type, render_cache=None, rebin=None, ranges=None,
+    manifest=False, stretch=None, autoscale=False, preview=None,
+    preview_rows=DEFAULT_PREVIEW_ROWS, quality=None, compress_level=None,
+    **kw
+):
     """
+    link the images that are in the render cache to the output files,
+    recording them in the manifest if requested, and return the image types
+    that still need to be made.  Extra keywords are ignored
+    """
+    types = _get_types(type)
+    if render_cache is None:
+        return types
+
+    keys = _get_render_keys(
+        ifiles, types, rebin=rebin, ranges=ranges, stretch=stretch,
+        autoscale=autoscale, preview=preview, preview_rows=preview_rows,
+        quality=quality, compress_level=compress_level,
+    )
+
+    remaining = []
+    for type in types:
+        fname = ifiles.get_output_file(type)
+        if type not in keys:
+            remaining.append(type)
+            continue
+
+        make_dir(fname)
+        if not render_cache.get(keys[type], fname):
+            remaining.append(type)
+        elif manifest and ranges is None and preview is None:
+            _record_image(
+                ifiles, type, 0.0, stretch=stretch, autoscale=autoscale,
+                quality=quality, compress_level=compress_level,
+            )
+
+    return remaining
+
 
-    if isinstance(type, list):
-        types = type
+def _get_render_keys(
+    ifiles, types, image_ext=1, ranges=None, boost=None, rebin=None,
+    scales=None, absscale=None, stretch=None, autoscale=False, preview=None,
+    preview_rows=DEFAULT_PREVIEW_ROWS, quality=None, compress_level=None,
+):
+    """
+    get the render cache keys for the image types, keyed by type.  Tile
+    pyramids are not cached.  The encoder settings are only part of the key
+    for the types they apply to, and only when not the default
+    """
+    if isinstance(ifiles, FilesAuto):
+        # the archive paths include the processing tag, so a path always
+        # refers to the same data
+        inputs = {
+            "bands": ifiles.get_bands(),
+            "paths": ifiles.get_input_paths(),
+        }
     else:
-        types = [type]
+        inputs = dict(
+            (name, rendercache.get_file_identity(ifiles[name]))
+            for name in ["gfile", "rfile", "ifile", "ufile", "zfile"]
+            if ifiles[name] is not None
+        )
+
+    # explicit scales replace those of the campaign
+    params = manifest_mod.get_params(
+        rebin=rebin, stretch=stretch, autoscale=autoscale,
+        campaign=ifiles["campaign"] if scales is None else None,
+    )
+    params["campaign"] = ifiles["campaign"]
+    params["image_ext"] = image_ext
+    params["boost"] = boost
+    params["absscale"] = absscale
+    if ranges is not None:
+        params["ranges"] = [[s.start, s.stop, s.step] for s in ranges]
+    if scales is not None:
+        params["scales"] = [float(s) for s in scales]
+    if preview is not None:
+        params["preview"] = preview
+        params["preview_rows"] = preview_rows
+
+    keys = {}
+    for type in types:
+        if type == "dzi":
+            continue
+
+        type_params = dict(params, image_type=type)
+        type_params.update(manifest_mod.get_encoder_params(
+            type, quality=quality, compress_level=compress_level,
+        ))
+
+        keys[type] = rendercache.get_render_key(inputs, type_params)
+
+    return keys
+
+
+def get_campaign_scales(campaign):
+    """
+    get the scales for the campaign from CAMPAIGN_SCALES, or None if the
+    campaign has none and autoscale is used
+    """
+    return CAMPAIGN_SCALES.get(campaign.upper())
+
+
+def _get_types(type):
+    """
+    get a list of image types from a type or list of types
+    """
+    if isinstance(type, (list, tuple)):
+        return list(type)
+    return [type]
+
+
+def make_cutout(
+    ra, dec, size, campaign=None, bands=None, type="jpg", fname=None,
+    clean=True, nthreads=None, stretch=None, autoscale=False,
+):
+    """
+    make a color cutout centered on a sky position.  The tile containing the
+    position is found using the tile index for the campaign
+
+    parameters
+    ----------
+    ra, dec: float
+        position in degrees
+    size: int
+        size of the cutout in pixels.  The cutout is smaller if it runs off
+        the edge of the tile
+    campaign: string, optional
+        campaign, e.g. y3a1_coadd
+    bands: list, optional
+        bands to use, default g,r,i
+    type: string, optional
+        image type, default jpg
+    fname: string, optional
+        output file name.  Default is from files.get_cutout_file
+    clean: bool, optional
+        if True, remove the downloaded fits files when done
+    nthreads: int, optional
+        Number of threads for the image processing kernels, default 1
+    stretch: string, optional
+        The stretch, e.g. asinh or gamma:2.2, default asinh
+    autoscale: bool, optional
+        If True, set the scales from the sky noise of the tile
+
+    returns
+    -------
+    fname: string
+        the output file name
+    """
 
     if campaign is None:
         campaign = DEFAULT_CAMPAIGN
 
-    ifiles = FilesAuto(campaign, tilename, rebin=rebin, bands=bands)
+    if bands is None:
+        bands = ["g", "r", "i"]
+
+    index = tileindex.get_tile_index(campaign)
+    tilename, ranges = index.get_cutout(ra, dec, size)
+
+    if fname is None:
+        fname = files.get_cutout_file(
+            campaign, tilename, bands, ra, dec, size, ext=type,
+        )
+
+    ifiles = FilesAuto(campaign, tilename, bands=bands)
+    instrument.set_context(campaign=ifiles["campaign"], tilename=tilename)
     ifiles.sync()
 
     try:
         image_maker = RGBImageMaker(
             ifiles,
-            rebin=rebin,
             ranges=ranges,
+            nthreads=nthreads,
+            stretch=stretch,
+            autoscale=autoscale,
         )
 
         image_maker.make_image()
 
-        for type in types:
-            image_maker.write_image(image_type=type)
+        make_dir(fname)
+        image_maker.write_image(fname=fname)
     finally:
         if clean:
             ifiles.clean()
 
+    return fname
+
 
 def make_image_fromfiles(
     fname,
@@ -74,6 +565,16 @@ def make_image_fromfiles(
     scales=None,
     absscale=None,
     image_ext=1,
+    strip_rows=None,
+    nthreads=None,
+    stretch=None,
+    autoscale=False,
+    preview=None,
+    preview_rows=DEFAULT_PREVIEW_ROWS,
+    render_cache=None,
+    load_threads=None,
+    quality=None,
+    compress_level=None,
 ):
     """
     make a color jpeg for the specified run
@@ -92,6 +593,31 @@ def make_image_fromfiles(
         campaign, e.g. y3a1_coadd
     tilename: string, optional
         DES coadd run
+    strip_rows: int, optional
+        If sent, process the image in strips of this many rows to limit
+        memory usage
+    nthreads: int, optional
+        Number of threads for the image processing kernels, default 1
+    load_threads: int, optional
+        Number of threads for loading the band files.  Set to 1 to load them
+        one at a time.  See RGBImageMaker
+    stretch: string, optional
+        The stretch, e.g. asinh or gamma:2.2, default asinh
+    autoscale: bool, optional
+        If True, set the scales from the sky noise measured in each band
+    preview: int, optional
+        If sent, make a quick preview at 1/preview of the resolution
+    preview_rows: int, optional
+        Number of rows read from each block of preview rows, default 1
+    render_cache: rendercache.RenderCache, optional
+        If sent, an image made before from the same files and parameters is
+        taken from the cache, and a new image is added to it.  The files are
+        identified by their path, size and modification time
+    quality: int, optional
+        jpg quality, default 90
+    compress_level: int, optional
+        zlib compression level for png, default 6, and for tiff, default
+        uncompressed
     """
 
     if campaign is None:
@@ -114,16 +640,92 @@ def make_image_fromfiles(
         boost=boost,
         scales=scales,
         absscale=absscale,
+        strip_rows=strip_rows,
+        nthreads=nthreads,
+        stretch=stretch,
+        autoscale=autoscale,
+        preview=preview,
+        preview_rows=preview_rows,
+        load_threads=load_threads,
     )
 
-    image_maker.make_image()
+    key = None
+    if render_cache is not None:
+        image_type = fname.split(".")[-1]
+        keys = _get_render_keys(
+            ifiles, [image_type], image_ext=image_ext, ranges=ranges,
+            boost=boost, scales=scales, absscale=absscale, stretch=stretch,
+            autoscale=autoscale, preview=preview, preview_rows=preview_rows,
+            quality=quality, compress_level=compress_level,
+        )
+        key = keys.get(image_type)
+        if key is not None and render_cache.get(key, fname):
+            return
+
+    if image_maker.can_stream([fname.split(".")[-1]]):
+        image_maker.make_and_write(
+            [fname], quality=quality, compress_level=compress_level,
+        )
+    else:
+        image_maker.make_image()
+        image_maker.write_image(
+            fname=fname, quality=quality, compress_level=compress_level,
+        )
+
+    if key is not None:
+        render_cache.put(key, fname)
+
 
-    image_maker.write_image(fname=fname)
+def _record_image(
+    ifiles, image_type, elapsed, stretch=None, autoscale=False, quality=None,
+    compress_level=None,
+):
+    """
+    record an image in the campaign manifest
+    """
+    rebin = ifiles.get_rebin()
+    with manifest_mod.RenderManifest(ifiles["campaign"]) as man:
+        man.record(
+            ifiles["tilename"],
+            ifiles.get_bands(),
+            image_type,
+            ifiles.get_output_file(image_type),
+            ifiles.get_input_paths(),
+            local_files=ifiles.get_local_files(),
+            rebin=rebin,
+            params=manifest_mod.get_params(
+                rebin=rebin, stretch=stretch, autoscale=autoscale,
+                campaign=ifiles["campaign"], image_type=image_type,
+                quality=quality, compress_level=compress_level,
+            ),
+            elapsed=elapsed,
+        )
 
 
 class RGBImageMaker(object):
     """
     class to actually make the color image and write it
+
+    The band files are loaded concurrently by up to load_threads threads.
+    All bands are then in memory at once, so for five bands the peak memory
+    is one image more than when loading one at a time, which is done with
+    load_threads=1.  By default one thread is used per file, up to the
+    number of cpus.  fitsio releases the GIL while reading, but if cfitsio
+    is not reentrant the reads are serialized with a lock, and only the
+    work after each read, such as zeroing the NaNs, is done concurrently
+
+    The output types are encoded at the same time by up to write_threads
+    threads, one per type, all reading the same color image.  The encoders
+    release the GIL while compressing, so with enough cores the time to
+    write several types is close to that of the slowest.  In strip mode each
+    strip is encoded while the next one is made.  By default one thread is
+    used per type, up to the number of cpus
+
+    With preview=N a quick image at 1/N of the resolution is made.  Only
+    preview_rows of each N rows are read, and blocks of them are averaged as
+    they arrive, so the full resolution images are never held in memory.
+    The rest of the processing is done at the lower resolution.  For tile
+    compressed images the time is mostly in decompressing the rows read
     """
 
     def __init__(
@@ -135,10 +737,26 @@ class RGBImageMaker(object):
         ranges=None,
         boost=None,
         rebin=None,
+        strip_rows=None,
+        nthreads=None,
+        image_cache=None,
+        stretch=None,
+        autoscale=False,
+        preview=None,
+        preview_rows=DEFAULT_PREVIEW_ROWS,
+        load_threads=None,
+        write_threads=None,
     ):
 
         self.ifiles = ifiles
+        self.image_cache = image_cache
         self.rebin = rebin
+        self.strip_rows = strip_rows
+        self.preview = preview
+        self.preview_rows = preview_rows
+        self.nthreads = nthreads
+        self.load_threads = load_threads
+        self.write_threads = write_threads
         self.boost = boost
         self.image_ext = image_ext
         self.ranges = ranges
@@ -146,72 +764,120 @@ class RGBImageMaker(object):
         self.scales = scales
         self.absscale = absscale
 
+        self.stretch = stretch
+        self.stretch_table = stretch_mod.get_table(stretch, NONLINEAR)
+
+        # set when the scales come from the measured sky
+        self.autoscale = autoscale
+        self.sky_levels = None
+
         # self.satval=1.0e9
         self.satval = None
         # self.satval=50
 
+        self._set_kernels()
+
+    def _set_kernels(self):
+        """
+        use the parallel kernels if more than one thread was requested.  The
+        parallel kernels give identical results
+        """
+        if self.nthreads is not None and self.nthreads > 1:
+            self._get_color_image = images.get_color_image_parallel
+            self._get_color_image_bytes = (
+                images.get_color_image_bytes_parallel
+            )
+            self._interpolate_bad = images.interpolate_bad_parallel
+            self._interpolate_bad_strip = (
+                images.interpolate_bad_strip_parallel
+            )
+            self._propagate_missing_data = (
+                images.propagate_missing_data_parallel
+            )
+            self._block_average = images.block_average_parallel
+        else:
+            self._get_color_image = images.get_color_image
+            self._get_color_image_bytes = images.get_color_image_bytes
+            self._interpolate_bad = images.interpolate_bad
+            self._interpolate_bad_strip = images.interpolate_bad_strip
+            self._propagate_missing_data = images.propagate_missing_data
+            self._block_average = images.block_average
+
     def _make_imlist(self):
-        imlist = []
         ifiles = self.ifiles
-        for fname in [ifiles["gfile"], ifiles["rfile"], ifiles["ifile"]]:
-            print(fname)
-            im = ImageTrans(
-                fname,
-                image_ext=self.image_ext,
-                ranges=self.ranges,
-                boost=self.boost,
+        names = [
+            name for name in ["gfile", "rfile", "ifile", "ufile", "zfile"]
+            if ifiles[name] is not None
+        ]
+
+        load_threads = self._get_load_threads(len(names))
+        if load_threads > 1:
+            logger.info(
+                "loading %d files with %d threads", len(names), load_threads,
             )
-            imlist.append(im)
-
-        if ifiles["ufile"] is not None:
-            print("adding:", ifiles["ufile"])
-            uim = ImageTrans(
-                ifiles["ufile"],
-                image_ext=self.image_ext,
-                ranges=self.ranges,
-                boost=self.boost,
+            pool = ThreadPoolExecutor(max_workers=load_threads)
+            futures = dict(
+                (name, pool.submit(self._load_image, ifiles[name]))
+                for name in names
             )
-            imlist[0].add_image(uim)
 
-        if ifiles["zfile"] is not None:
-            print("adding:", ifiles["zfile"])
-            zim = ImageTrans(
-                ifiles["zfile"],
-                image_ext=self.image_ext,
-                ranges=self.ranges,
-                boost=self.boost,
-            )
-            imlist[2].add_image(zim)
+            def get_image(name):
+                return futures.pop(name).result()
+        else:
+            pool = None
+
+            def get_image(name):
+                return self._load_image(ifiles[name])
+
+        try:
+            imlist = [get_image(name) for name in ["gfile", "rfile", "ifile"]]
+
+            if ifiles["ufile"] is not None:
+                logger.info("adding: %s", ifiles["ufile"])
+                imlist[0].add_image(get_image("ufile"))
+
+            if ifiles["zfile"] is not None:
+                logger.info("adding: %s", ifiles["zfile"])
+                imlist[2].add_image(get_image("zfile"))
+        finally:
+            if pool is not None:
+                pool.shutdown()
 
+        # the masks are combined into the first one, freeing the others
         mask = None
-        for i, im in enumerate(imlist):
+        with instrument.stage("mask"):
+            for im in imlist:
 
-            if im.mask is not None:
-                if i == 0:
-                    mask = im.mask.copy()
-                else:
-                    w = np.where(im.mask > 0)
-                    mask[w] = 1
+                if im.mask is not None:
+                    if mask is None:
+                        mask = im.mask
+                    else:
+                        images.combine_masks(mask, im.mask)
+                        im.mask = None
+
+            if mask is not None:
+                self._propagate_missing_data(
+                    imlist[0].image,
+                    imlist[1].image,
+                    imlist[2].image,
+                    mask,
+                )
 
         if mask is not None:
-            images.propagate_missing_data(
-                imlist[0].image,
-                imlist[1].image,
-                imlist[2].image,
-                mask,
-            )
-            for im in imlist:
-                images.interpolate_bad(im.image, mask)
+            with instrument.stage("interpolate"):
+                for im in imlist:
+                    self._interpolate_bad(im.image, mask)
 
-        for i, im in enumerate(imlist):
-            # im.scale_image()
-            im.flip_ud()
-            # im.zero_bad_weightmap()
-            # im.transpose()
-            if self.rebin is not None:
-                im.rebin(self.rebin)
+        # if not rebinning, the flip is done when making the color image
+        if self.rebin is not None:
+            with instrument.stage("rebin", rebin=self.rebin):
+                for i, im in enumerate(imlist):
+                    # im.scale_image()
+                    # im.zero_bad_weightmap()
+                    # im.transpose()
 
-            print()
+                    im.flip_ud()
+                    im.rebin(self.rebin)
 
         self.imlist = imlist
 
@@ -220,49 +886,438 @@ class RGBImageMaker(object):
         create the rgb image
         """
 
+        if self.nthreads is not None:
+            images.set_num_threads(self.nthreads)
+
+        if self.preview is not None:
+            self._make_image_preview()
+            return
+
+        if self.strip_rows is not None:
+            self._make_image_strips()
+            return
+
         self._make_imlist()
 
         scales = self._get_scales()
+        self.color_scales = scales
+        self._subtract_sky([im.image for im in self.imlist])
 
-        print("using satval:", self.satval)
-        print("getting color image")
+        logger.info("using satval: %s", self.satval)
+        logger.info("getting color image")
         imlist = self.imlist
 
-        if True:
-            nrows, ncols = imlist[0].image.shape
-            colorim = zeros((nrows, ncols, 3), dtype="f4")
-            images.get_color_image(
-                imlist[2].image,
-                imlist[1].image,
-                imlist[0].image,
-                NONLINEAR,
+        with instrument.stage("color"):
+            if True:
+                # stretch, bytescale and flip in a single pass
+                nrows, ncols = imlist[0].image.shape
+                colorim = zeros((nrows, ncols, 3), dtype="u1")
+                self._get_color_image_bytes(
+                    imlist[2].image,
+                    imlist[1].image,
+                    imlist[0].image,
+                    self.stretch_table,
+                    scales,
+                    colorim,
+                    self.rebin is None,
+                )
+            else:
+                colorim = images.get_color_image_old(
+                    imlist[2].image,
+                    imlist[1].image,
+                    imlist[0].image,
+                    scales=scales,
+                    nonlinear=NONLINEAR,
+                    satval=self.satval,
+                )
+
+                logger.info("bytescaling")
+                colorim = images.bytescale(colorim)
+
+        self.colorim = colorim
+
+    def _make_image_strips(self, writers=None):
+        """
+        create the rgb image, reading and processing strips of rows so that
+        only strip_rows rows of each band are in memory at once.  The byte
+        image is filled in strip by strip, or if writers are sent each strip
+        is written to them and the byte image is not kept
+        """
+
+        if self.boost is not None and self.rebin is not None:
+            raise ValueError("cannot currently boost and rebin in strip mode")
+
+        readers, extras = self._make_strip_readers()
+
+        try:
+            # the scales use the exposure times of the g, r, i images
+            self.imlist = readers
+            scales = self._get_scales()
+
+            boost = 1 if self.boost is None else int(self.boost)
+            rebin = 1 if self.rebin is None else int(self.rebin)
+
+            strip_rows = max(int(self.strip_rows) // rebin, 1) * rebin
+
+            nrows, ncols = readers[0].shape
+            out_nrows = -(-nrows * boost // rebin)
+            out_ncols = -(-ncols * boost // rebin)
+            logger.info(
+                "rendering %d rows in strips of %d", nrows, strip_rows,
+            )
+
+            colorim = None
+            if writers is None:
+                colorim = zeros((out_nrows, out_ncols, 3), dtype="u1")
+
+            # each strip is sent to the writers while the next is made; the
+            # writes for a strip finish before those for the next start
+            pool = None
+            pending = []
+            if writers is not None:
+                write_threads = self._get_write_threads(len(writers))
+                if write_threads > 1:
+                    pool = ThreadPoolExecutor(max_workers=write_threads)
+
+            # the strips are made from the top of the color image down, so
+            # the writers get them in order, and interpolation continues from
+            # one strip to the next
+            last_good = [zeros(ncols, dtype="f4") for r in readers]
+            have_good = [zeros(ncols, dtype="bool") for r in readers]
+
+            # reading and processing are interleaved, so the strips are
+            # timed as one stage
+            with instrument.stage(
+                "strips",
+                strip_rows=strip_rows,
+                bytes_read=_get_file_bytes(readers + extras),
+            ):
+                for row_start, row_end in _get_strips(nrows, strip_rows):
+                    imlist, mask = self._read_strips(
+                        readers, extras, row_start, row_end,
+                    )
+
+                    if mask is not None:
+                        self._propagate_missing_data(
+                            imlist[0], imlist[1], imlist[2], mask,
+                        )
+                        for i, im in enumerate(imlist):
+                            self._interpolate_bad_strip(
+                                im, mask, last_good[i], have_good[i],
+                            )
+
+                    # if not rebinning, the flip is done when making the color
+                    # image
+                    if self.rebin is not None:
+                        for i in range(3):
+                            imlist[i] = _rebin_padded(flipud(imlist[i]), rebin)
+
+                    self._subtract_sky(imlist)
+
+                    # the image is flipped
+                    snrows = imlist[0].shape[0]
+                    out_start = (nrows - row_end) * boost // rebin
+                    out_end = out_start + snrows
+
+                    if writers is None:
+                        strip = colorim[out_start:out_end]
+                    else:
+                        strip = zeros((snrows, out_ncols, 3), dtype="u1")
+
+                    self._get_color_image_bytes(
+                        imlist[2],
+                        imlist[1],
+                        imlist[0],
+                        self.stretch_table,
+                        scales,
+                        strip,
+                        self.rebin is None,
+                    )
+
+                    if pool is not None:
+                        for future in pending:
+                            future.result()
+                        pending = [
+                            pool.submit(writer.write, strip, out_start)
+                            for writer in writers
+                        ]
+                    elif writers is not None:
+                        for writer in writers:
+                            writer.write(strip, row_start=out_start)
+
+                for future in pending:
+                    future.result()
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+            for reader in readers + extras:
+                if reader is not None:
+                    reader.close()
+
+        self.colorim = colorim
+
+    def _load_image(self, fname):
+        """
+        read an image, with its mask if present
+        """
+        logger.info(fname)
+        return ImageTrans(
+            fname,
+            image_ext=self.image_ext,
+            ranges=self.ranges,
+            boost=self.boost,
+            image_cache=self.image_cache,
+        )
+
+    def _get_load_threads(self, nfiles):
+        """
+        get the number of threads for loading the files
+        """
+        load_threads = self.load_threads
+        if load_threads is None:
+            load_threads = os.cpu_count() or 1
+
+        return max(1, min(int(load_threads), nfiles))
+
+    def _get_write_threads(self, ntypes):
+        """
+        get the number of threads for writing the image types
+        """
+        write_threads = self.write_threads
+        if write_threads is None:
+            write_threads = os.cpu_count() or 1
+
+        return max(1, min(int(write_threads), ntypes))
+
+    def _make_image_preview(self):
+        """
+        create the rgb image at 1/preview of the resolution.  Only
+        preview_rows rows from the middle of each block of preview rows are
+        read, and blocks of those rows are averaged as they arrive.  Masked
+        pixels are not included in the averages.
+
+        The blocks are those of a rebin render, which flips the image before
+        padding it, so where the rows are not a multiple of preview the
+        partial block is the first rather than the last
+        """
+
+        if self.boost is not None or self.rebin is not None:
+            raise ValueError("cannot currently boost or rebin a preview")
+
+        preview = int(self.preview)
+        if preview < 1:
+            raise ValueError("preview factor must be >= 1")
+
+        preview_rows = min(int(self.preview_rows), preview)
+        if preview_rows < 1:
+            raise ValueError("preview_rows must be >= 1")
+
+        readers, extras = self._make_strip_readers()
+
+        try:
+            nrows, ncols = readers[0].shape
+            out_nrows = -(-nrows // preview)
+            out_ncols = -(-ncols // preview)
+            row_offset = out_nrows * preview - nrows
+            logger.info(
+                "making %d x %d preview reading %d of each %d rows",
+                out_nrows, out_ncols, preview_rows, preview,
+            )
+
+            imlist = [
+                zeros((out_nrows, out_ncols), dtype="f4") for r in readers
+            ]
+            mask = zeros((out_nrows, out_ncols), dtype="i4")
+
+            with instrument.stage(
+                "preview", preview=preview, preview_rows=preview_rows,
+            ) as st:
+                if preview_rows == preview:
+                    # all rows are needed, so read them in strips
+                    strip_rows = self.strip_rows
+                    if strip_rows is None:
+                        strip_rows = PREVIEW_STRIP_ROWS
+                    strip_rows = max(int(strip_rows) // preview, 1) * preview
+
+                    # the partial block on its own, then whole blocks
+                    blocks = []
+                    first_row = 0
+                    if row_offset > 0:
+                        first_row = preview - row_offset
+                        blocks.append((0, first_row))
+
+                    blocks += [
+                        (row_start, min(row_start + strip_rows, nrows))
+                        for row_start in range(first_row, nrows, strip_rows)
+                    ]
+                else:
+                    blocks = [
+                        _get_preview_rows(
+                            orow, preview, preview_rows, nrows, row_offset,
+                        )
+                        for orow in range(out_nrows)
+                    ]
+
+                have_mask = False
+                nread = 0
+                for row_start, row_end in blocks:
+                    have_mask |= self._add_preview_rows(
+                        readers, extras, row_start, row_end, row_offset,
+                        imlist, mask,
+                    )
+                    nread += row_end - row_start
+
+                fbytes = _get_file_bytes(readers + extras)
+                st.add(bytes_read=int(fbytes * nread / float(nrows)))
+
+            # the scales use the exposure times of the g, r, i images
+            self.imlist = readers
+            scales = self._get_scales()
+        finally:
+            for reader in readers + extras:
+                if reader is not None:
+                    reader.close()
+
+        if have_mask:
+            with instrument.stage("mask"):
+                self._propagate_missing_data(
+                    imlist[0], imlist[1], imlist[2], mask,
+                )
+
+            with instrument.stage("interpolate"):
+                for im in imlist:
+                    self._interpolate_bad(im, mask)
+
+        self.color_scales = scales
+        self._subtract_sky(imlist)
+
+        with instrument.stage("color"):
+            colorim = zeros((out_nrows, out_ncols, 3), dtype="u1")
+            self._get_color_image_bytes(
+                imlist[2],
+                imlist[1],
+                imlist[0],
+                self.stretch_table,
                 scales,
                 colorim,
+                True,
             )
+
+        self.colorim = colorim
+
+    def _add_preview_rows(
+        self, readers, extras, row_start, row_end, row_offset, imlist, mask,
+    ):
+        """
+        read rows [row_start, row_end), which are either whole blocks of
+        preview rows or rows from within a single block, and average them
+        into the preview images.  The blocks start row_offset rows before
+        the first row.  Returns True if there was a mask
+        """
+        preview = int(self.preview)
+
+        strips, smask = self._read_strips(
+            readers, extras, row_start, row_end,
+        )
+
+        has_mask = smask is not None
+        if not has_mask:
+            smask = zeros((0, 0), dtype="i4")
+
+        out_start = (row_start + row_offset) // preview
+        if (row_end - row_start) < preview:
+            row_factor = row_end - row_start
+            out_end = out_start + 1
         else:
-            colorim = images.get_color_image_old(
-                imlist[2].image,
-                imlist[1].image,
-                imlist[0].image,
-                scales=scales,
-                nonlinear=NONLINEAR,
-                satval=self.satval,
+            row_factor = preview
+            out_end = (row_end + row_offset) // preview
+
+        for strip, im in zip(strips, imlist):
+            self._block_average(
+                strip,
+                smask,
+                row_factor,
+                preview,
+                im[out_start:out_end],
+                mask[out_start:out_end],
             )
 
-        print("bytescaling")
-        colorim = images.bytescale(colorim)
+        return has_mask
 
-        self.colorim = colorim
+    def _make_strip_readers(self):
+        """
+        get readers for g, r, i and the u, z images that get added to them
+        """
+        ifiles = self.ifiles
+        kw = dict(
+            image_ext=self.image_ext,
+            ranges=self.ranges,
+            boost=self.boost,
+        )
+
+        readers = []
+        for fname in [ifiles["gfile"], ifiles["rfile"], ifiles["ifile"]]:
+            logger.info(fname)
+            readers.append(ImageStrips(fname, **kw))
+
+        extras = [None, None, None]
+        if ifiles["ufile"] is not None:
+            logger.info("adding: %s", ifiles["ufile"])
+            extras[0] = ImageStrips(ifiles["ufile"], **kw)
+
+        if ifiles["zfile"] is not None:
+            logger.info("adding: %s", ifiles["zfile"])
+            extras[2] = ImageStrips(ifiles["zfile"], **kw)
 
-    def write_image(self, image_type=None, fname=None):
+        return readers, extras
+
+    def _read_strips(self, readers, extras, row_start, row_end):
         """
-        write the image to an output file
+        read the same strip from each band, adding in the extra bands, and
+        combine the masks
         """
-        from PIL import Image
+        imlist = []
+        mask = None
+        for reader, extra in zip(readers, extras):
+            image, msk = reader.read_strip(row_start, row_end)
+
+            if extra is not None:
+                eimage, _ = extra.read_strip(row_start, row_end)
+                eimage *= reader.exptime / extra.exptime
+                image += eimage
+                image *= 0.5
+
+            if msk is not None:
+                if mask is None:
+                    mask = msk
+                else:
+                    images.combine_masks(mask, msk)
 
-        kw = {}
+            imlist.append(image)
 
-        pim = Image.fromarray(self.colorim)
+        return imlist, mask
+
+    def write_image(
+        self, image_type=None, fname=None, quality=None, compress_level=None,
+    ):
+        """
+        write the image to an output file
+
+        parameters
+        ----------
+        image_type: string, optional
+            The image type, e.g. jpg, png, tiff or dzi.  The file name is
+            from the input files.  Send either this or fname
+        fname: string, optional
+            The output file, with the type from the extension
+        quality: int, optional
+            jpg quality, default 90
+        compress_level: int, optional
+            zlib compression level for png, default 6, and for tiff, default
+            uncompressed
+        """
+        from PIL import Image
 
         if fname is not None:
             image_type = fname.split(".")[-1]
@@ -272,11 +1327,198 @@ class RGBImageMaker(object):
             )
             fname = self.ifiles.get_output_file(image_type)
 
-        if image_type == "jpg":
-            kw["quality"] = 90
+        if image_type == "dzi":
+            with instrument.stage("write", image_type=image_type):
+                self.write_pyramid(fname, quality=quality)
+            return
+
+        logger.info("writing: %s", fname)
+
+        if image_type in stripwriter.WRITERS:
+            with instrument.stage("write", image_type=image_type) as st:
+                stripwriter.write_image(
+                    fname,
+                    self.colorim,
+                    image_type=image_type,
+                    quality=quality,
+                    compress_level=compress_level,
+                )
+                st.add(bytes_written=os.path.getsize(fname))
+            return
+
+        # other types are written by PIL
+        pim = Image.fromarray(self.colorim)
+
+        # the output may be a link into the render cache, so it is replaced
+        # rather than written over
+        if os.path.exists(fname):
+            os.remove(fname)
+
+        with instrument.stage("write", image_type=image_type) as st:
+            pim.save(fname)
+            st.add(bytes_written=os.path.getsize(fname))
+
+    def write_images(self, image_types, quality=None, compress_level=None):
+        """
+        write the image to the output file for each type, encoding the
+        types at the same time.  See write_image for the parameters
+
+        returns
+        -------
+        seconds: dict
+            The time to write each type, keyed by type
+        """
+
+        def write(image_type):
+            tm0 = time.time()
+            self.write_image(
+                image_type=image_type,
+                quality=quality,
+                compress_level=compress_level,
+            )
+            return time.time() - tm0
+
+        write_threads = self._get_write_threads(len(image_types))
+        if write_threads == 1:
+            return dict(
+                (image_type, write(image_type)) for image_type in image_types
+            )
+
+        logger.info(
+            "writing %d types with %d threads",
+            len(image_types), write_threads,
+        )
+        with ThreadPoolExecutor(max_workers=write_threads) as pool:
+            futures = [
+                (image_type, pool.submit(write, image_type))
+                for image_type in image_types
+            ]
+            return dict(
+                (image_type, future.result())
+                for image_type, future in futures
+            )
+
+    def can_stream(self, image_types):
+        """
+        check if the image types can be written by make_and_write, strip
+        mode with types that have strip writers
+        """
+        return (
+            self.strip_rows is not None
+            and self.preview is None
+            and all(
+                image_type in stripwriter.WRITERS
+                for image_type in image_types
+            )
+        )
+
+    def make_and_write(self, fnames, quality=None, compress_level=None):
+        """
+        make the image in strip mode and write it to the files as the strips
+        are made, so the whole color image is never in memory.  The types
+        are from the file extensions, which must have strip writers.
+        colorim is not set
+
+        See write_image for the parameters
+        """
+        image_types = [fname.split(".")[-1] for fname in fnames]
+        if not self.can_stream(image_types):
+            raise ValueError(
+                "can only write images as they are made in strip mode, for "
+                "types %s" % sorted(stripwriter.WRITERS)
+            )
+
+        if self.nthreads is not None:
+            images.set_num_threads(self.nthreads)
+
+        nrows, ncols = self._get_output_shape()
+
+        writers = []
+        try:
+            for fname in fnames:
+                logger.info("writing: %s", fname)
+                writers.append(
+                    stripwriter.get_strip_writer(
+                        fname,
+                        nrows,
+                        ncols,
+                        quality=quality,
+                        compress_level=compress_level,
+                    )
+                )
+
+            self._make_image_strips(writers=writers)
+
+            for image_type, writer in zip(image_types, writers):
+                with instrument.stage(
+                    "write", image_type=image_type, streamed=True,
+                ) as st:
+                    writer.close()
+                    st.add(bytes_written=writer.get_nbytes())
+        except BaseException:
+            for writer in writers:
+                writer.abort()
+            raise
+
+        self.colorim = None
+
+    def _get_output_shape(self):
+        """
+        get the shape of the color image made in strip mode
+        """
+        ifiles = self.ifiles
+        with fitsio.FITS(ifiles["gfile"]) as fits:
+            nrows, ncols = fits[self.image_ext].get_dims()
+
+        if self.ranges is not None:
+            rowslice, colslice = self.ranges
+            nrows = len(range(*rowslice.indices(nrows)))
+            ncols = len(range(*colslice.indices(ncols)))
+
+        boost = 1 if self.boost is None else int(self.boost)
+        rebin = 1 if self.rebin is None else int(self.rebin)
+        return -(-nrows * boost // rebin), -(-ncols * boost // rebin)
 
-        print("writing:", fname)
-        pim.save(fname, **kw)
+    def write_pyramid(self, fname, quality=None):
+        """
+        write a deep zoom tile pyramid.  The lower resolution levels are made
+        from the band images, which are averaged before stretching
+
+        parameters
+        ----------
+        fname: string
+            The .dzi file name.  The tiles go in the directory <name>_files
+        quality: int, optional
+            jpg quality of the tiles, default 90
+        """
+        if self.strip_rows is not None or self.preview is not None:
+            raise ValueError(
+                "cannot currently write a pyramid in strip or preview mode"
+            )
+
+        imlist = [im.image for im in self.imlist]
+        if self.rebin is None:
+            # the flip is otherwise done when making the color image
+            imlist = [flipud(im) for im in imlist]
+
+        nthreads = self.nthreads
+        if nthreads is None:
+            nthreads = 1
+
+        if quality is None:
+            quality = stripwriter.DEFAULT_QUALITY
+
+        pyramid.write_dzi(
+            fname,
+            imlist[2],
+            imlist[1],
+            imlist[0],
+            self.stretch_table,
+            self.color_scales,
+            colorim=self.colorim,
+            nthreads=nthreads,
+            quality=quality,
+        )
 
     def _get_scales(self):
         """
@@ -284,7 +1526,7 @@ class RGBImageMaker(object):
         """
 
         campaign = self.ifiles["campaign"].upper()
-        print("getting scaled color for", campaign)
+        logger.info("getting scaled color for %s", campaign)
 
         # smaller scale means darker, so noise is more suppressed
         # compared to the peak. remember it is all scaled below
@@ -295,83 +1537,116 @@ class RGBImageMaker(object):
             relative_scales = array(self.scales)
             scale = self.absscale
 
-        elif campaign == "ONEOFF":
-            nominal_exptime = 90.0
-            # used for the big galaxy images
-            scale = 0.01
-            relative_scales = array([1.0, 1.0, 1.5])
-            # scale=0.004
-            # scale=0.015
-            # relative_scales= array([1.00, 1.2, 2.0])
-            # relative_scales= array([1.0, 1.0, 1.6])
-        elif campaign == "MACS":
-            nominal_exptime = 9000.0
-            # scale=.015*sqrt(2.0)
-            scale = 0.015
-            relative_scales = array([1.0, 1.0, 1.5])
+        elif self.autoscale:
+            return self._get_auto_scales()
+
         else:
-            nominal_exptime = NOMINAL_EXPTIME
-            if campaign in ("Y5A1_COADD", "Y6A1_COADD"):
-                # scale=.015*sqrt(2.0)
-                scale = 0.03
-                # relative_scales= array([1.00, 1.2, 2.0])
-                relative_scales = array([1.0, 1.0, 1.5])
-            elif campaign == "Y3A1_COADD":
-                scale = 0.015 * sqrt(2.0)
-                # scale=.010*sqrt(2.0)
-                relative_scales = array([1.00, 1.2, 2.0])
-            elif campaign == "Y1A1":
-                print("getting scaled color for y1")
-                scale = 0.010 * sqrt(2.0)
-                relative_scales = array([1.00, 1.2, 2.0])
-            elif campaign == "SVA1":
-                # SVA seems to require a very different scaling
-                print("getting scaled color for sv")
-                scale = 0.050 * 0.88
-                relative_scales = array([1.00, 1.2, 2.5])
-            else:
-                raise ValueError("bad campaign: '%s'" % campaign)
+            campaign_scales = get_campaign_scales(campaign)
+            if campaign_scales is None:
+                logger.info("no scales for %s, using autoscale", campaign)
+                return self._get_auto_scales()
+
+            nominal_exptime = campaign_scales["nominal_exptime"]
+            scale = campaign_scales["scale"]
+            relative_scales = array(campaign_scales["relative_scales"])
 
         scales = scale * relative_scales
-        print("scales:", scales)
+        logger.info("scales: %s", scales)
 
         for i in range(3):
             im = self.imlist[i]
             if im.exptime is not None:
-                print("    scaling", im.band, im.exptime)
+                logger.info("    scaling %s %s", im.band, im.exptime)
                 scales[i] *= sqrt(nominal_exptime / im.exptime)
         return scales
 
+    def _get_auto_scales(self):
+        """
+        get scales that put the sky noise of each band at AUTO_NOISE, from
+        a sample of rows of the images.  The sky levels are kept to be
+        subtracted
+        """
+        ifiles = self.ifiles
+        fnames = [ifiles["gfile"], ifiles["rfile"], ifiles["ifile"]]
+        extras = [ifiles["ufile"], None, ifiles["zfile"]]
+
+        with instrument.stage("skystats"):
+            stats = [
+                skystats.get_file_sky_stats(
+                    fname, image_ext=self.image_ext, extra_fname=extra,
+                )
+                for fname, extra in zip(fnames, extras)
+            ]
+
+        self.sky_levels = [sky for sky, sigma in stats]
+        logger.info("sky levels: %s", self.sky_levels)
+        logger.info("sky noise: %s", [sigma for sky, sigma in stats])
+
+        # i,r,g -> r,g,b
+        scales = array([AUTO_NOISE / stats[2 - i][1] for i in range(3)])
+        logger.info("scales: %s", scales)
+        return scales
+
+    def _subtract_sky(self, imlist):
+        """
+        subtract the measured sky levels from the g, r, i images, if the
+        scales were set from the sky
+        """
+        if self.sky_levels is None:
+            return
+
+        for im, sky in zip(imlist, self.sky_levels):
+            im -= sky
+
 
 class ImageTrans(object):
-    def __init__(self, filename, boost=None, image_ext=1, ranges=None):
+    def __init__(
+        self, filename, boost=None, image_ext=1, ranges=None, image_cache=None,
+    ):
         self.ranges = ranges
         self.mask = None
-        with fitsio.FITS(filename) as fits:
-            if ranges is not None:
-                rowslice, colslice = ranges
-                print(rowslice)
-                print(colslice)
-                image = fits[image_ext][rowslice, colslice]
 
-                if "msk" in fits:
-                    self.mask = fits["msk"][rowslice, colslice]
+        fields = {"file": os.path.basename(filename)}
+        if image_cache is not None:
+            fields["cached"] = True
 
+        with instrument.stage("read", **fields) as st, _get_fitsio_lock():
+            if image_cache is not None:
+                image, self.mask, header = image_cache.get_cutout(
+                    filename, image_ext=image_ext, ranges=ranges,
+                )
             else:
-                image = fits[image_ext].read()
-                if "msk" in fits:
-                    self.mask = fits["msk"].read()
-
-            wnan = where(isnan(image))
-            if wnan[0].size > 0:
-                image[wnan] = 0.0
-
-            if boost is not None:
-                image = images.boost(image, boost)
-                if self.mask is not None:
-                    raise ValueError("cannot currently boost mask")
-
-            header = fits[image_ext].read_header()
+                # for part of the image, the same fraction of the file is
+                # counted as read
+                fraction = 1.0
+                with fitsio.FITS(filename) as fits:
+                    if ranges is not None:
+                        rowslice, colslice = ranges
+                        logger.debug("rows: %s cols: %s", rowslice, colslice)
+                        image = fits[image_ext][rowslice, colslice]
+
+                        if "msk" in fits:
+                            self.mask = fits["msk"][rowslice, colslice]
+
+                        nrows, ncols = fits[image_ext].get_dims()
+                        fraction = image.size / float(nrows * ncols)
+                    else:
+                        image = fits[image_ext].read()
+                        if "msk" in fits:
+                            self.mask = fits["msk"].read()
+
+                    header = fits[image_ext].read_header()
+
+                st.add(
+                    bytes_read=int(os.path.getsize(filename) * fraction),
+                )
+
+        images.zero_nans(image)
+
+        if boost is not None:
+            image = images.boost(image, boost)
+            if self.mask is not None:
+                raise ValueError("cannot currently boost mask")
 
         self.image = image
         self.header = header
@@ -380,69 +1655,226 @@ class ImageTrans(object):
         self.exptime = header.get("exptime", NOMINAL_EXPTIME)
 
     def add_image(self, imt):
+        """
+        average in another image, scaled to the same exposure time.  The
+        other image is modified
+        """
         fac = self.exptime / imt.exptime
-        self.image += imt.image * fac
+        imt.image *= fac
+        self.image += imt.image
         self.image *= 0.5
 
     def zero_bad_weightmap(self, minval=0.001):
-        print("    zeroing bad weight map")
+        logger.info("    zeroing bad weight map")
 
         wt = self.weight
         w = where(wt < minval)
 
         if w[0].size > 0:
-            print("        zeroing", w[0].size, "bad pixels")
-            print("        max val from image:", self.image[w].max())
+            logger.info("        zeroing %d bad pixels", w[0].size)
+            logger.info(
+                "        max val from image: %s", self.image[w].max(),
+            )
             self.image[w] = 0.0
 
     def flip_ud(self):
-        print("    flipping", self.band)
+        logger.info("    flipping %s", self.band)
         self.image = flipud(self.image)
         if self.mask is not None:
             self.mask = flipud(self.mask)
 
     def transpose(self):
-        print("    transposing", self.band)
+        logger.info("    transposing %s", self.band)
         self.image = self.image.transpose()
         if self.mask is not None:
             self.mask = self.mask.transpose()
 
     def rebin(self, rebin):
-        print("    rebinning", self.band)
-        image = self.image
-
-        nrows, ncols = image.shape
-
-        # pad nrows,ncols for rebin
-        row_remain = nrows % rebin
-        if row_remain != 0:
-            nrows += rebin - row_remain
-        col_remain = ncols % rebin
-        if col_remain != 0:
-            ncols += rebin - col_remain
-
-        imrebin = zeros((nrows, ncols), dtype="f4")
+        logger.info("    rebinning %s", self.band)
 
-        imrebin[0: image.shape[0], 0: image.shape[1]] = image[:, :]
-
-        imrebin = images.rebin(imrebin, rebin)
+        imrebin = _rebin_padded(self.image, rebin)
 
         del self.image
         self.image = imrebin
 
     def scale_image(self, exptime=NOMINAL_EXPTIME):
-        print("    scaling", self.band, self.exptime, "to", exptime)
+        logger.info(
+            "    scaling %s %s to %s", self.band, self.exptime, exptime,
+        )
 
         self.image *= exptime / self.exptime
 
 
+class ImageStrips(object):
+    """
+    read an image, and the mask if present, in strips of rows
+
+    Row numbers are relative to the region specified by ranges, if sent
+    """
+    def __init__(self, filename, boost=None, image_ext=1, ranges=None):
+        self.filename = filename
+        self.boost = boost
+        self.image_ext = image_ext
+        self.fits = fitsio.FITS(filename)
+
+        hdu = self.fits[image_ext]
+        dims = hdu.get_dims()
+        if ranges is not None:
+            rowslice, colslice = ranges
+        else:
+            rowslice, colslice = slice(None), slice(None)
+
+        self.row_start, self.row_end, _ = rowslice.indices(dims[0])
+        self.col_start, self.col_end, _ = colslice.indices(dims[1])
+
+        self.has_mask = "msk" in self.fits
+        if boost is not None and self.has_mask:
+            raise ValueError("cannot currently boost mask")
+
+        header = hdu.read_header()
+        self.header = header
+
+        self.band = header.get("FILTER", "None").split()[0]
+        self.exptime = header.get("exptime", NOMINAL_EXPTIME)
+
+    @property
+    def shape(self):
+        return (self.row_end - self.row_start, self.col_end - self.col_start)
+
+    def read_strip(self, row_start, row_end):
+        """
+        read rows [row_start, row_end) of the image and mask
+
+        returns
+        -------
+        image, mask: arrays
+            mask is None if there is no mask
+        """
+        rowslice = slice(self.row_start + row_start, self.row_start + row_end)
+        colslice = slice(self.col_start, self.col_end)
+
+        image = self.fits[self.image_ext][rowslice, colslice]
+
+        images.zero_nans(image)
+
+        if self.boost is not None:
+            image = images.boost(image, self.boost)
+
+        mask = None
+        if self.has_mask:
+            mask = self.fits["msk"][rowslice, colslice]
+
+        return image, mask
+
+    def close(self):
+        self.fits.close()
+
+
+def _get_strips(nrows, strip_rows):
+    """
+    get [start, end) row ranges covering nrows in decreasing order, which is
+    the order of the rows of the color image.  The strips are aligned to the
+    end, so only the last, starting at row zero, can be short
+    """
+    strips = []
+    row_end = nrows
+    while row_end > 0:
+        row_start = max(row_end - strip_rows, 0)
+        strips.append((row_start, row_end))
+        row_end = row_start
+
+    return strips
+
+
+def _get_fitsio_lock():
+    """
+    get a lock to hold while reading with fitsio.  This is the module lock
+    if cfitsio is not reentrant, so files are read one at a time by the
+    load threads, otherwise it does nothing
+    """
+    is_reentrant = getattr(fitsio, "cfitsio_is_reentrant", None)
+    if is_reentrant is not None and is_reentrant():
+        return contextlib.nullcontext()
+
+    return _FITSIO_LOCK
+
+
+def _get_preview_rows(orow, preview, preview_rows, nrows, row_offset=0):
+    """
+    get the [start, end) range of preview_rows rows centered in the block of
+    preview rows for the output row.  The blocks start row_offset rows
+    before the first row, so the first block can be partial
+    """
+    block_start = max(orow * preview - row_offset, 0)
+    block_end = min((orow + 1) * preview - row_offset, nrows)
+    block_nrows = block_end - block_start
+    nread = min(preview_rows, block_nrows)
+
+    row_start = block_start + (block_nrows - nread) // 2
+    return row_start, row_start + nread
+
+
+def _rebin_padded(image, rebin):
+    """
+    rebin the image, padding the end of each dimension with zeros to
+    a multiple of the rebin factor
+    """
+    nrows, ncols = image.shape
+
+    # pad nrows,ncols for rebin
+    row_remain = nrows % rebin
+    if row_remain != 0:
+        nrows += rebin - row_remain
+    col_remain = ncols % rebin
+    if col_remain != 0:
+        ncols += rebin - col_remain
+
+    if (nrows, ncols) == image.shape:
+        return images.rebin(image, rebin)
+
+    imrebin = zeros((nrows, ncols), dtype="f4")
+
+    imrebin[0: image.shape[0], 0: image.shape[1]] = image[:, :]
+
+    return images.rebin(imrebin, rebin)
+
+
+def parse_ranges(ranges):
+    """
+    convert a string such as 1000:2000,550:850 to row and column slices
+    """
+    rparts = ranges.split(",")
+    if len(rparts) != 2:
+        raise ValueError("bad ranges: '%s'" % ranges)
+
+    rowstart, rowend = [int(p) for p in rparts[0].split(":")]
+    colstart, colend = [int(p) for p in rparts[1].split(":")]
+    return (
+        slice(rowstart, rowend),
+        slice(colstart, colend),
+    )
+
+
+def _get_file_bytes(fnames):
+    """
+    total size of the files, which may be ImageStrips readers or None
+    """
+    nbytes = 0
+    for fname in fnames:
+        if isinstance(fname, ImageStrips):
+            fname = fname.filename
+        if fname is not None and os.path.exists(fname):
+            nbytes += os.path.getsize(fname)
+    return nbytes
+
+
 def make_dir(fname):
     dname = os.path.dirname(fname)
     if dname == "":
         return
 
     if not os.path.exists(dname):
-        print("making dirs:", dname)
+        logger.info("making dirs: %s", dname)
         os.makedirs(dname)
 
 
@@ -451,20 +1883,15 @@ class FlistCache(dict):
 
     def get_flist(self, campaign):
         """
-        get the coadd file list
+        get the coadd file list.  This is a read-only mapping from keys such
+        as DES0428-4748-g to paths, backed by an index that is rebuilt when
+        the list changes
         """
         if campaign not in FlistCache._flists:
-            flist_file = files.get_flist_file(campaign)
-            print("reading:", flist_file)
-            data = fitsio.read(flist_file, lower=True)
-
-            flist = {}
-            for i in range(data.size):
-                key = _convert_bytes(data["key"][i].strip())
-                path = _convert_bytes(data["path"][i].strip())
-                flist[key] = path
-
-            FlistCache._flists[campaign] = flist
+            FlistCache._flists[campaign] = flistindex.FlistIndex(
+                files.get_flist_file(campaign),
+                files.get_flist_index_file(campaign),
+            )
 
         return FlistCache._flists[campaign]
 
@@ -512,9 +1939,17 @@ class Files(dict):
 class FilesAuto(Files):
     """
     deal with files, including syncing
+
+    With a source cache the coadd files are kept in the cache rather than
+    the sources directory of the tile.  sync() gets them into the cache and
+    holds them, and clean() releases them to the cache rather than
+    removing them
     """
 
-    def __init__(self, campaign, tilename, rebin=None, clean=True, bands=None):
+    def __init__(
+        self, campaign, tilename, rebin=None, clean=True, bands=None,
+        transfer=None, preview=None, source_cache=None,
+    ):
         if bands is None:
             self._bands = ["g", "r", "i"]
         else:
@@ -524,7 +1959,14 @@ class FilesAuto(Files):
         self["tilename"] = tilename
 
         self._rebin = rebin
+        self._preview = preview
         self._clean = clean
+        self._source_cache = source_cache
+        self._held_paths = []
+
+        if transfer is None:
+            transfer = transfer_mod.RsyncTransfer()
+        self._transfer = transfer
 
         fd = self._get_files()
 
@@ -551,6 +1993,9 @@ class FilesAuto(Files):
         """
         local location of coadd fits file
         """
+        if self._source_cache is not None:
+            return self._source_cache.get_file(self._get_coadd_path(band))
+
         return os.path.join(
             self.get_temp_dir(),
             os.path.basename(self._get_coadd_path(band)),
@@ -571,6 +2016,30 @@ class FilesAuto(Files):
         """
         return get_flist(self["campaign"])
 
+    def get_bands(self):
+        """
+        get the list of bands
+        """
+        return list(self._bands)
+
+    def get_rebin(self):
+        """
+        get the rebin factor
+        """
+        return self._rebin
+
+    def get_input_paths(self):
+        """
+        get the paths of the coadd files from the file list
+        """
+        return [self._get_coadd_path(band) for band in self._bands]
+
+    def get_local_files(self):
+        """
+        get the local locations of the coadd files
+        """
+        return [self.get_coadd_file(band) for band in self._bands]
+
     def get_temp_dir(self):
         """
         temporary location for the input fits files
@@ -599,50 +2068,65 @@ class FilesAuto(Files):
             self._bands,
             rebin=self._rebin,
             ext=image_type,
+            preview=self._preview,
         )
 
     def sync(self):
         """
         sync the coadd images
         """
-        odir = self.get_temp_dir()
-        if not os.path.exists(odir):
-            os.makedirs(odir)
-
-        remote_url = self.get_remote_coadd_file("g")
+        with instrument.stage(
+            "sync", campaign=self["campaign"], tilename=self["tilename"],
+        ) as st:
+            if self._source_cache is not None:
+                fetched = self._sync_cached()
+            else:
+                self._transfer.fetch(self)
+                fetched = self.get_local_files()
 
-        p = "_g,_r,_i"
+            st.add(bytes_fetched=_get_file_bytes(fetched))
 
-        if self["ufile"] is not None:
-            p = "_u," + p
+    def _sync_cached(self):
+        """
+        get the coadd files into the source cache and hold them, returning
+        the files that were fetched
+        """
+        if not hasattr(self._transfer, "fetch_file"):
+            raise ValueError(
+                "the source cache needs a transfer with a fetch_file method"
+            )
 
-        if self["zfile"] is not None:
-            p = p + ",_z"
+        fetched = []
+        for band in self._bands:
+            path = self._get_coadd_path(band)
+            if path in self._held_paths:
+                continue
 
-        p = "{" + p + "}"
+            def fetch(local_file, path=path):
+                self._transfer.fetch_file(path, local_file)
 
-        remote_url = remote_url.replace("_g", p)
-        cmd = r"""
-    rsync                                   \
-        -aP                                 \
-        --password-file $DES_RSYNC_PASSFILE \
-        %(remote_url)s \
-        %(local_dir)s/
-        """ % dict(
-            remote_url=remote_url,
-            local_dir=odir,
-        )
+            if self._source_cache.acquire(path, fetch):
+                fetched.append(self._source_cache.get_file(path))
+            self._held_paths.append(path)
 
-        print(cmd)
-        subprocess.check_call(cmd, shell=True)
+        return fetched
 
     def clean(self):
         """
-        clean up the source files
+        clean up the source files, or release them to the source cache
         """
+        if self._source_cache is not None:
+            for path in self._held_paths:
+                self._source_cache.release(path)
+            self._held_paths = []
+
+            # files held while fetching others can now be removed
+            self._source_cache.evict()
+            return
+
         odir = self.get_temp_dir()
         if os.path.exists(odir):
-            print("removing sources:", odir)
+            logger.info("removing sources: %s", odir)
             shutil.rmtree(odir)
 
     def get_output_front(self):
@@ -663,10 +2147,3 @@ class FilesAuto(Files):
             d["%sfile" % band] = self.get_coadd_file(band)
             d["%sfile_remote" % band] = self.get_remote_coadd_file(band)
         return d
-
-
-def _convert_bytes(data):
-    try:
-        return str(data, "utf-8")
-    except Exception:
-        return str(data)
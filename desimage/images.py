@@ -1,24 +1,34 @@
+import math
 import numpy as np
-from numba import njit
+import numba
+from numba import njit, prange
 
+from . import stretch as stretch_mod
 
-@njit
-def get_color_image(imr, img, imb, nonlinear, scales, colorim):
+# The kernels are compiled with cache=True, so the compiled code is saved on
+# disk, in __pycache__ or under NUMBA_CACHE_DIR, and later processes load it
+# rather than compiling again.  Run warmup() once after installing to fill
+# the cache for the usual array types
+
+
+@njit(nogil=True, cache=True)
+def get_color_image(imr, img, imb, stretch, scales, colorim):
     """
     Create a color image.
 
-    The idea here is that, after applying the asinh scaling, the color image
+    The idea here is that, after applying the stretch, the color image
     should basically be between [0,1] for all filters.  Any place where a value
     is > 1 the intensity will be scaled back in all but the brightest filter
     but color preserved.
 
     In other words, you develaop a set of pre-scalings the images so that after
-    multiplying by
+    multiplying by the stretch factor, for example for asinh
 
         asinh(I/nonlinear)/(I/nonlinear)
 
     the numbers will be mostly between [0,1].  You can send scales using the
-    scale= keyword
+    scale= keyword.  The stretch is a stretch.StretchTable, from
+    stretch.get_table
 
     It can actually be good to have some color saturation so don't be too
     agressive.  You'll have to play with the numbers for each image.
@@ -33,60 +43,261 @@ def get_color_image(imr, img, imb, nonlinear, scales, colorim):
     nrows, ncols = imr.shape
 
     for row in range(nrows):
-        for col in range(ncols):
-            rval = imr[row, col] * scales[0]
-            gval = img[row, col] * scales[1]
-            bval = imb[row, col] * scales[2]
+        _get_color_row(imr, img, imb, stretch, scales, colorim, row)
+
+
+@njit(nogil=True, parallel=True, cache=True)
+def get_color_image_parallel(imr, img, imb, stretch, scales, colorim):
+    """
+    Same as get_color_image but with the rows processed in parallel.  The
+    output is identical to that of get_color_image
+    """
+
+    nrows, ncols = imr.shape
+
+    for row in prange(nrows):
+        _get_color_row(imr, img, imb, stretch, scales, colorim, row)
+
+
+@njit(nogil=True, cache=True)
+def _get_color_row(imr, img, imb, stretch, scales, colorim, row):
+    """
+    fill in a row of the color image
+    """
+    ncols = imr.shape[1]
+
+    for col in range(ncols):
+        rval, gval, bval = _get_color_pixel(
+            imr[row, col] * scales[0],
+            img[row, col] * scales[1],
+            imb[row, col] * scales[2],
+            stretch,
+        )
+
+        colorim[row, col, 0] = rval
+        colorim[row, col, 1] = gval
+        colorim[row, col, 2] = bval
+
+
+@njit(nogil=True, cache=True)
+def get_color_image_bytes(imr, img, imb, stretch, scales, colorim, flip):
+    """
+    Create a color image as in get_color_image, but write the bytescaled
+    values directly into the unsigned byte array colorim, in a single pass
+    over the data.  NaN values are treated as zero.
+
+    If flip is True, the image is flipped top to bottom as it is written.
+
+    The output is identical to that of get_color_image followed by bytescale
+    """
+
+    nrows, ncols = imr.shape
+
+    for row in range(nrows):
+        _get_color_bytes_row(
+            imr, img, imb, stretch, scales, colorim, row, flip,
+        )
+
 
-            if rval < 0.0:
-                rval = 0.0
-            if gval < 0.0:
-                gval = 0.0
-            if bval < 0.0:
-                bval = 0.0
+@njit(nogil=True, parallel=True, cache=True)
+def get_color_image_bytes_parallel(
+    imr, img, imb, stretch, scales, colorim, flip,
+):
+    """
+    Same as get_color_image_bytes but with the rows processed in parallel.
+    The output is identical to that of get_color_image_bytes
+    """
 
-            # average images and divide by the nonlinear factor
-            meanval = (rval + gval + bval) / 3.0
-            scaled_image = meanval / nonlinear  # noqa
+    nrows, ncols = imr.shape
 
-            if scaled_image <= 0.0:
-                scaled_image = 1.0 / 3.0
+    for row in prange(nrows):
+        _get_color_bytes_row(
+            imr, img, imb, stretch, scales, colorim, row, flip,
+        )
 
-            f = np.arcsinh(scaled_image) / scaled_image
 
-            if (rval * f > 1) or (gval * f > 1) or (bval * f > 1):
-                maxval = max(rval, gval, bval)
-                if maxval > 0.0:
-                    f = 1.0 / maxval
+@njit(nogil=True, cache=True)
+def _get_color_bytes_row(imr, img, imb, stretch, scales, colorim, row, flip):
+    """
+    fill in a row of the byte color image
+    """
+    nrows, ncols = imr.shape
 
-            colorim[row, col, 0] = rval * f
-            colorim[row, col, 1] = gval * f
-            colorim[row, col, 2] = bval * f
+    # prange gives unsigned row numbers
+    if flip:
+        outrow = nrows - 1 - np.int64(row)
+    else:
+        outrow = np.int64(row)
 
+    for col in range(ncols):
+        rval, gval, bval = _get_color_pixel(
+            imr[row, col] * scales[0],
+            img[row, col] * scales[1],
+            imb[row, col] * scales[2],
+            stretch,
+        )
 
-@njit
+        colorim[outrow, col, 0] = _to_byte(rval)
+        colorim[outrow, col, 1] = _to_byte(gval)
+        colorim[outrow, col, 2] = _to_byte(bval)
+
+
+@njit(nogil=True, cache=True)
+def _get_color_pixel(rval, gval, bval, stretch):
+    """
+    apply the stretch to a single scaled pixel.  Values are clipped at zero,
+    and NaN is treated as zero
+    """
+
+    if not rval > 0.0:
+        rval = 0.0
+    if not gval > 0.0:
+        gval = 0.0
+    if not bval > 0.0:
+        bval = 0.0
+
+    # the stretch depends on the average of the images
+    meanval = (rval + gval + bval) / 3.0
+
+    f = _get_stretch_factor(stretch, meanval)
+
+    if (rval * f > 1) or (gval * f > 1) or (bval * f > 1):
+        maxval = max(rval, gval, bval)
+        if maxval > 0.0:
+            f = 1.0 / maxval
+
+    return rval * f, gval * f, bval * f
+
+
+@njit(nogil=True, cache=True)
+def _get_stretch_factor(stretch, meanval):
+    """
+    get the stretch factor S(I)/I from the lookup table, interpolating
+    linearly within the octave found from the exponent of I
+    """
+    values, min_exp, low, high = stretch
+
+    if not meanval > 0.0:
+        # all values are zero
+        return 1.0
+
+    mantissa, exponent = math.frexp(meanval)
+    octave = exponent - 1 - min_exp
+
+    if octave < 0:
+        return low
+
+    noctaves, npoints = values.shape
+    if octave >= noctaves:
+        return high
+
+    pos = (2.0 * mantissa - 1.0) * (npoints - 1)
+    ipos = int(pos)
+    frac = pos - ipos
+
+    v0 = values[octave, ipos]
+    val = v0 + frac * (values[octave, ipos + 1] - v0)
+    return val / meanval
+
+
+@njit(nogil=True, cache=True)
+def _to_byte(val):
+    """
+    convert a value in [0,1] to [0,255] the same way as bytescale, going
+    through single precision as for a f4 color image
+    """
+    bval = np.float32(val) * np.float32(255)
+    if bval >= 255:
+        return np.uint8(255)
+    return np.uint8(bval)
+
+
+@njit(nogil=True, cache=True)
 def interpolate_bad(im, mask):
     """
-    go along columns until we hit a problem, then continue
-    the last value
+    go along columns from the last row, which is the top of the color image,
+    until we hit a problem, then continue the last value
+    """
+    nrows, ncols = im.shape
+
+    for col in range(ncols):
+        _interpolate_bad_column(im, mask, col)
+
+
+@njit(nogil=True, parallel=True, cache=True)
+def interpolate_bad_parallel(im, mask):
+    """
+    Same as interpolate_bad but with the columns processed in parallel
+    """
+    nrows, ncols = im.shape
+
+    for col in prange(ncols):
+        _interpolate_bad_column(im, mask, col)
+
+
+@njit(nogil=True, cache=True)
+def _interpolate_bad_column(im, mask, col):
+    """
+    interpolate bad values in a single column
+    """
+    nrows = im.shape[0]
+
+    last_good = 0
+    have_good = False
+    for row in range(nrows - 1, -1, -1):
+        if mask[row, col] > 0:
+            # we hit a bad value
+            if have_good:
+                # we have a good value to continue
+                im[row, col] = last_good
+        else:
+            last_good = im[row, col]
+            have_good = True
+
+
+@njit(nogil=True, cache=True)
+def interpolate_bad_strip(im, mask, last_good, have_good):
+    """
+    same as interpolate_bad but for a strip of rows from a larger image.
+
+    The last good value and whether one was seen are carried for each column
+    in last_good and have_good, which are updated in place so the next strip,
+    the one below this one, continues where this one left off.
     """
     nrows, ncols = im.shape
 
     for col in range(ncols):
-        last_good = 0
-        have_good = False
-        for row in range(nrows):
-            if mask[row, col] > 0:
-                # we hit a bad value
-                if have_good:
-                    # we have a good value to continue
-                    im[row, col] = last_good
-            else:
-                last_good = im[row, col]
-                have_good = True
-
-
-@njit
+        _interpolate_bad_strip_column(im, mask, last_good, have_good, col)
+
+
+@njit(nogil=True, parallel=True, cache=True)
+def interpolate_bad_strip_parallel(im, mask, last_good, have_good):
+    """
+    Same as interpolate_bad_strip but with the columns processed in parallel
+    """
+    nrows, ncols = im.shape
+
+    for col in prange(ncols):
+        _interpolate_bad_strip_column(im, mask, last_good, have_good, col)
+
+
+@njit(nogil=True, cache=True)
+def _interpolate_bad_strip_column(im, mask, last_good, have_good, col):
+    """
+    interpolate bad values in a single column of a strip
+    """
+    nrows = im.shape[0]
+
+    for row in range(nrows - 1, -1, -1):
+        if mask[row, col] > 0:
+            if have_good[col]:
+                im[row, col] = last_good[col]
+        else:
+            last_good[col] = im[row, col]
+            have_good[col] = True
+
+
+@njit(nogil=True, cache=True)
 def propagate_missing_data(im1, im2, im3, mask):
     """
     If the data are masked because of missing data, just set
@@ -97,17 +308,203 @@ def propagate_missing_data(im1, im2, im3, mask):
     nrows, ncols = im1.shape
 
     for col in range(ncols):
-        for row in range(nrows):
-            if mask[row, col] > 0:
-                v1 = im1[row, col]
-                v2 = im2[row, col]
-                v3 = im3[row, col]
+        _propagate_missing_data_column(im1, im2, im3, mask, col)
+
+
+@njit(nogil=True, parallel=True, cache=True)
+def propagate_missing_data_parallel(im1, im2, im3, mask):
+    """
+    Same as propagate_missing_data but with the columns processed in
+    parallel
+    """
+    nrows, ncols = im1.shape
 
-                if v1 == 0.0 or v2 == 0.0 or v3 == 0.0:
-                    im1[row, col] = 0.0
-                    im2[row, col] = 0.0
-                    im3[row, col] = 0.0
-                    mask[row, col] = 0
+    for col in prange(ncols):
+        _propagate_missing_data_column(im1, im2, im3, mask, col)
+
+
+@njit(nogil=True, cache=True)
+def _propagate_missing_data_column(im1, im2, im3, mask, col):
+    """
+    propagate missing data for a single column
+    """
+    nrows = im1.shape[0]
+
+    for row in range(nrows):
+        if mask[row, col] > 0:
+            v1 = im1[row, col]
+            v2 = im2[row, col]
+            v3 = im3[row, col]
+
+            if v1 == 0.0 or v2 == 0.0 or v3 == 0.0:
+                im1[row, col] = 0.0
+                im2[row, col] = 0.0
+                im3[row, col] = 0.0
+                mask[row, col] = 0
+
+
+@njit(nogil=True, cache=True)
+def zero_nans(im):
+    """
+    set NaN values to zero in place, returning the number set
+    """
+    nrows, ncols = im.shape
+
+    nnan = 0
+    for row in range(nrows):
+        for col in range(ncols):
+            if np.isnan(im[row, col]):
+                im[row, col] = 0.0
+                nnan += 1
+
+    return nnan
+
+
+@njit(nogil=True, cache=True)
+def combine_masks(mask, other):
+    """
+    set mask to 1 in place where other is set
+    """
+    nrows, ncols = mask.shape
+
+    for row in range(nrows):
+        for col in range(ncols):
+            if other[row, col] > 0:
+                mask[row, col] = 1
+
+
+@njit(nogil=True, cache=True)
+def block_average(im, mask, row_factor, col_factor, out, outmask):
+    """
+    average blocks of row_factor x col_factor pixels of the image into out,
+    skipping masked pixels.  The blocks at the ends of the rows and columns
+    can be partial.
+
+    Where all pixels of a block are masked, they are all averaged and the
+    output mask is set, otherwise the output mask is zero.  Send a mask of
+    shape (0, 0) if there is no mask
+    """
+    for orow in range(out.shape[0]):
+        _block_average_row(
+            im, mask, row_factor, col_factor, out, outmask, orow,
+        )
+
+
+@njit(nogil=True, parallel=True, cache=True)
+def block_average_parallel(im, mask, row_factor, col_factor, out, outmask):
+    """
+    Same as block_average but with the output rows processed in parallel
+    """
+    for orow in prange(out.shape[0]):
+        _block_average_row(
+            im, mask, row_factor, col_factor, out, outmask, orow,
+        )
+
+
+@njit(nogil=True, cache=True)
+def _block_average_row(im, mask, row_factor, col_factor, out, outmask, orow):
+    """
+    block average for a single output row
+    """
+    nrows, ncols = im.shape
+    has_mask = mask.shape[0] > 0
+
+    row_start = orow * row_factor
+    row_end = min(row_start + row_factor, nrows)
+
+    for ocol in range(out.shape[1]):
+        col_start = ocol * col_factor
+        col_end = min(col_start + col_factor, ncols)
+
+        vsum = 0.0
+        nsum = 0
+        vsum_all = 0.0
+        nsum_all = 0
+        for row in range(row_start, row_end):
+            for col in range(col_start, col_end):
+                val = im[row, col]
+                vsum_all += val
+                nsum_all += 1
+                if not has_mask or mask[row, col] == 0:
+                    vsum += val
+                    nsum += 1
+
+        if nsum > 0:
+            out[orow, ocol] = vsum / nsum
+            outmask[orow, ocol] = 0
+        else:
+            out[orow, ocol] = vsum_all / nsum_all
+            outmask[orow, ocol] = 1
+
+
+def set_num_threads(nthreads):
+    """
+    set the number of threads used by the parallel kernels.  This is limited
+    to the number of threads numba was configured with, which can be set
+    using the NUMBA_NUM_THREADS environment variable
+    """
+    nthreads = max(1, min(int(nthreads), numba.config.NUMBA_NUM_THREADS))
+    numba.set_num_threads(nthreads)
+
+
+def warmup(parallel=True):
+    """
+    compile the kernels for the usual array types by calling them on a small
+    image, so the compilation is not done while making the first real image.
+    If the compiled kernels are in the on-disk cache they are just loaded
+
+    parameters
+    ----------
+    parallel: bool, optional
+        If True, also compile the parallel kernels, default True
+    """
+    im = np.ones((4, 4), dtype="f4")
+    mask = np.zeros((4, 4), dtype="i4")
+    scales = np.ones(3)
+    colorim = np.zeros((4, 4, 3), dtype="f4")
+    bytes_colorim = np.zeros((4, 4, 3), dtype="u1")
+    last_good = np.zeros(4, dtype="f4")
+    have_good = np.zeros(4, dtype="bool")
+    table = stretch_mod.get_table()
+
+    kernel_sets = [
+        (
+            get_color_image,
+            get_color_image_bytes,
+            interpolate_bad,
+            interpolate_bad_strip,
+            propagate_missing_data,
+            block_average,
+        ),
+        (
+            get_color_image_parallel,
+            get_color_image_bytes_parallel,
+            interpolate_bad_parallel,
+            interpolate_bad_strip_parallel,
+            propagate_missing_data_parallel,
+            block_average_parallel,
+        ),
+    ]
+
+    if not parallel:
+        kernel_sets = kernel_sets[:1]
+
+    block_im = np.zeros((2, 2), dtype="f4")
+    block_mask = np.zeros((2, 2), dtype="i4")
+    for kernels in kernel_sets:
+        (
+            color, color_bytes, interp, interp_strip, propagate, block,
+        ) = kernels
+
+        color(im, im, im, table, scales, colorim)
+        color_bytes(im, im, im, table, scales, bytes_colorim, True)
+        interp(im, mask)
+        interp_strip(im, mask, last_good, have_good)
+        propagate(im, im, im, mask)
+        block(im, mask, 2, 2, block_im, block_mask)
+
+    zero_nans(im)
+    combine_masks(mask, mask)
 
 
 def bytescale(im):
@@ -129,16 +526,7 @@ def boost(a, factor):
     if factor < 1:
         raise ValueError("boost factor must be >= 1")
 
-    newshape = np.array(a.shape) * factor
-
-    slices = [
-        slice(0, old, float(old) / new) for old, new in zip(a.shape, newshape)
-    ]
-    coordinates = np.mgrid[slices]
-
-    # choose the biggest smaller integer index
-    indices = coordinates.astype("i")
-    return a[tuple(indices)]
+    return a.repeat(factor, axis=0).repeat(factor, axis=1)
 
 
 def rebin(im, factor, dtype=None):
@@ -154,21 +542,23 @@ def rebin(im, factor, dtype=None):
             "divisible by factor (%d)" % (s[0], s[1], factor)
         )
 
-    newshape = np.array(s) / factor
-    if dtype is None:
-        a = im
-    else:
-        a = im.astype(dtype)
-
-    return (
-        a.reshape(
-            newshape[0],
-            factor,
-            newshape[1],
-            factor,
-        )
-        .sum(1)
-        .sum(2)
-        / factor
-        / factor
-    )
+    newshape = np.array(s) // factor
+
+    # sum in the type of the image, or dtype if sent, and divide in place,
+    # so the only large temporary is the partial sum over rows
+    partial = im.reshape(
+        newshape[0],
+        factor,
+        newshape[1],
+        factor,
+    ).sum(1, dtype=dtype)
+
+    out = partial.sum(2)
+    del partial
+
+    if out.dtype.kind != "f":
+        out = out.astype("f8")
+
+    out /= factor
+    out /= factor
+    return out
@@ -0,0 +1,361 @@
+"""
+timing and memory instrumentation for the stages of making an image
+
+Code marks its stages with
+
+    with instrument.stage("read", band="g") as st:
+        ...
+        st.add(bytes_read=nbytes)
+
+Instrumentation is disabled by default, and stage() then returns a shared
+object that does nothing, so the stages cost a function call.  After
+enable() each stage is logged to the desimage.stages logger with its time,
+bytes read and written and peak memory, and optionally written as a json
+line to a file.
+
+On linux the peak memory is measured for each stage, by resetting the
+process high water mark; elsewhere it is the peak for the process so far.
+
+A profiler can be run around any stage by sending profile hooks to
+enable().  A hook is called with the stage name and returns a context
+manager, for example
+
+    instrument.enable(profile={"read": instrument.cprofile_hook("read.prof")})
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import contextlib
+
+logger = logging.getLogger("desimage.stages")
+
+PROC_STATUS = "/proc/self/status"
+PROC_CLEAR_REFS = "/proc/self/clear_refs"
+
+
+class Instrument(object):
+    """
+    record the stages
+
+    parameters
+    ----------
+    jsonl_file: string or callable, optional
+        Append a json line for each stage to this file.  If callable, it is
+        called with each record and returns the file name, or None to skip
+        the record
+    profile: dict, optional
+        profile hooks keyed by stage name
+    **context:
+        fields added to every record, e.g. tilename
+    """
+
+    def __init__(self, jsonl_file=None, profile=None, **context):
+        self.jsonl_file = jsonl_file
+        self.profile = profile if profile is not None else {}
+        self.context = context
+
+        self._lock = threading.Lock()
+        self._open_stages = []
+        self._can_reset_peak = _can_reset_peak()
+
+    def stage(self, name, **fields):
+        """
+        get a context manager timing the stage
+        """
+        return _Stage(self, name, fields)
+
+    def set_context(self, **context):
+        """
+        set fields added to every record, replacing the current ones
+        """
+        self.context = context
+
+    def _start(self, stage):
+        with self._lock:
+            if self._can_reset_peak:
+                # fold the peak so far into the open stages before resetting
+                peak = _read_status()[0]
+                for open_stage in self._open_stages:
+                    open_stage.peak = max(open_stage.peak, peak)
+                _reset_peak()
+
+            self._open_stages.append(stage)
+
+    def _finish(self, stage, record):
+        with self._lock:
+            self._open_stages.remove(stage)
+
+            peak, rss = _read_status()
+            if self._can_reset_peak:
+                peak = max(stage.peak, peak)
+
+            record["peak_rss_mb"] = _to_mb(peak)
+            record["rss_mb"] = _to_mb(rss)
+
+            self._write_record(record)
+
+        _log_record(record)
+
+    def _write_record(self, record):
+        fname = self.jsonl_file
+        if callable(fname):
+            fname = fname(record)
+
+        if fname is None:
+            return
+
+        dname = os.path.dirname(fname)
+        if dname != "" and not os.path.exists(dname):
+            os.makedirs(dname)
+
+        with open(fname, "a") as fobj:
+            fobj.write(json.dumps(record) + "\n")
+
+
+class _Stage(object):
+    def __init__(self, instrument, name, fields):
+        self.instrument = instrument
+        self.name = name
+        self.fields = fields
+        self.counts = {}
+        self.peak = 0
+
+        self._hook = None
+        hook = instrument.profile.get(name)
+        if hook is not None:
+            self._hook = hook(name)
+
+    def add(self, **counts):
+        """
+        add to counts such as bytes_read and bytes_written
+        """
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    def __enter__(self):
+        self.instrument._start(self)
+        self._start_time = time.time()
+        self._tm0 = time.perf_counter()
+        if self._hook is not None:
+            self._hook.__enter__()
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        if self._hook is not None:
+            self._hook.__exit__(exception_type, exception_value, traceback)
+
+        seconds = time.perf_counter() - self._tm0
+
+        record = {"stage": self.name, "time": self._start_time}
+        record.update(self.instrument.context)
+        record.update(self.fields)
+        record["seconds"] = seconds
+        record.update(self.counts)
+        if exception_type is not None:
+            record["error"] = repr(exception_value)
+
+        self.instrument._finish(self, record)
+        return False
+
+
+class _NullStage(object):
+    """
+    stands in for a stage when instrumentation is disabled
+    """
+
+    def add(self, **counts):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+_instrument = None
+
+
+def stage(name, **fields):
+    """
+    get a context manager for the stage.  It does nothing if instrumentation
+    is not enabled
+
+    parameters
+    ----------
+    name: string
+        name of the stage, e.g. read
+    **fields:
+        added to the record, e.g. band
+    """
+    if _instrument is None:
+        return _NULL_STAGE
+    return _instrument.stage(name, **fields)
+
+
+def enable(jsonl_file=None, profile=None, **context):
+    """
+    enable instrumentation, replacing any current Instrument
+
+    See Instrument for the parameters
+
+    returns
+    -------
+    instrument: Instrument
+    """
+    global _instrument
+
+    _instrument = Instrument(jsonl_file=jsonl_file, profile=profile, **context)
+    return _instrument
+
+
+def disable():
+    """
+    disable instrumentation
+    """
+    global _instrument
+
+    _instrument = None
+
+
+def is_enabled():
+    return _instrument is not None
+
+
+def set_context(**context):
+    """
+    set the fields added to every record, if instrumentation is enabled
+    """
+    if _instrument is not None:
+        _instrument.set_context(**context)
+
+
+def cprofile_hook(fname):
+    """
+    get a profile hook running cProfile.  The statistics accumulate over
+    the calls to the stage and are written to fname after each
+
+    parameters
+    ----------
+    fname: string
+        file for the statistics, to be read with pstats
+    """
+    import cProfile
+
+    profiler = cProfile.Profile()
+
+    @contextlib.contextmanager
+    def hook(name):
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(fname)
+
+    return hook
+
+
+def setup_logging(level="info"):
+    """
+    send the log messages of the package to stdout, as the scripts do.
+    Calling again only changes the level
+    """
+    package_logger = logging.getLogger("desimage")
+    package_logger.setLevel(getattr(logging, level.upper()))
+
+    if not package_logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        package_logger.addHandler(handler)
+
+
+def _log_record(record):
+    if not logger.isEnabledFor(logging.INFO):
+        return
+
+    extra = [
+        "%s=%s" % (key, value) for key, value in record.items()
+        if key not in ("stage", "time", "seconds", "peak_rss_mb", "rss_mb")
+    ]
+    logger.info(
+        "stage %s: %.3f s, peak %.1f MB %s",
+        record["stage"],
+        record["seconds"],
+        record["peak_rss_mb"],
+        " ".join(extra),
+    )
+
+
+def get_peak_rss_mb():
+    """
+    get the peak resident memory of the process in MB.  On linux this is
+    read from /proc, since the peak from getrusage includes that of the
+    parent process when started with fork and exec
+    """
+    return _to_mb(_read_status()[0])
+
+
+def reset_peak_rss():
+    """
+    reset the peak resident memory to the current value, if supported by
+    the system.  Returns True if it was reset
+    """
+    try:
+        _reset_peak()
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def _can_reset_peak():
+    if not os.path.exists(PROC_CLEAR_REFS):
+        return False
+    try:
+        _reset_peak()
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def _reset_peak():
+    """
+    reset the high water mark of the resident memory, linux only
+    """
+    with open(PROC_CLEAR_REFS, "w") as fobj:
+        fobj.write("5")
+
+
+def _read_status():
+    """
+    get the peak and current resident memory in kB
+    """
+    if os.path.exists(PROC_STATUS):
+        peak, rss = 0, 0
+        with open(PROC_STATUS) as fobj:
+            for line in fobj:
+                if line.startswith("VmHWM:"):
+                    peak = int(line.split()[1])
+                elif line.startswith("VmRSS:"):
+                    rss = int(line.split()[1])
+        return peak, rss
+
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # bytes rather than kB
+        peak = peak // 1024
+    return peak, None
+
+
+def _to_mb(kb):
+    if kb is None:
+        return None
+    return kb / 1024.0
@@ -0,0 +1,501 @@
+"""
+manifest of rendered images for a campaign, kept in an sqlite database
+
+For each output image the manifest records the input files, with their
+sizes and modification times, the rendering parameters, including the
+campaign scales, the output file and the time taken.  Planning a batch run
+is then a query against the manifest rather than a check for each output
+file, and outputs whose inputs or parameters have changed are found as
+stale.  The sizes and modification times of the inputs are compared when
+get_stale is sent a function to get them, for example the stat_files method
+of a transfer.
+
+The manifest can be brought back in sync with the files on disk using
+RenderManifest.reconcile
+"""
+from __future__ import print_function
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from . import files
+
+logger = logging.getLogger(__name__)
+
+# seconds to wait for other processes writing to the database
+TIMEOUT = 60.0
+
+SCHEMA = """
+create table if not exists renders (
+    tilename text not null,
+    bands text not null,
+    image_type text not null,
+    rebin integer not null,
+    output text not null,
+    input_key text not null,
+    params_key text not null,
+    inputs text not null,
+    params text not null,
+    output_size integer,
+    elapsed real,
+    time real,
+    primary key (tilename, bands, image_type, rebin)
+);
+create index if not exists renders_plan
+    on renders (bands, image_type, rebin, params_key);
+"""
+
+
+class RenderManifest(object):
+    """
+    manifest of rendered images for a campaign
+
+    parameters
+    ----------
+    campaign: string
+        campaign, e.g. y6a1_coadd
+    fname: string, optional
+        The database file, default from files.get_manifest_file
+    """
+
+    def __init__(self, campaign, fname=None):
+        if fname is None:
+            fname = files.get_manifest_file(campaign)
+
+        dname = os.path.dirname(fname)
+        if dname != "" and not os.path.exists(dname):
+            os.makedirs(dname)
+
+        self.campaign = campaign
+        self.fname = fname
+        self.conn = sqlite3.connect(fname, timeout=TIMEOUT)
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def record(
+        self,
+        tilename,
+        bands,
+        image_type,
+        output,
+        input_paths,
+        local_files=None,
+        rebin=None,
+        params=None,
+        elapsed=None,
+    ):
+        """
+        record a rendered image
+
+        parameters
+        ----------
+        tilename: string
+            DES coadd tile
+        bands: list
+            bands used
+        image_type: string
+            e.g. jpg
+        output: string
+            output file name
+        input_paths: list
+            paths of the input files from the campaign file list
+        local_files: list, optional
+            local copies of the input files; their size and modification
+            time are recorded and are part of the input key.  The transfers
+            keep the modification times of the archive files
+        rebin: int, optional
+            rebin factor used
+        params: dict, optional
+            rendering parameters, default from get_params
+        elapsed: float, optional
+            time taken to render in seconds
+        """
+        if params is None:
+            params = get_params(rebin=rebin, campaign=self.campaign)
+
+        inputs = []
+        for i, path in enumerate(input_paths):
+            size, mtime = None, None
+            if local_files is not None and os.path.exists(local_files[i]):
+                size, mtime = get_file_identity(local_files[i])
+            inputs.append([path, size, mtime])
+
+        output_size = None
+        if os.path.exists(output):
+            output_size = os.path.getsize(output)
+
+        row = (
+            tilename,
+            _get_bands_string(bands),
+            image_type,
+            _get_rebin(rebin),
+            output,
+            get_input_key(input_paths, identities=[
+                [size, mtime] for path, size, mtime in inputs
+            ]),
+            get_key(params),
+            json.dumps(inputs),
+            json.dumps(params, sort_keys=True),
+            output_size,
+            elapsed,
+            time.time(),
+        )
+        with self.conn:
+            self.conn.execute(
+                "insert or replace into renders values "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                row,
+            )
+
+    def get_input_keys(self, bands, image_type, rebin=None, params=None):
+        """
+        get the input keys of the images rendered with the current
+        parameters
+
+        returns
+        -------
+        input_keys: dict
+            keyed by tilename
+        """
+        if params is None:
+            params = get_params(rebin=rebin, campaign=self.campaign)
+
+        curs = self.conn.execute(
+            "select tilename, input_key from renders "
+            "where bands = ? and image_type = ? and rebin = ? "
+            "and params_key = ?",
+            (
+                _get_bands_string(bands),
+                image_type,
+                _get_rebin(rebin),
+                get_key(params),
+            ),
+        )
+        return dict(curs.fetchall())
+
+    def get_stale(
+        self, flist, tilenames, bands, types, rebin=None, params=None,
+        stat_inputs=None,
+    ):
+        """
+        get the tiles for which any of the image types are missing from the
+        manifest, or were made from different inputs or parameters
+
+        parameters
+        ----------
+        flist: dict
+            The campaign file list
+        tilenames: list
+            tiles to check
+        bands: list
+            bands used
+        types: list
+            image types, e.g. [jpg]
+        rebin: int, optional
+            rebin factor
+        params: dict, optional
+            rendering parameters, default from get_params
+        stat_inputs: function, optional
+            stat_inputs(paths) gets the current [size, mtime] of the files
+            at the paths in the file list, or None for missing files.  If
+            sent, images made from inputs that have since changed are stale.
+            Images recorded without the sizes and times of their inputs,
+            for example by reconcile, are compared by path only
+
+        returns
+        -------
+        stale: list
+            The tilenames to render
+        """
+        if params is None:
+            params = get_params(rebin=rebin, campaign=self.campaign)
+
+        inputs_by_type = [
+            self._get_inputs(bands, image_type, rebin, params)
+            for image_type in types
+        ]
+
+        stale = []
+        for tilename in tilenames:
+            input_paths = get_input_paths(flist, tilename, bands)
+
+            identities = None
+            if stat_inputs is not None:
+                identities = stat_inputs(input_paths)
+
+            for inputs in inputs_by_type:
+                recorded = inputs.get(tilename)
+                if recorded is None or not _inputs_match(
+                    recorded, input_paths, identities,
+                ):
+                    stale.append(tilename)
+                    break
+
+        return stale
+
+    def _get_inputs(self, bands, image_type, rebin, params):
+        """
+        get the inputs recorded for the images rendered with the parameters,
+        keyed by tilename
+        """
+        curs = self.conn.execute(
+            "select tilename, inputs from renders "
+            "where bands = ? and image_type = ? and rebin = ? "
+            "and params_key = ?",
+            (
+                _get_bands_string(bands),
+                image_type,
+                _get_rebin(rebin),
+                get_key(params),
+            ),
+        )
+        return dict(
+            (tilename, json.loads(inputs)) for tilename, inputs in curs
+        )
+
+    def reconcile(
+        self, nthreads=8, flist=None, bands=None, types=None, rebin=None,
+    ):
+        """
+        bring the manifest in sync with the files on disk.  Entries for which
+        the output file is missing or has changed size are removed.
+
+        If flist, bands and types are sent, output files that are on disk
+        but not in the manifest are added, assuming they were made from the
+        current inputs with the current parameters
+
+        The tile directories are scanned in parallel
+
+        parameters
+        ----------
+        nthreads: int, optional
+            number of threads for scanning directories
+        flist: dict, optional
+            The campaign file list
+        bands: list, optional
+            bands used
+        types: list, optional
+            image types, e.g. [jpg]
+        rebin: int, optional
+            rebin factor
+
+        returns
+        -------
+        nremoved, nadded: int
+        """
+        base_dir = files.get_base_dir(self.campaign)
+        if os.path.exists(base_dir):
+            tile_dirs = [
+                entry.path for entry in os.scandir(base_dir)
+                if entry.is_dir()
+            ]
+        else:
+            tile_dirs = []
+
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+            scans = pool.map(_scan_dir, tile_dirs)
+            on_disk = {}
+            for scan in scans:
+                on_disk.update(scan)
+
+        curs = self.conn.execute("select output, output_size from renders")
+        recorded = dict(curs.fetchall())
+
+        removed = [
+            (output,) for output, size in recorded.items()
+            if output not in on_disk
+            or (size is not None and on_disk[output] != size)
+        ]
+        with self.conn:
+            self.conn.executemany(
+                "delete from renders where output = ?", removed,
+            )
+
+        nadded = 0
+        if flist is not None and bands is not None and types is not None:
+            nadded = self._adopt(flist, bands, types, rebin, on_disk, recorded)
+
+        logger.info("removed %d entries, added %d", len(removed), nadded)
+        return len(removed), nadded
+
+    def _adopt(self, flist, bands, types, rebin, on_disk, recorded):
+        """
+        add outputs that are on disk but not in the manifest
+        """
+        tilenames = set(key[0:-2] for key in flist)
+
+        nadded = 0
+        for tilename in sorted(tilenames):
+            try:
+                input_paths = get_input_paths(flist, tilename, bands)
+            except KeyError:
+                continue
+
+            for image_type in types:
+                output = files.get_output_file(
+                    self.campaign, tilename, bands, rebin=rebin,
+                    ext=image_type,
+                )
+                if output in on_disk and output not in recorded:
+                    self.record(
+                        tilename,
+                        bands,
+                        image_type,
+                        output,
+                        input_paths,
+                        rebin=rebin,
+                    )
+                    nadded += 1
+
+        return nadded
+
+
+def get_params(
+    rebin=None, stretch=None, autoscale=False, campaign=None,
+    image_type=None, quality=None, compress_level=None,
+):
+    """
+    get the rendering parameters that affect the output images.  The
+    stretch and autoscale are only included if they are not the defaults,
+    so images recorded before they could be chosen are still current.  If
+    the campaign is sent its scales are included, unless autoscale is set.
+    The encoder settings are included as for get_encoder_params
+    """
+    from . import __version__
+    from .imagemaker import NONLINEAR, NOMINAL_EXPTIME, get_campaign_scales
+    from .stretch import DEFAULT_STRETCH
+
+    params = {
+        "version": __version__,
+        "nonlinear": NONLINEAR,
+        "nominal_exptime": NOMINAL_EXPTIME,
+        "rebin": rebin,
+    }
+    if stretch is not None and stretch != DEFAULT_STRETCH:
+        params["stretch"] = stretch
+    if autoscale:
+        params["autoscale"] = True
+    elif campaign is not None:
+        campaign_scales = get_campaign_scales(campaign)
+        if campaign_scales is not None:
+            params["campaign_scales"] = campaign_scales
+
+    params.update(get_encoder_params(
+        image_type, quality=quality, compress_level=compress_level,
+    ))
+
+    return params
+
+
+def get_encoder_params(image_type, quality=None, compress_level=None):
+    """
+    get the encoder settings that affect an image of the type, for those
+    that are not the defaults
+    """
+    from .stripwriter import DEFAULT_QUALITY, DEFAULT_COMPRESS_LEVEL
+
+    params = {}
+    if image_type in ("jpg", "jpeg", "dzi"):
+        if quality is not None and quality != DEFAULT_QUALITY:
+            params["quality"] = quality
+    elif image_type == "png":
+        if compress_level is not None and (
+            compress_level != DEFAULT_COMPRESS_LEVEL
+        ):
+            params["compress_level"] = compress_level
+    elif image_type in ("tif", "tiff"):
+        # uncompressed by default
+        if compress_level is not None:
+            params["compress_level"] = compress_level
+
+    return params
+
+
+def get_input_paths(flist, tilename, bands):
+    """
+    get the paths of the input files from the campaign file list
+    """
+    return [flist["%s-%s" % (tilename, band)] for band in bands]
+
+
+def get_input_key(input_paths, identities=None):
+    """
+    key identifying a set of input files, from their paths and, if sent,
+    their [size, mtime] identities
+    """
+    if identities is None:
+        return get_key(list(input_paths))
+    return get_key([list(input_paths), list(identities)])
+
+
+def get_file_identity(fname):
+    """
+    get the size and modification time of a file, to the second, which is
+    all rsync keeps
+    """
+    st = os.stat(fname)
+    return st.st_size, int(st.st_mtime)
+
+
+def get_key(data):
+    """
+    hash of json serializable data
+    """
+    text = json.dumps(data, sort_keys=True)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _inputs_match(recorded, input_paths, identities):
+    """
+    check the recorded [path, size, mtime] inputs against the current paths
+    and, if sent, their identities
+    """
+    if [path for path, size, mtime in recorded] != list(input_paths):
+        return False
+
+    if identities is None:
+        return True
+
+    for (path, size, mtime), identity in zip(recorded, identities):
+        if size is None:
+            # not known when recorded
+            continue
+        if identity is None or [size, int(mtime)] != list(identity):
+            return False
+
+    return True
+
+
+def _get_bands_string(bands):
+    return "".join(bands)
+
+
+def _get_rebin(rebin):
+    if rebin is None:
+        return 0
+    return int(rebin)
+
+
+def _scan_dir(dname):
+    """
+    get the sizes of the files in the directory, keyed by path
+    """
+    sizes = {}
+    for entry in os.scandir(dname):
+        if entry.is_file():
+            sizes[entry.path] = entry.stat().st_size
+    return sizes
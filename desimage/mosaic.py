@@ -0,0 +1,670 @@
+"""
+mosaics of many coadd tiles in a single image
+
+The tiles are resampled onto a common TAN projection and stretched with
+the scales used for single tile images, RGBImageMaker._get_scales, so the
+tiles match at the seams.  Each output pixel takes the nearest pixel of the
+tile in which it lies furthest from an edge; ties go to the first tile by
+name, so overlaps are resolved the same way every time.
+
+The output is an uncompressed tiled BigTIFF, created up front and filled in
+through memory maps by worker processes, each making disjoint blocks of the
+output.  The blocks are fixed by block_size, so the result does not depend
+on the number of processes.  Bad pixels are interpolated along the columns
+of each tile from the last good pixel, starting at the last row, so the
+part of a tile needed for a block is read with rows past its end, until
+each column has a good pixel to start from, and cropped after
+interpolating.  This gives the same pixels as
+interpolating the whole tile, except for bad runs longer than
+MAX_READ_MARGIN rows, so there are no seams at the block edges.
+
+The rows of the output run from north to south, as in the single tile
+images.  The ImageDescription tag holds a FITS style TAN WCS for the
+output, as json, with rows counted from the bottom as in the coadds.
+"""
+from __future__ import print_function
+
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+
+from . import images
+from . import bigtiff
+from . import tileindex
+from . import stretch as stretch_mod
+from .imagemaker import (
+    RGBImageMaker,
+    Files,
+    FilesAuto,
+    NONLINEAR,
+    DEFAULT_CAMPAIGN,
+    make_dir,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BLOCK_SIZE = 2048
+
+# number of points along each edge used to find footprints
+EDGE_NPTS = 20
+
+# rows read past the end of the part of a tile needed for a block, so the
+# interpolation of bad pixels starts as for the whole tile.  The margin is
+# doubled, up to MAX_READ_MARGIN, while a column that is bad in the last row
+# of the part has no good pixel in the margin
+READ_MARGIN = 16
+MAX_READ_MARGIN = 1024
+
+
+def make_mosaic(
+    fname,
+    tilenames=None,
+    box=None,
+    campaign=None,
+    bands=None,
+    pixel_scale=None,
+    block_size=DEFAULT_BLOCK_SIZE,
+    tile_size=bigtiff.DEFAULT_TILE_SIZE,
+    njobs=None,
+    transfer=None,
+    clean=True,
+    nfetch=4,
+    stretch=None,
+    source_cache=None,
+):
+    """
+    make a mosaic of tiles as a tiled BigTIFF
+
+    parameters
+    ----------
+    fname: string
+        output file name
+    tilenames: list, optional
+        tiles to include.  Send this or box
+    box: sequence, optional
+        ra_min, ra_max, dec_min, dec_max in degrees.  The mosaic covers the
+        box, using all tiles that overlap it.  ra_min can be larger than
+        ra_max for a box crossing ra=0
+    campaign: string, optional
+        campaign, e.g. y6a1_coadd
+    bands: list, optional
+        bands to use, default g,r,i
+    pixel_scale: float, optional
+        arcsec per pixel, default that of the coadds
+    block_size: int, optional
+        size of the blocks of the output made by each job, a multiple of
+        tile_size, default 2048
+    tile_size: int, optional
+        size of the tiff tiles, default 256
+    njobs: int, optional
+        number of worker processes, default the number of cpus
+    transfer: transfer object, optional
+        used to get the coadd files, default is a transfer.RsyncTransfer
+    clean: bool, optional
+        If True, remove the coadd files when done, default True
+    nfetch: int, optional
+        number of tiles to fetch at once, default 4
+    stretch: string, optional
+        The stretch, e.g. asinh or gamma:2.2, default asinh
+    source_cache: sourcecache.SourceCache, optional
+        If sent, the coadd files are kept in this cache, and with clean they
+        are released to the cache rather than removed.  All files are held
+        while the mosaic is made
+
+    returns
+    -------
+    fname: string
+    """
+    if campaign is None:
+        campaign = DEFAULT_CAMPAIGN
+
+    if bands is None:
+        bands = ["g", "r", "i"]
+
+    if (tilenames is None) == (box is None):
+        raise ValueError("send one of tilenames or box")
+
+    if block_size % tile_size != 0:
+        raise ValueError(
+            "block size %d is not a multiple of the tile size %d" % (
+                block_size, tile_size,
+            )
+        )
+
+    index = tileindex.get_tile_index(campaign)
+    if box is not None:
+        tiles = get_box_tiles(index, box)
+    else:
+        tiles = get_tiles(index, tilenames)
+
+    if tiles.size == 0:
+        raise ValueError("no tiles overlap the box %s" % (box,))
+
+    wcs = get_mosaic_wcs(tiles, box=box, pixel_scale=pixel_scale)
+    nrows, ncols = int(wcs["nrows"]), int(wcs["ncols"])
+    logger.info(
+        "making %d x %d mosaic of %d tiles", nrows, ncols, tiles.size,
+    )
+
+    bboxes = get_tile_bboxes(wcs, tiles)
+    blocks = get_blocks(nrows, ncols, block_size)
+    jobs = []
+    for block in blocks:
+        candidates = _get_candidates(block, bboxes)
+        if len(candidates) > 0:
+            jobs.append((block, candidates))
+
+    ifiles_list = [
+        FilesAuto(
+            campaign, str(tilename), bands=bands, transfer=transfer,
+            source_cache=source_cache,
+        )
+        for tilename in tiles["tilename"]
+    ]
+
+    try:
+        _fetch_all(ifiles_list, nfetch)
+        local_files = [_get_local_files(ifiles) for ifiles in ifiles_list]
+        tile_scales = [_get_tile_scales(lfiles) for lfiles in local_files]
+
+        make_dir(fname)
+        bigtiff.create_tiled(
+            fname,
+            nrows,
+            ncols,
+            tile_size=tile_size,
+            description=json.dumps(get_wcs_header(wcs)),
+        )
+
+        table = stretch_mod.get_table(stretch, NONLINEAR)
+        initargs = (fname, wcs, tiles, local_files, tile_scales, table)
+        if njobs == 1:
+            _init_worker(*initargs)
+            results = map(_make_block, jobs)
+            _report(results, len(jobs))
+        else:
+            with ProcessPoolExecutor(
+                max_workers=njobs,
+                initializer=_init_worker,
+                initargs=initargs,
+            ) as pool:
+                _report(pool.map(_make_block, jobs), len(jobs))
+    finally:
+        if clean:
+            for ifiles in ifiles_list:
+                ifiles.clean()
+
+    logger.info("wrote: %s", fname)
+    return fname
+
+
+def get_tiles(index, tilenames):
+    """
+    get the entries for the tiles from the tile index, sorted by tilename
+    """
+    tilenames = sorted(set(tilenames))
+
+    w, = np.where(np.isin(index.data["tilename"], tilenames))
+    missing = set(tilenames) - set(str(t) for t in index.data["tilename"][w])
+    if missing:
+        raise ValueError(
+            "tiles not in the index: %s" % ", ".join(sorted(missing))
+        )
+
+    return np.sort(index.data[w], order="tilename")
+
+
+def get_box_tiles(index, box):
+    """
+    get the entries for the tiles overlapping the box, sorted by tilename
+
+    parameters
+    ----------
+    index: TileIndex
+        The tile index
+    box: sequence
+        ra_min, ra_max, dec_min, dec_max in degrees
+    """
+    ra_min, ra_max, dec_min, dec_max = box
+    data = index.data
+
+    # two ranges of ra overlap if either contains the start of the other
+    ra_overlap = tileindex._ra_in_range(
+        ra_min, data["ra_min"], data["ra_max"],
+    ) | tileindex._ra_in_range(data["ra_min"], ra_min % 360.0, ra_max % 360.0)
+
+    w, = np.where(
+        ra_overlap
+        & (data["dec_max"] >= dec_min)
+        & (data["dec_min"] <= dec_max)
+    )
+    return np.sort(data[w], order="tilename")
+
+
+def get_mosaic_wcs(tiles, box=None, pixel_scale=None):
+    """
+    get the TAN projection for the mosaic, covering the box if sent,
+    otherwise the tiles
+
+    returns
+    -------
+    wcs: array element
+        with the fields of a tile index entry, including nrows and ncols
+    """
+    if pixel_scale is None:
+        det = tiles["cd1_1"] * tiles["cd2_2"] - tiles["cd1_2"] * tiles["cd2_1"]
+        scale = np.median(np.sqrt(np.abs(det)))
+    else:
+        scale = pixel_scale / 3600.0
+
+    if box is not None:
+        ra, dec = _get_box_points(box)
+        ra_cen, dec_cen = _get_box_center(box)
+    else:
+        ra, dec = _get_tile_points(tiles)
+        ra_cen, dec_cen = _get_mean_position(tiles["crval1"], tiles["crval2"])
+
+    wcs = np.zeros(1, dtype=tileindex.DTYPE)[0]
+    wcs["tilename"] = "mosaic"
+    wcs["crval1"] = ra_cen
+    wcs["crval2"] = dec_cen
+    wcs["crpix1"] = 1.0
+    wcs["crpix2"] = 1.0
+    wcs["cd1_1"] = -scale
+    wcs["cd2_2"] = scale
+
+    row, col = tileindex.sky2pix(wcs, ra, dec)
+    row_min, row_max = np.floor(row.min()), np.ceil(row.max())
+    col_min, col_max = np.floor(col.min()), np.ceil(col.max())
+
+    wcs["crpix1"] = 1.0 - col_min
+    wcs["crpix2"] = 1.0 - row_min
+    wcs["nrows"] = int(row_max - row_min) + 1
+    wcs["ncols"] = int(col_max - col_min) + 1
+
+    return wcs
+
+
+def get_wcs_header(wcs):
+    """
+    get a FITS style WCS header for the mosaic
+    """
+    return {
+        "NAXIS1": int(wcs["ncols"]),
+        "NAXIS2": int(wcs["nrows"]),
+        "CTYPE1": "RA---TAN",
+        "CTYPE2": "DEC--TAN",
+        "CRVAL1": float(wcs["crval1"]),
+        "CRVAL2": float(wcs["crval2"]),
+        "CRPIX1": float(wcs["crpix1"]),
+        "CRPIX2": float(wcs["crpix2"]),
+        "CD1_1": float(wcs["cd1_1"]),
+        "CD1_2": float(wcs["cd1_2"]),
+        "CD2_1": float(wcs["cd2_1"]),
+        "CD2_2": float(wcs["cd2_2"]),
+    }
+
+
+def get_tile_bboxes(wcs, tiles):
+    """
+    get the bounding box of each tile in the output image
+
+    returns
+    -------
+    bboxes: array
+        [row_min, row_max, col_min, col_max] for each tile, in output image
+        rows counted from the top, inclusive
+    """
+    nrows = int(wcs["nrows"])
+
+    bboxes = np.zeros((tiles.size, 4), dtype="i8")
+    for i, tile in enumerate(tiles):
+        ra, dec = _get_tile_points(tile)
+        row, col = tileindex.sky2pix(wcs, ra, dec)
+        out_row = nrows - 1 - row
+        bboxes[i] = [
+            np.floor(out_row.min()) - 1,
+            np.ceil(out_row.max()) + 1,
+            np.floor(col.min()) - 1,
+            np.ceil(col.max()) + 1,
+        ]
+
+    return bboxes
+
+
+def get_blocks(nrows, ncols, block_size):
+    """
+    get the blocks of the output as [row_start, row_end, col_start, col_end]
+    """
+    return [
+        (row, min(row + block_size, nrows), col, min(col + block_size, ncols))
+        for row in range(0, nrows, block_size)
+        for col in range(0, ncols, block_size)
+    ]
+
+
+def make_block(
+    wcs, tiles, local_files, block, candidates, stretch, tile_scales=None,
+):
+    """
+    make the color image for a block of the output
+
+    parameters
+    ----------
+    wcs: array element
+        The mosaic projection
+    tiles: array
+        tile index entries
+    local_files: list
+        dicts of the local files for each tile, with gfile, rfile, ifile,
+        ufile, zfile, campaign and tilename
+    block: sequence
+        [row_start, row_end, col_start, col_end] in the output, rows counted
+        from the top
+    candidates: list
+        indices of tiles that may overlap the block, in order of tilename
+    stretch: StretchTable
+        lookup table for the stretch, from stretch.get_table
+    tile_scales: list, optional
+        (scales, sky_levels) for each tile, as made by make_mosaic.  By
+        default they are found for each tile used
+
+    returns
+    -------
+    colorim: array
+        The byte color image for the block
+    """
+    row_start, row_end, col_start, col_end = block
+    nrows = int(wcs["nrows"])
+
+    out_rows = np.arange(row_start, row_end)
+    cols = np.arange(col_start, col_end)
+    rows, cols = np.meshgrid(nrows - 1 - out_rows, cols, indexing="ij")
+    ra, dec = tileindex.pix2sky(wcs, rows, cols)
+
+    shape = rows.shape
+    best = np.zeros(shape) - 1.0
+    imr = np.zeros(shape)
+    img = np.zeros(shape)
+    imb = np.zeros(shape)
+
+    for itile in candidates:
+        tile = tiles[itile]
+        trow, tcol = tileindex.sky2pix(tile, ra, dec)
+
+        irow = np.floor(trow + 0.5).astype("i8")
+        icol = np.floor(tcol + 0.5).astype("i8")
+        dist = np.minimum(
+            np.minimum(trow, tcol),
+            np.minimum(tile["nrows"] - 1 - trow, tile["ncols"] - 1 - tcol),
+        )
+
+        use = (
+            (irow >= 0) & (irow < tile["nrows"])
+            & (icol >= 0) & (icol < tile["ncols"])
+            & (dist > best)
+        )
+        if not use.any():
+            continue
+
+        irow, icol = irow[use], icol[use]
+        ranges = (
+            slice(int(irow.min()), int(irow.max()) + 1),
+            slice(int(icol.min()), int(icol.max()) + 1),
+        )
+        if tile_scales is None:
+            scales, sky_levels = _get_tile_scales(local_files[itile])
+        else:
+            scales, sky_levels = tile_scales[itile]
+
+        imlist = _read_tile(
+            local_files[itile], ranges, int(tile["nrows"]), sky_levels,
+        )
+
+        irow -= ranges[0].start
+        icol -= ranges[1].start
+
+        # pre-scaled as in the color kernel, which is then sent unit scales
+        imr[use] = imlist[2][irow, icol] * scales[0]
+        img[use] = imlist[1][irow, icol] * scales[1]
+        imb[use] = imlist[0][irow, icol] * scales[2]
+        best[use] = dist[use]
+
+    colorim = np.zeros(shape + (3,), dtype="u1")
+    images.get_color_image_bytes(
+        imr, img, imb, stretch, np.ones(3), colorim, False,
+    )
+    return colorim
+
+
+_worker_state = {}
+
+
+def _init_worker(fname, wcs, tiles, local_files, tile_scales, stretch):
+    # the image maker reports each read, too much for many blocks
+    logging.getLogger("desimage.imagemaker").setLevel(logging.WARNING)
+
+    tiff_tiles, _, _ = bigtiff.memmap_tiles(fname)
+    _worker_state.update(
+        tiff_tiles=tiff_tiles,
+        wcs=wcs,
+        tiles=tiles,
+        local_files=local_files,
+        tile_scales=tile_scales,
+        stretch=stretch,
+    )
+
+
+def _make_block(job):
+    """
+    make a block and write it into the tiff
+    """
+    block, candidates = job
+    state = _worker_state
+
+    colorim = make_block(
+        state["wcs"],
+        state["tiles"],
+        state["local_files"],
+        block,
+        candidates,
+        state["stretch"],
+        tile_scales=state["tile_scales"],
+    )
+
+    tiff_tiles = state["tiff_tiles"]
+    tile_size = tiff_tiles.shape[2]
+
+    row_start, row_end, col_start, col_end = block
+    nrows, ncols = row_end - row_start, col_end - col_start
+    ntile_rows, ntile_cols = bigtiff.get_tile_grid(nrows, ncols, tile_size)
+
+    padded = np.zeros(
+        (ntile_rows * tile_size, ntile_cols * tile_size, 3), dtype="u1",
+    )
+    padded[:nrows, :ncols] = colorim
+
+    trow = row_start // tile_size
+    tcol = col_start // tile_size
+    tiff_tiles[trow:trow + ntile_rows, tcol:tcol + ntile_cols] = (
+        padded.reshape(
+            ntile_rows, tile_size, ntile_cols, tile_size, 3,
+        ).transpose(0, 2, 1, 3, 4)
+    )
+    tiff_tiles.flush()
+
+    return block
+
+
+def _report(results, njobs):
+    for i, block in enumerate(results):
+        logger.info("%d/%d made block %s", i + 1, njobs, block)
+
+
+def _get_tile_scales(local_files):
+    """
+    get the scales for a tile as RGBImageMaker does, and the sky levels to
+    subtract, None unless the scales were set from the sky.  Only the
+    headers are read, or for autoscale a sample of rows
+
+    returns
+    -------
+    scales, sky_levels
+    """
+    maker = RGBImageMaker(Files(**local_files))
+    readers, extras = maker._make_strip_readers()
+    try:
+        # the scales use the exposure times of the g, r, i images
+        maker.imlist = readers
+        scales = maker._get_scales()
+    finally:
+        for reader in readers + extras:
+            if reader is not None:
+                reader.close()
+
+    return scales, maker.sky_levels
+
+
+def _read_tile(local_files, ranges, tile_nrows, sky_levels=None):
+    """
+    read part of a tile as RGBImageMaker does, with the missing data
+    propagated and bad pixels interpolated, and the sky levels subtracted
+    if sent.  Rows past the end of the part are read so the interpolation
+    starts as for the whole tile, see READ_MARGIN
+
+    returns
+    -------
+    imlist: list
+        g, r, i images
+    """
+    row_range, col_range = ranges
+    nrows = row_range.stop - row_range.start
+
+    margin = READ_MARGIN
+    while True:
+        read_stop = min(row_range.stop + margin, tile_nrows)
+        nafter = read_stop - row_range.stop
+
+        maker = RGBImageMaker(
+            Files(**local_files),
+            ranges=(slice(row_range.start, read_stop), col_range),
+        )
+        maker._make_imlist()
+
+        if (
+            read_stop == tile_nrows
+            or margin >= MAX_READ_MARGIN
+            or not _needs_more_rows(maker.imlist, nafter)
+        ):
+            break
+
+        margin *= 2
+
+    imlist = [im.image[:nrows] for im in maker.imlist]
+
+    maker.sky_levels = sky_levels
+    maker._subtract_sky(imlist)
+    return imlist
+
+
+def _needs_more_rows(imlist, nafter):
+    """
+    check for columns that are bad in the last row of the part of the tile,
+    before the nafter rows read past its end, and have no good pixel after it
+    """
+    masks = [im.mask for im in imlist if im.mask is not None]
+    if len(masks) == 0:
+        return False
+
+    # the masks are combined into the first one
+    mask = masks[0]
+    nrows = mask.shape[0] - nafter
+    bad_last = mask[nrows - 1] > 0
+    good_after = (mask[nrows:] == 0).any(axis=0)
+    return bool((bad_last & ~good_after).any())
+
+
+def _get_candidates(block, bboxes):
+    row_start, row_end, col_start, col_end = block
+    w, = np.where(
+        (bboxes[:, 0] < row_end) & (bboxes[:, 1] >= row_start)
+        & (bboxes[:, 2] < col_end) & (bboxes[:, 3] >= col_start)
+    )
+    return list(w)
+
+
+def _fetch_all(ifiles_list, nfetch):
+    with ThreadPoolExecutor(max_workers=nfetch) as pool:
+        list(pool.map(lambda ifiles: ifiles.sync(), ifiles_list))
+
+
+def _get_local_files(ifiles):
+    local_files = {
+        key: ifiles[key]
+        for key in ["gfile", "rfile", "ifile", "ufile", "zfile"]
+    }
+    local_files["campaign"] = ifiles["campaign"]
+    local_files["tilename"] = ifiles["tilename"]
+    return local_files
+
+
+def _get_tile_points(tile):
+    """
+    get ra, dec of points around the edges of the tiles
+    """
+    tiles = np.atleast_1d(tile)
+
+    ras, decs = [], []
+    for tile in tiles:
+        nrows, ncols = tile["nrows"], tile["ncols"]
+        rows = np.linspace(-0.5, nrows - 0.5, EDGE_NPTS)
+        cols = np.linspace(-0.5, ncols - 0.5, EDGE_NPTS)
+        low = np.zeros(EDGE_NPTS) - 0.5
+        edge_rows = np.concatenate([rows, rows, low, low + nrows])
+        edge_cols = np.concatenate([low, low + ncols, cols, cols])
+
+        ra, dec = tileindex.pix2sky(tile, edge_rows, edge_cols)
+        ras.append(ra)
+        decs.append(dec)
+
+    return np.concatenate(ras), np.concatenate(decs)
+
+
+def _get_box_points(box):
+    """
+    get ra, dec of points around the edges of the box
+    """
+    ra_min, ra_max, dec_min, dec_max = box
+    width = (ra_max - ra_min) % 360.0
+
+    ra = ra_min + width * np.linspace(0.0, 1.0, EDGE_NPTS)
+    dec = np.linspace(dec_min, dec_max, EDGE_NPTS)
+    low = np.zeros(EDGE_NPTS)
+
+    return (
+        np.concatenate([ra, ra, low + ra_min, low + ra_min + width]) % 360.0,
+        np.concatenate([low + dec_min, low + dec_max, dec, dec]),
+    )
+
+
+def _get_box_center(box):
+    ra_min, ra_max, dec_min, dec_max = box
+    width = (ra_max - ra_min) % 360.0
+    return (ra_min + 0.5 * width) % 360.0, 0.5 * (dec_min + dec_max)
+
+
+def _get_mean_position(ra, dec):
+    """
+    mean of positions on the sphere, which handles ra wrapping through
+    zero
+    """
+    ra = np.deg2rad(ra)
+    dec = np.deg2rad(dec)
+    x = np.mean(np.cos(dec) * np.cos(ra))
+    y = np.mean(np.cos(dec) * np.sin(ra))
+    z = np.mean(np.sin(dec))
+
+    ra_mean = np.rad2deg(np.arctan2(y, x)) % 360.0
+    dec_mean = np.rad2deg(np.arctan2(z, np.hypot(x, y)))
+    return ra_mean, dec_mean
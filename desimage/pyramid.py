@@ -0,0 +1,179 @@
+"""
+write deep zoom (DZI) tile pyramids
+
+Each zoom level is made by averaging the band images 2x2 and then applying
+the stretch, rather than shrinking the stretched color image
+"""
+from __future__ import print_function
+
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from . import images
+
+logger = logging.getLogger(__name__)
+
+TILE_SIZE = 256
+DZI_NS = "http://schemas.microsoft.com/deepzoom/2008"
+
+
+def write_dzi(
+    fname,
+    imr,
+    img,
+    imb,
+    stretch,
+    scales,
+    colorim=None,
+    tile_size=TILE_SIZE,
+    tile_format="jpg",
+    quality=90,
+    nthreads=1,
+):
+    """
+    write a deep zoom image: the .dzi descriptor and the tiles for every
+    level, in the directory <name>_files next to it
+
+    parameters
+    ----------
+    fname: string
+        name of the .dzi file
+    imr, img, imb: arrays
+        the band images for r, g, b, oriented as for the output image
+    stretch: StretchTable
+        lookup table for the stretch, from stretch.get_table
+    scales: array
+        scales for each band
+    colorim: array, optional
+        the byte color image at full resolution, if already made
+    tile_size: int, optional
+        size of the tiles, default 256
+    tile_format: string, optional
+        format for the tiles, default jpg
+    quality: int, optional
+        jpeg quality, default 90
+    nthreads: int, optional
+        number of threads for stretching and writing tiles, default 1
+    """
+
+    nrows, ncols = imr.shape
+    max_level = get_max_level(nrows, ncols)
+    tile_dir = get_tile_dir(fname)
+
+    if nthreads > 1:
+        kernel = images.get_color_image_bytes_parallel
+    else:
+        kernel = images.get_color_image_bytes
+
+    logger.info("writing pyramid: %s", tile_dir)
+
+    bands = [imr, img, imb]
+    futures = []
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        for level in range(max_level, -1, -1):
+            if level == max_level and colorim is not None:
+                level_im = colorim
+            else:
+                lnrows, lncols = bands[0].shape
+                level_im = np.zeros((lnrows, lncols, 3), dtype="u1")
+                kernel(
+                    bands[0], bands[1], bands[2],
+                    stretch, scales, level_im, False,
+                )
+
+            level_dir = os.path.join(tile_dir, "%d" % level)
+            if not os.path.exists(level_dir):
+                os.makedirs(level_dir)
+
+            for tile_row, tile_col, tile in _get_tiles(level_im, tile_size):
+                tile_file = os.path.join(
+                    level_dir,
+                    "%d_%d.%s" % (tile_col, tile_row, tile_format),
+                )
+                futures.append(
+                    pool.submit(_write_tile, tile_file, tile, quality)
+                )
+
+            if level > 0:
+                bands = [halve(band) for band in bands]
+
+        # raise any errors from writing tiles
+        for future in futures:
+            future.result()
+
+    # the descriptor is written last, so it only exists if all tiles do
+    _write_descriptor(fname, nrows, ncols, tile_size, tile_format)
+
+
+def get_max_level(nrows, ncols):
+    """
+    the highest level, at which the image is full resolution.  Level zero
+    is a single pixel
+    """
+    return (max(nrows, ncols) - 1).bit_length()
+
+
+def get_tile_dir(fname):
+    """
+    directory holding the tiles for the input .dzi file
+    """
+    return "%s_files" % os.path.splitext(fname)[0]
+
+
+def halve(im):
+    """
+    average the image 2x2.  Odd dimensions are padded by repeating the last
+    row or column, so the edge pixels are averaged with themselves
+    """
+    nrows, ncols = im.shape
+
+    if nrows % 2 != 0:
+        im = np.concatenate([im, im[-1:, :]], axis=0)
+    if ncols % 2 != 0:
+        im = np.concatenate([im, im[:, -1:]], axis=1)
+
+    return images.rebin(im, 2)
+
+
+def _get_tiles(im, tile_size):
+    """
+    iterate over tile row, tile column and tile image
+    """
+    nrows, ncols = im.shape[0:2]
+
+    for tile_row, row in enumerate(range(0, nrows, tile_size)):
+        for tile_col, col in enumerate(range(0, ncols, tile_size)):
+            tile = im[row:row + tile_size, col:col + tile_size]
+            yield tile_row, tile_col, tile
+
+
+def _write_tile(fname, tile, quality):
+    from PIL import Image
+
+    kw = {}
+    if fname.endswith(".jpg"):
+        kw["quality"] = quality
+
+    pim = Image.fromarray(np.ascontiguousarray(tile))
+    pim.save(fname, **kw)
+
+
+def _write_descriptor(fname, nrows, ncols, tile_size, tile_format):
+    text = """<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="%(ns)s" TileSize="%(tile_size)d" Overlap="0" Format="%(format)s">
+    <Size Width="%(ncols)d" Height="%(nrows)d"/>
+</Image>
+"""  # noqa
+    text = text % dict(
+        ns=DZI_NS,
+        tile_size=tile_size,
+        format=tile_format,
+        nrows=nrows,
+        ncols=ncols,
+    )
+
+    logger.info("writing: %s", fname)
+    with open(fname, "w") as fobj:
+        fobj.write(text)
@@ -0,0 +1,264 @@
+"""
+cache of rendered images, keyed by a hash of the inputs and the rendering
+parameters
+
+The images are stored under the key in a cache directory, and an sqlite
+database holds their sizes and the time each was last used.  When the total
+size exceeds the limit the least recently used images are removed.  Several
+processes can share the cache; the database serializes the updates and the
+images are moved into place with a rename, so a partial image is never
+seen.
+
+A hit is linked to the output file, or copied if the output is on another
+file system.  The cached images are read only, and writers of output files
+should remove an existing file rather than writing over it, since it may be
+a link into the cache
+"""
+from __future__ import print_function
+
+import os
+import stat
+import time
+import errno
+import shutil
+import sqlite3
+import logging
+import tempfile
+
+from . import files
+from .manifest import get_key
+
+logger = logging.getLogger(__name__)
+
+# 10 GB
+DEFAULT_MAX_BYTES = 10 * 1024**3
+
+# seconds to wait for other processes writing to the database
+TIMEOUT = 60.0
+
+SCHEMA = """
+create table if not exists entries (
+    key text primary key,
+    path text not null,
+    size integer not null,
+    last_used real not null
+);
+create index if not exists entries_lru on entries (last_used);
+"""
+
+
+class RenderCache(object):
+    """
+    size limited cache of rendered images
+
+    parameters
+    ----------
+    dirname: string, optional
+        directory for the cache, default from files.get_render_cache_dir
+    max_bytes: int, optional
+        limit on the total size of the cached images, default 10 GB
+    """
+
+    def __init__(self, dirname=None, max_bytes=DEFAULT_MAX_BYTES):
+        if dirname is None:
+            dirname = files.get_render_cache_dir()
+
+        if not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+
+        self.dirname = dirname
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(
+            os.path.join(dirname, "index.sqlite"),
+            timeout=TIMEOUT,
+            isolation_level=None,
+        )
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def get(self, key, fname):
+        """
+        put the cached image for the key at fname, replacing any existing
+        file
+
+        returns
+        -------
+        True if the image was in the cache
+        """
+        row = self.conn.execute(
+            "select path from entries where key = ?", (key,),
+        ).fetchone()
+        if row is None:
+            return False
+
+        path = os.path.join(self.dirname, row[0])
+        try:
+            _link_or_copy(path, fname)
+        except FileNotFoundError:
+            # removed by another process
+            self._remove_entry(key)
+            return False
+
+        self.conn.execute(
+            "update entries set last_used = ? where key = ?",
+            (time.time(), key),
+        )
+        logger.info("render cache hit: %s", fname)
+        return True
+
+    def put(self, key, fname):
+        """
+        add a copy of the image in fname to the cache under the key, then
+        remove the least recently used images to keep under the size limit
+        """
+        _, ext = os.path.splitext(fname)
+        relpath = os.path.join(key[0:2], key + ext)
+        path = os.path.join(self.dirname, relpath)
+
+        dname = os.path.dirname(path)
+        if not os.path.exists(dname):
+            os.makedirs(dname, exist_ok=True)
+
+        # copy rather than link, so later writes to fname can't change the
+        # cached image
+        fd, tmp_path = tempfile.mkstemp(dir=dname, suffix=".part")
+        os.close(fd)
+        try:
+            shutil.copyfile(fname, tmp_path)
+            os.chmod(tmp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        self.conn.execute(
+            "insert or replace into entries values (?, ?, ?, ?)",
+            (key, relpath, os.path.getsize(path), time.time()),
+        )
+        self.evict()
+
+    def evict(self, max_bytes=None):
+        """
+        remove the least recently used images until the total size is at
+        most max_bytes, default the cache limit
+
+        returns
+        -------
+        nremoved: int
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+
+        self.conn.execute("begin immediate")
+        try:
+            total, = self.conn.execute(
+                "select coalesce(sum(size), 0) from entries",
+            ).fetchone()
+
+            removed = []
+            if total > max_bytes:
+                curs = self.conn.execute(
+                    "select key, path, size from entries order by last_used",
+                )
+                for key, relpath, size in curs:
+                    if total <= max_bytes:
+                        break
+                    removed.append((key, relpath))
+                    total -= size
+
+                self.conn.executemany(
+                    "delete from entries where key = ?",
+                    [(key,) for key, relpath in removed],
+                )
+            self.conn.execute("commit")
+        except BaseException:
+            self.conn.execute("rollback")
+            raise
+
+        # images being linked or copied by other processes are not
+        # affected by the removal
+        for key, relpath in removed:
+            _remove_if_exists(os.path.join(self.dirname, relpath))
+
+        if len(removed) > 0:
+            logger.info("removed %d images from render cache", len(removed))
+
+        return len(removed)
+
+    def get_nbytes(self):
+        """
+        get the total size of the cached images
+        """
+        total, = self.conn.execute(
+            "select coalesce(sum(size), 0) from entries",
+        ).fetchone()
+        return total
+
+    def _remove_entry(self, key):
+        self.conn.execute("delete from entries where key = ?", (key,))
+
+
+def get_render_key(inputs, params):
+    """
+    get the cache key for an image
+
+    parameters
+    ----------
+    inputs: dict
+        identities of the input files, e.g. from get_file_identity
+    params: dict
+        everything else that affects the image, including the image type
+
+    returns
+    -------
+    key: string
+    """
+    return get_key({"inputs": inputs, "params": params})
+
+
+def get_file_identity(fname):
+    """
+    identify a local file by its absolute path, size and modification time
+    """
+    st = os.stat(fname)
+    return [os.path.abspath(fname), st.st_size, st.st_mtime_ns]
+
+
+def _link_or_copy(path, fname):
+    """
+    link the file at path to fname, or copy it if linking is not possible,
+    replacing fname atomically
+    """
+    dname = os.path.dirname(os.path.abspath(fname))
+    fd, tmp_path = tempfile.mkstemp(dir=dname, suffix=".part")
+    os.close(fd)
+    os.remove(tmp_path)
+
+    try:
+        try:
+            os.link(path, tmp_path)
+        except OSError as err:
+            if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            shutil.copyfile(path, tmp_path)
+
+        os.replace(tmp_path, fname)
+    except BaseException:
+        _remove_if_exists(tmp_path)
+        raise
+
+
+def _remove_if_exists(fname):
+    try:
+        os.remove(fname)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,258 @@
+"""
+simple http server for making color cutouts on demand
+
+    GET /cutout?tilename=DES0428-4748&ranges=1000:2000,550:850
+
+The decoded band images are held in a memory bounded ImageCache, so repeated
+cutouts from the same tile do not read the FITS files again.  The cutouts
+are made by a pool of worker threads; the image kernels release the GIL so
+concurrent requests use multiple cores.
+
+query parameters
+----------------
+tilename: required
+    DES coadd tile name
+campaign: optional
+    campaign, default set when starting the server
+bands: optional
+    e.g. g,r,i or u,g,r,i,z, default g,r,i
+ranges: optional
+    e.g. 1000:2000,550:850
+scales: optional
+    relative scales, over-ride campaign settings.  e.g. 1.0,1.2,2.0
+absscale: optional
+    absolute scaling when scales is sent, default 0.03
+boost: optional
+    boost the image by this integer factor
+stretch: optional
+    e.g. asinh or gamma:2.2, default asinh
+autoscale: optional
+    if 1, set the scales from the sky noise of the tile
+type: optional
+    jpg or png, default jpg
+"""
+from __future__ import print_function
+
+import io
+import os
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from . import imagemaker
+from . import images
+from .imagecache import ImageCache, DEFAULT_CACHE_BYTES
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8080
+DEFAULT_ABSSCALE = 0.03
+
+CONTENT_TYPES = {
+    "jpg": "image/jpeg",
+    "png": "image/png",
+}
+
+
+class CutoutServer(ThreadingHTTPServer):
+    """
+    http server for making color cutouts
+
+    parameters
+    ----------
+    address: tuple
+        (host, port) to listen on
+    campaign: string, optional
+        default campaign, e.g. y6a1_coadd
+    cache_bytes: int, optional
+        maximum size of the cache of decoded images
+    cache_dtype: string, optional
+        type for storing images in the cache, f4 or f2, default f4
+    nworkers: int, optional
+        number of cutouts to make at the same time, default the number
+        of cpus
+    locate_files: function, optional
+        function locate_files(campaign, tilename, bands) returning a Files
+        object for the tile.  By default the files are found using the
+        campaign file list and synced if not already present
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address,
+        campaign=None,
+        cache_bytes=DEFAULT_CACHE_BYTES,
+        nworkers=None,
+        locate_files=None,
+        cache_dtype="f4",
+    ):
+        if campaign is None:
+            campaign = imagemaker.DEFAULT_CAMPAIGN
+
+        if nworkers is None:
+            nworkers = os.cpu_count() or 1
+
+        if locate_files is None:
+            locate_files = self._locate_files
+
+        self.campaign = campaign
+        self.image_cache = ImageCache(max_bytes=cache_bytes, dtype=cache_dtype)
+        self.pool = ThreadPoolExecutor(max_workers=nworkers)
+        self.locate_files = locate_files
+        self._sync_lock = threading.Lock()
+
+        ThreadingHTTPServer.__init__(self, address, CutoutHandler)
+
+    def server_close(self):
+        ThreadingHTTPServer.server_close(self)
+        self.pool.shutdown()
+
+    def make_cutout(self, query):
+        """
+        make a cutout for the input query parameters
+
+        parameters
+        ----------
+        query: dict
+            The query parameters, with a single value for each key
+
+        returns
+        -------
+        data, content_type: bytes, string
+        """
+        if "tilename" not in query:
+            raise ValueError("tilename is required")
+
+        tilename = query["tilename"]
+        campaign = query.get("campaign", self.campaign)
+        bands = query.get("bands", "g,r,i").split(",")
+
+        image_type = query.get("type", "jpg")
+        if image_type not in CONTENT_TYPES:
+            raise ValueError("bad type: '%s'" % image_type)
+
+        ranges = query.get("ranges")
+        if ranges is not None:
+            ranges = imagemaker.parse_ranges(ranges)
+
+        scales = query.get("scales")
+        if scales is not None:
+            scales = [float(s) for s in scales.split(",")]
+            if len(scales) != 3:
+                raise ValueError("need a scale for each band")
+
+        absscale = float(query.get("absscale", DEFAULT_ABSSCALE))
+
+        boost = query.get("boost")
+        if boost is not None:
+            boost = int(boost)
+
+        stretch = query.get("stretch")
+        autoscale = query.get("autoscale", "0") == "1"
+
+        ifiles = self.locate_files(campaign, tilename, bands)
+
+        image_maker = imagemaker.RGBImageMaker(
+            ifiles,
+            ranges=ranges,
+            boost=boost,
+            scales=scales,
+            absscale=absscale,
+            image_cache=self.image_cache,
+            stretch=stretch,
+            autoscale=autoscale,
+        )
+        image_maker.make_image()
+
+        data = encode_image(image_maker.colorim, image_type)
+        return data, CONTENT_TYPES[image_type]
+
+    def _locate_files(self, campaign, tilename, bands):
+        ifiles = imagemaker.FilesAuto(campaign, tilename, bands=bands)
+
+        with self._sync_lock:
+            missing = [
+                ifiles.get_coadd_file(band) for band in bands
+                if not os.path.exists(ifiles.get_coadd_file(band))
+            ]
+            if len(missing) > 0:
+                ifiles.sync()
+
+        return ifiles
+
+
+class CutoutHandler(BaseHTTPRequestHandler):
+    """
+    handle GET /cutout requests
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/cutout":
+            self.send_error(404, "unknown path: %s" % url.path)
+            return
+
+        query = dict(
+            (key, vals[-1]) for key, vals in parse_qs(url.query).items()
+        )
+
+        future = self.server.pool.submit(self.server.make_cutout, query)
+        try:
+            data, content_type = future.result()
+        except (ValueError, TypeError) as err:
+            self.send_error(400, str(err))
+            return
+        except (KeyError, IOError, OSError) as err:
+            self.send_error(404, str(err))
+            return
+        except Exception as err:
+            self.send_error(500, str(err))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def encode_image(colorim, image_type):
+    """
+    encode the color image as jpg or png and return the bytes
+    """
+    from PIL import Image
+
+    kw = {}
+    if image_type == "jpg":
+        kw["format"] = "JPEG"
+        kw["quality"] = 90
+    else:
+        kw["format"] = image_type.upper()
+
+    buff = io.BytesIO()
+    Image.fromarray(colorim).save(buff, **kw)
+    return buff.getvalue()
+
+
+def serve(host="localhost", port=DEFAULT_PORT, **kw):
+    """
+    run a cutout server until interrupted.  Extra keywords are sent to
+    CutoutServer
+    """
+
+    # compile the kernels before taking requests
+    images.warmup()
+
+    server = CutoutServer((host, port), **kw)
+    logger.info("serving cutouts on %s:%d", host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,167 @@
+"""
+sky level and noise of coadd images estimated from a sample of pixels
+
+Only a set of evenly spaced rows of the image and mask is read.  For tile
+compressed images each row is decompressed separately, so this costs a few
+percent of a full read.  Masked pixels, NaN and pixels that are exactly
+zero, which mark missing data, are skipped.
+
+The sky level is the median of the sample and the noise is from the median
+absolute deviation, after one pass of clipping to reduce the effect of
+bright objects
+"""
+from __future__ import print_function
+
+import numpy as np
+import fitsio
+
+DEFAULT_NROWS = 64
+DEFAULT_COL_STEP = 4
+
+# converts the median absolute deviation to a standard deviation for
+# gaussian noise
+MAD_TO_SIGMA = 1.4826
+
+CLIP_NSIGMA = 3.0
+
+# fewest unmasked pixels needed for an estimate
+MIN_NPIX = 100
+
+
+def read_sample(
+    fname, image_ext=1, nrows=DEFAULT_NROWS, col_step=DEFAULT_COL_STEP,
+):
+    """
+    read evenly spaced rows of an image and its mask, if present
+
+    parameters
+    ----------
+    fname: string
+        The fits file name
+    image_ext: int or string, optional
+        HDU with the image, default 1
+    nrows: int, optional
+        number of rows to read, default 64
+    col_step: int, optional
+        keep every col_step column of the rows, default 4
+
+    returns
+    -------
+    image, mask: arrays
+        The sampled pixels, mask is None if there is no mask
+    header: FITSHDR
+        The image header
+    """
+    with fitsio.FITS(fname) as fits:
+        hdu = fits[image_ext]
+        dims = hdu.get_dims()
+        rows = get_sample_rows(dims[0], nrows)
+
+        has_mask = "msk" in fits
+
+        image = []
+        mask = [] if has_mask else None
+        for row in rows:
+            image.append(hdu[row:row + 1, :][0, ::col_step])
+            if has_mask:
+                mask.append(fits["msk"][row:row + 1, :][0, ::col_step])
+
+        header = hdu.read_header()
+
+    image = np.array(image)
+    if has_mask:
+        mask = np.array(mask)
+
+    return image, mask, header
+
+
+def get_sample_rows(nrows_total, nrows):
+    """
+    get evenly spaced rows, avoiding the edges
+    """
+    nrows = min(nrows, nrows_total)
+    step = nrows_total / float(nrows)
+    return (step * (np.arange(nrows) + 0.5)).astype("i8")
+
+
+def get_sky_stats(image, mask=None):
+    """
+    get a robust estimate of the sky level and noise
+
+    parameters
+    ----------
+    image: array
+        pixel values
+    mask: array, optional
+        pixels with mask > 0 are skipped
+
+    returns
+    -------
+    sky, sigma: float
+    """
+    good = np.isfinite(image) & (image != 0.0)
+    if mask is not None:
+        good &= mask == 0
+
+    vals = image[good]
+    if vals.size < MIN_NPIX:
+        raise ValueError(
+            "too few good pixels for sky statistics: %d" % vals.size
+        )
+
+    sky, sigma = _get_median_mad(vals)
+
+    if sigma > 0:
+        vals = vals[np.abs(vals - sky) < CLIP_NSIGMA * sigma]
+        sky, sigma = _get_median_mad(vals)
+
+    if not sigma > 0:
+        raise ValueError("could not measure the sky noise")
+
+    return float(sky), float(sigma)
+
+
+def get_file_sky_stats(fname, image_ext=1, extra_fname=None, **kw):
+    """
+    get the sky level and noise for an image in a file, sampling rows as in
+    read_sample
+
+    parameters
+    ----------
+    fname: string
+        The fits file name
+    image_ext: int or string, optional
+        HDU with the image, default 1
+    extra_fname: string, optional
+        A file with another image averaged with this one, scaled by the
+        ratio of the exposure times, as for the u and z bands
+    **kw:
+        sent to read_sample
+
+    returns
+    -------
+    sky, sigma: float
+    """
+    image, mask, header = read_sample(fname, image_ext=image_ext, **kw)
+
+    if extra_fname is not None:
+        eimage, emask, eheader = read_sample(
+            extra_fname, image_ext=image_ext, **kw
+        )
+        fac = _get_exptime(header) / _get_exptime(eheader)
+        image = 0.5 * (image + eimage * fac)
+        if emask is not None:
+            mask = emask if mask is None else mask | emask
+
+    return get_sky_stats(image, mask=mask)
+
+
+def _get_median_mad(vals):
+    sky = np.median(vals)
+    sigma = MAD_TO_SIGMA * np.median(np.abs(vals - sky))
+    return sky, sigma
+
+
+def _get_exptime(header):
+    from .imagemaker import NOMINAL_EXPTIME
+    return header.get("exptime", NOMINAL_EXPTIME)
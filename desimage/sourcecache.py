@@ -0,0 +1,268 @@
+"""
+cache of coadd source files, shared by the workers on a node or on a shared
+file system, keyed by the path of the file in the campaign file list
+
+The files are stored under their file list path in the cache directory,
+and an sqlite database holds their sizes and the time each was last used.
+When the total size exceeds the limit the least recently used files that
+are not in use are removed.
+
+Each file has a lock file next to it.  A file is fetched holding an
+exclusive lock, so concurrent workers wait for one fetch rather than each
+fetching the file, and it is fetched to a temporary name and renamed into
+place, so a partial file is never seen.  While in use, between acquire()
+and release(), a shared lock is held, which keeps the file from being
+removed.  The locks are dropped when a process exits, so a failed worker
+does not keep files in the cache.  The lock files are never removed, since
+a process could otherwise lock a file that has been replaced
+"""
+from __future__ import print_function
+
+import os
+import time
+import fcntl
+import sqlite3
+import logging
+import tempfile
+import threading
+
+from . import files
+
+logger = logging.getLogger(__name__)
+
+# 100 GB
+DEFAULT_MAX_BYTES = 100 * 1024**3
+
+# seconds to wait for other processes writing to the database
+TIMEOUT = 60.0
+
+SCHEMA = """
+create table if not exists entries (
+    path text primary key,
+    size integer not null,
+    last_used real not null
+);
+create index if not exists entries_lru on entries (last_used);
+"""
+
+
+class SourceCache(object):
+    """
+    size limited cache of coadd source files
+
+    parameters
+    ----------
+    dirname: string, optional
+        directory for the cache, default from files.get_source_cache_dir
+    max_bytes: int, optional
+        limit on the total size of the cached files, default 100 GB.  Files
+        in use are not removed, so the limit can be exceeded while they are
+        held
+    """
+
+    def __init__(self, dirname=None, max_bytes=DEFAULT_MAX_BYTES):
+        if dirname is None:
+            dirname = files.get_source_cache_dir()
+
+        if not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+
+        self.dirname = dirname
+        self.max_bytes = max_bytes
+
+        # files are fetched in prefetch threads, so the connection is shared
+        # by threads, serialized by the lock
+        self._lock = threading.Lock()
+        self._held = {}
+        self.conn = sqlite3.connect(
+            os.path.join(dirname, "index.sqlite"),
+            timeout=TIMEOUT,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        release all files held and close the database
+        """
+        with self._lock:
+            held = self._held
+            self._held = {}
+
+        for lock_fobjs in held.values():
+            for lock_fobj in lock_fobjs:
+                lock_fobj.close()
+
+        self.conn.close()
+
+    def get_file(self, path):
+        """
+        get the location in the cache of the file at path in the file list
+        """
+        return os.path.join(self.dirname, path.lstrip("/"))
+
+    def acquire(self, path, fetch):
+        """
+        get the file at path in the file list into the cache if it is not
+        already there, and hold it until release(path) is called
+
+        parameters
+        ----------
+        path: string
+            The path in the file list
+        fetch: function
+            fetch(local_file) puts the file at local_file
+
+        returns
+        -------
+        True if the file was fetched, False if it was in the cache
+        """
+        fname = self.get_file(path)
+
+        dname = os.path.dirname(fname)
+        if not os.path.exists(dname):
+            os.makedirs(dname, exist_ok=True)
+
+        lock_fobj = open(fname + ".lock", "a")
+        try:
+            fetched = False
+            while True:
+                fcntl.flock(lock_fobj, fcntl.LOCK_EX)
+                if not os.path.exists(fname):
+                    _fetch(fname, fetch)
+                    fetched = True
+
+                # the change to a shared lock is not atomic, so the file may
+                # have been removed in between
+                fcntl.flock(lock_fobj, fcntl.LOCK_SH)
+                if os.path.exists(fname):
+                    break
+        except BaseException:
+            lock_fobj.close()
+            raise
+
+        with self._lock:
+            self._held.setdefault(path, []).append(lock_fobj)
+            self.conn.execute(
+                "insert or replace into entries values (?, ?, ?)",
+                (path, os.path.getsize(fname), time.time()),
+            )
+
+        if fetched:
+            self.evict()
+        else:
+            logger.info("source cache hit: %s", fname)
+
+        return fetched
+
+    def release(self, path):
+        """
+        stop holding the file, so it can be removed when the cache is full.
+        Files not held are ignored
+        """
+        with self._lock:
+            lock_fobjs = self._held.get(path)
+            if not lock_fobjs:
+                return
+
+            lock_fobj = lock_fobjs.pop()
+            if len(lock_fobjs) == 0:
+                del self._held[path]
+
+            self.conn.execute(
+                "update entries set last_used = ? where path = ?",
+                (time.time(), path),
+            )
+
+        lock_fobj.close()
+
+    def evict(self, max_bytes=None):
+        """
+        remove the least recently used files not in use until the total size
+        is at most max_bytes, default the cache limit
+
+        returns
+        -------
+        nremoved: int
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+
+        with self._lock:
+            entries = self.conn.execute(
+                "select path, size from entries order by last_used",
+            ).fetchall()
+
+        total = sum(size for path, size in entries)
+
+        nremoved = 0
+        for path, size in entries:
+            if total <= max_bytes:
+                break
+
+            if self._remove_if_unused(path):
+                total -= size
+                nremoved += 1
+
+        if nremoved > 0:
+            logger.info("removed %d files from source cache", nremoved)
+
+        return nremoved
+
+    def get_nbytes(self):
+        """
+        get the total size of the cached files
+        """
+        with self._lock:
+            total, = self.conn.execute(
+                "select coalesce(sum(size), 0) from entries",
+            ).fetchone()
+        return total
+
+    def _remove_if_unused(self, path):
+        """
+        remove the file if no process holds it
+        """
+        fname = self.get_file(path)
+        with open(fname + ".lock", "a") as lock_fobj:
+            try:
+                fcntl.flock(lock_fobj, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+
+            try:
+                os.remove(fname)
+            except FileNotFoundError:
+                pass
+
+            with self._lock:
+                self.conn.execute(
+                    "delete from entries where path = ?", (path,),
+                )
+
+        return True
+
+
+def _fetch(fname, fetch):
+    """
+    fetch to a temporary name and rename, so a partial file is never seen
+    """
+    dname = os.path.dirname(fname)
+    fd, tmp_path = tempfile.mkstemp(dir=dname, suffix=".part")
+    os.close(fd)
+
+    logger.info("fetching into source cache: %s", fname)
+    try:
+        fetch(tmp_path)
+        os.replace(tmp_path, fname)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -0,0 +1,190 @@
+"""
+stretches for the color images
+
+A stretch is a function g(x) of the mean of the scaled band intensities,
+softened by the nonlinear factor, x = I/nonlinear.  Each band is multiplied
+by the same factor
+
+    f(I) = nonlinear * g(I/nonlinear) / I
+
+so the colors are preserved.  The color kernels do not evaluate g; they
+interpolate in a lookup table of the stretched intensity
+
+    S(I) = nonlinear * g(I/nonlinear)
+
+made once for each stretch.  The table has the same number of equally spaced
+points in each factor of two in I, so the kernels find the entry from the
+exponent and mantissa of I without any transcendental functions.  The
+number of points is chosen so the error in the stretched values, which run
+from 0 to 1, is at most the requested tolerance.
+
+Stretches are given by name, optionally with a parameter after a colon,
+e.g. asinh or gamma:2.2
+"""
+from __future__ import print_function
+
+import collections
+import numpy as np
+
+DEFAULT_STRETCH = "asinh"
+
+# maximum error in the stretched values, well below the 1/255 steps of the
+# byte images
+DEFAULT_TOL = 1.0e-6
+
+# The table values, with shape (noctaves, npoints + 1); values[k, j] is S(I)
+# at I = 2**(min_exp + k) * (1 + j/npoints).  Below 2**min_exp the factor is
+# taken to be the constant low, and above the table the constant high; the
+# pixels there are saturated, so the factor is replaced anyway
+StretchTable = collections.namedtuple(
+    "StretchTable", ["values", "min_exp", "low", "high"],
+)
+
+
+def asinh_stretch(x):
+    return np.arcsinh(x)
+
+
+def linear_stretch(x):
+    return x
+
+
+def log_stretch(x):
+    return np.log1p(x)
+
+
+def sqrt_stretch(x):
+    return np.sqrt(x)
+
+
+def gamma_stretch(x, gamma=2.2):
+    return x ** (1.0 / gamma)
+
+
+STRETCHES = {
+    "asinh": asinh_stretch,
+    "linear": linear_stretch,
+    "log": log_stretch,
+    "sqrt": sqrt_stretch,
+    "gamma": gamma_stretch,
+}
+
+_MAX_NPOINTS = 2**16
+_EXP_LIMIT = 200
+_tables = {}
+
+
+def get_table(stretch=None, nonlinear=None, tol=DEFAULT_TOL):
+    """
+    get the lookup table for a stretch, making it the first time
+
+    parameters
+    ----------
+    stretch: string, optional
+        e.g. asinh or gamma:2.2, default asinh
+    nonlinear: float, optional
+        the nonlinear factor, default imagemaker.NONLINEAR
+    tol: float, optional
+        maximum error in the stretched values
+
+    returns
+    -------
+    StretchTable
+    """
+    if stretch is None:
+        stretch = DEFAULT_STRETCH
+
+    if nonlinear is None:
+        from .imagemaker import NONLINEAR
+        nonlinear = NONLINEAR
+
+    key = (stretch, float(nonlinear), float(tol))
+    if key not in _tables:
+        _tables[key] = make_table(get_stretch(stretch), nonlinear, tol=tol)
+
+    return _tables[key]
+
+
+def get_stretch(stretch):
+    """
+    get the function g(x) for a stretch given by name, optionally with a
+    parameter after a colon, e.g. gamma:2.2
+    """
+    name, _, param = stretch.partition(":")
+
+    if name not in STRETCHES:
+        raise ValueError(
+            "bad stretch '%s', should be one of %s" % (
+                stretch, ", ".join(sorted(STRETCHES)),
+            )
+        )
+
+    func = STRETCHES[name]
+    if param == "":
+        return func
+
+    if name != "gamma":
+        raise ValueError("stretch '%s' takes no parameter" % name)
+
+    gamma = float(param)
+    if gamma <= 0:
+        raise ValueError("gamma must be positive, got %g" % gamma)
+
+    return lambda x: func(x, gamma=gamma)
+
+
+def make_table(func, nonlinear, tol=DEFAULT_TOL):
+    """
+    make the lookup table for the stretch g(x) = func(x)
+
+    The stretched values S(I) must increase from zero and reach one.  Below
+    the table the error is at most S(2**min_exp), so min_exp is chosen to
+    make that at most tol; the number of points is doubled until the error
+    of the interpolation is at most tol
+
+    returns
+    -------
+    StretchTable
+    """
+
+    def stretch(intensity):
+        return nonlinear * func(intensity / nonlinear)
+
+    min_exp = 0
+    while stretch(2.0**min_exp) > tol:
+        min_exp -= 1
+        if min_exp < -_EXP_LIMIT:
+            raise ValueError("stretch does not go to zero")
+
+    max_exp = min_exp
+    while stretch(2.0**max_exp) < 1.0:
+        max_exp += 1
+        if max_exp > _EXP_LIMIT:
+            raise ValueError("stretch does not reach one")
+
+    octaves = 2.0 ** np.arange(min_exp, max_exp)
+
+    npoints = 4
+    while True:
+        frac = np.linspace(0.0, 1.0, npoints + 1)
+        values = stretch(octaves[:, np.newaxis] * (1.0 + frac))
+
+        # check between the points
+        sub = (np.arange(npoints)[:, np.newaxis] + np.linspace(0, 1, 9))
+        sub = sub.ravel() / npoints
+        exact = stretch(octaves[:, np.newaxis] * (1.0 + sub))
+        interp = np.array([np.interp(sub, frac, v) for v in values])
+
+        if np.abs(interp - exact).max() <= tol:
+            break
+
+        npoints *= 2
+        if npoints > _MAX_NPOINTS:
+            raise ValueError("could not meet tolerance %g" % tol)
+
+    return StretchTable(
+        values=values,
+        min_exp=min_exp,
+        low=values[0, 0] / 2.0**min_exp,
+        high=values[-1, -1] / 2.0**max_exp,
+    )
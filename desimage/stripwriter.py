@@ -0,0 +1,786 @@
+"""
+writers for RGB images that take the image in strips of rows
+
+The whole image does not need to be in memory.  Rows are sent to write() as
+they are made, in any order, and each block of rows is encoded as soon as
+it is complete.  TIFF blocks are written as they arrive and found through
+the strip offsets.  JPEG and PNG data must be in order, so blocks that
+arrive early are held in a spool file until the blocks before them are
+written.  Strip mode rendering makes the image from the top down, so
+nothing is spooled and each block is in the file once it is encoded.
+Sending the rows in any other order costs up to the size of the encoded
+image in the spool, and the output stops at the first missing block.
+
+JPEG blocks are one row of 16x16 pixel MCUs.  Each is encoded by PIL and
+they are joined with restart markers, which reset the DC prediction, so
+the decoded pixels are the same as for PIL encoding the whole image.
+
+PNG blocks are compressed separately and joined into a single zlib stream.
+The first row of each block is filtered without reference to the row above,
+so the blocks are independent.  By default the filter for each row is chosen
+as by libpng.
+
+encoder settings
+----------------
+quality: jpg quality, default 90
+compress_level: zlib level for png, default 6.  For tiff the strips are
+    deflate compressed at this level if sent, otherwise uncompressed
+"""
+from __future__ import print_function
+
+import io
+import os
+import zlib
+import struct
+import tempfile
+import numpy as np
+
+from .bigtiff import (
+    IMAGE_WIDTH,
+    IMAGE_LENGTH,
+    BITS_PER_SAMPLE,
+    COMPRESSION,
+    PHOTOMETRIC,
+    SAMPLES_PER_PIXEL,
+    PLANAR_CONFIG,
+    SHORT,
+    LONG,
+    LONG8,
+    _pack_values,
+)
+
+DEFAULT_QUALITY = 90
+DEFAULT_COMPRESS_LEVEL = 6
+
+# rows written at once by write_image
+DEFAULT_STRIP_ROWS = 256
+
+# one row of MCUs for 2x2 chroma subsampling
+JPEG_BLOCK_ROWS = 16
+JPEG_MCU_SIZE = 16
+
+PNG_BLOCK_ROWS = 64
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# adaptive chooses the filter for each row
+PNG_FILTERS = {
+    "none": 0, "sub": 1, "up": 2, "average": 3, "paeth": 4, "adaptive": None,
+}
+DEFAULT_PNG_FILTER = "adaptive"
+
+TIFF_ROWS_PER_STRIP = 16
+
+# tiff tags not used in the tiled files
+STRIP_OFFSETS = 273
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+PREDICTOR = 317
+
+TIFF_NONE = 1
+TIFF_DEFLATE = 8
+
+# use BigTIFF if the file could be larger than this
+CLASSIC_TIFF_MAX_BYTES = 2**32 - 2**26
+
+
+class _StripWriter(object):
+    """
+    base class for the writers; subclasses set block_rows and sequential and
+    implement _write_header, _encode_block, _write_block and _write_trailer
+    """
+
+    block_rows = None
+
+    # if True the blocks must be written in order
+    sequential = True
+
+    def __init__(self, fname, nrows, ncols):
+        if nrows < 1 or ncols < 1:
+            raise ValueError("bad image size %d x %d" % (nrows, ncols))
+
+        self.fname = fname
+        self.nrows = nrows
+        self.ncols = ncols
+        self.nblocks = -(-nrows // self.block_rows)
+
+        self._next_row = 0
+        self._partial = {}
+        self._next_block = 0
+        self._nwritten = 0
+        self._held = {}
+        self._spool = None
+
+        # the output may be a link into the render cache, so it is replaced
+        # rather than written over
+        if os.path.exists(fname):
+            os.remove(fname)
+
+        self._fobj = open(fname, "wb")
+        self._write_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        if exception_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, rows, row_start=None):
+        """
+        write rows of the image.  Each row must be sent once
+
+        parameters
+        ----------
+        rows: array
+            uint8 array of shape (n, ncols, 3)
+        row_start: int, optional
+            The image row of the first row sent, default the row after the
+            last ones sent
+        """
+        rows = np.asarray(rows)
+        if rows.dtype != np.uint8 or rows.shape[1:] != (self.ncols, 3):
+            raise ValueError(
+                "rows should be uint8 with shape (n, %d, 3), got %s %s" % (
+                    self.ncols, rows.dtype, rows.shape,
+                )
+            )
+
+        if row_start is None:
+            row_start = self._next_row
+
+        row_end = row_start + rows.shape[0]
+        if row_start < 0 or row_end > self.nrows:
+            raise ValueError(
+                "rows [%d, %d) are outside the image of %d rows" % (
+                    row_start, row_end, self.nrows,
+                )
+            )
+        self._next_row = row_end
+
+        block_rows = self.block_rows
+        for block in range(row_start // block_rows, -(-row_end // block_rows)):
+            block_start = block * block_rows
+            block_end = min(block_start + block_rows, self.nrows)
+
+            start = max(block_start, row_start)
+            end = min(block_end, row_end)
+            part = rows[start - row_start:end - row_start]
+
+            if start == block_start and end == block_end:
+                self._add_block(block, part)
+                continue
+
+            buff, nfilled = self._partial.pop(block, (None, 0))
+            if buff is None:
+                buff = np.zeros(
+                    (block_end - block_start, self.ncols, 3), dtype="u1",
+                )
+
+            buff[start - block_start:end - block_start] = part
+            nfilled += end - start
+            if nfilled == buff.shape[0]:
+                self._add_block(block, buff)
+            else:
+                self._partial[block] = (buff, nfilled)
+
+    def close(self):
+        """
+        finish writing the file
+        """
+        try:
+            if self._nwritten != self.nblocks:
+                raise ValueError(
+                    "only %d of %d blocks of rows were written to %s" % (
+                        self._nwritten, self.nblocks, self.fname,
+                    )
+                )
+            self._write_trailer()
+        except BaseException:
+            self.abort()
+            raise
+
+        self._fobj.close()
+        self._close_spool()
+
+    def abort(self):
+        """
+        close and remove the partial file
+        """
+        self._fobj.close()
+        self._close_spool()
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+    def get_nbytes(self):
+        """
+        get the size of the file written so far
+        """
+        if self._fobj.closed:
+            return os.path.getsize(self.fname)
+        return self._fobj.tell()
+
+    def _add_block(self, block, data):
+        encoded = self._encode_block(block, data)
+
+        if not self.sequential:
+            self._write_block(block, encoded)
+            self._nwritten += 1
+            return
+
+        if block != self._next_block:
+            self._hold(block, encoded)
+            return
+
+        self._write_block(block, encoded)
+        self._nwritten += 1
+        self._next_block += 1
+
+        while self._next_block in self._held:
+            encoded = self._unhold(self._next_block)
+            self._write_block(self._next_block, encoded)
+            self._nwritten += 1
+            self._next_block += 1
+
+    def _hold(self, block, encoded):
+        if self._spool is None:
+            dname = os.path.dirname(os.path.abspath(self.fname))
+            self._spool = tempfile.TemporaryFile(dir=dname)
+
+        self._spool.seek(0, os.SEEK_END)
+        self._held[block] = (self._spool.tell(), len(encoded))
+        self._spool.write(encoded)
+
+    def _unhold(self, block):
+        offset, size = self._held.pop(block)
+        self._spool.seek(offset)
+        return self._spool.read(size)
+
+    def _close_spool(self):
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+
+
+class JPEGStripWriter(_StripWriter):
+    """
+    write a baseline JPEG in strips of rows
+
+    parameters
+    ----------
+    fname: string
+        The output file
+    nrows, ncols: int
+        The image size
+    quality: int, optional
+        jpg quality, default 90
+    """
+
+    block_rows = JPEG_BLOCK_ROWS
+
+    def __init__(self, fname, nrows, ncols, quality=DEFAULT_QUALITY):
+        if quality is None:
+            quality = DEFAULT_QUALITY
+
+        # the restart interval is one row of MCUs
+        self.restart_interval = -(-ncols // JPEG_MCU_SIZE)
+        if self.restart_interval > 0xFFFF:
+            raise ValueError("image too wide for jpg: %d" % ncols)
+
+        self.quality = quality
+        self._header = None
+        super(JPEGStripWriter, self).__init__(fname, nrows, ncols)
+
+    def _write_header(self):
+        # the header is taken from the first block encoded
+        pass
+
+    def _encode_block(self, block, data):
+        from PIL import Image
+
+        buff = io.BytesIO()
+        Image.fromarray(data).save(
+            buff,
+            format="JPEG",
+            quality=self.quality,
+            subsampling=2,
+            optimize=False,
+            progressive=False,
+        )
+        header, scan = _split_jpeg(buff.getvalue())
+        if self._header is None:
+            self._header = _make_jpeg_header(
+                header, self.nrows, self.restart_interval,
+            )
+        return scan
+
+    def _write_block(self, block, scan):
+        if block == 0:
+            self._fobj.write(self._header)
+
+        self._fobj.write(scan)
+        if block < self.nblocks - 1:
+            self._fobj.write(bytes([0xFF, 0xD0 + block % 8]))
+
+    def _write_trailer(self):
+        self._fobj.write(b"\xff\xd9")
+
+
+class PNGStripWriter(_StripWriter):
+    """
+    write an RGB PNG in strips of rows
+
+    parameters
+    ----------
+    fname: string
+        The output file
+    nrows, ncols: int
+        The image size
+    compress_level: int, optional
+        zlib compression level, default 6
+    filter: string, optional
+        row filter, none, sub, up, average, paeth or adaptive to choose
+        the filter for each row, default adaptive
+    """
+
+    block_rows = PNG_BLOCK_ROWS
+
+    def __init__(
+        self, fname, nrows, ncols, compress_level=DEFAULT_COMPRESS_LEVEL,
+        filter=DEFAULT_PNG_FILTER,
+    ):
+        if compress_level is None:
+            compress_level = DEFAULT_COMPRESS_LEVEL
+
+        if filter not in PNG_FILTERS:
+            raise ValueError("bad png filter '%s'" % filter)
+
+        self.compress_level = compress_level
+        self.filter = filter
+        self._adler = 1
+        super(PNGStripWriter, self).__init__(fname, nrows, ncols)
+
+    def _write_header(self):
+        self._fobj.write(PNG_SIGNATURE)
+        # 8 bit RGB, not interlaced
+        ihdr = struct.pack(">IIBBBBB", self.ncols, self.nrows, 8, 2, 0, 0, 0)
+        self._write_chunk(b"IHDR", ihdr)
+
+    def _encode_block(self, block, data):
+        filtered = _png_filter(
+            data.reshape(data.shape[0], self.ncols * 3), self.filter,
+        )
+
+        comp = zlib.compressobj(self.compress_level, zlib.DEFLATED, -15)
+        compressed = comp.compress(filtered) + comp.flush(zlib.Z_FULL_FLUSH)
+
+        # the checksum and length are needed for the checksum of the stream
+        info = struct.pack(">II", zlib.adler32(filtered), filtered.size)
+        return info + compressed
+
+    def _write_block(self, block, encoded):
+        adler, size = struct.unpack(">II", encoded[0:8])
+        self._adler = _adler32_combine(self._adler, adler, size)
+
+        data = encoded[8:]
+        if block == 0:
+            data = _get_zlib_header(self.compress_level) + data
+
+        self._write_chunk(b"IDAT", data)
+
+    def _write_trailer(self):
+        # an empty final block ends the stream
+        comp = zlib.compressobj(self.compress_level, zlib.DEFLATED, -15)
+        data = comp.flush() + struct.pack(">I", self._adler)
+        self._write_chunk(b"IDAT", data)
+        self._write_chunk(b"IEND", b"")
+
+    def _write_chunk(self, ctype, data):
+        crc = zlib.crc32(data, zlib.crc32(ctype))
+        self._fobj.write(struct.pack(">I", len(data)))
+        self._fobj.write(ctype)
+        self._fobj.write(data)
+        self._fobj.write(struct.pack(">I", crc))
+
+
+class TIFFStripWriter(_StripWriter):
+    """
+    write an RGB TIFF in strips of rows.  BigTIFF is used if the file could
+    be larger than 4 GB
+
+    parameters
+    ----------
+    fname: string
+        The output file
+    nrows, ncols: int
+        The image size
+    compress_level: int, optional
+        If sent, the strips are deflate compressed at this zlib level, with
+        the horizontal differencing predictor.  Default uncompressed
+    rows_per_strip: int, optional
+        rows in each tiff strip, default 16
+    """
+
+    sequential = False
+
+    def __init__(
+        self, fname, nrows, ncols, compress_level=None,
+        rows_per_strip=TIFF_ROWS_PER_STRIP,
+    ):
+        self.block_rows = rows_per_strip
+        self.compress_level = compress_level
+        self.bigtiff = nrows * ncols * 3 > CLASSIC_TIFF_MAX_BYTES
+
+        nblocks = -(-nrows // rows_per_strip)
+        self._offsets = np.zeros(nblocks, dtype="u8")
+        self._byte_counts = np.zeros(nblocks, dtype="u8")
+        super(TIFFStripWriter, self).__init__(fname, nrows, ncols)
+
+    def _write_header(self):
+        # the directory offset is filled in when closing
+        if self.bigtiff:
+            self._fobj.write(b"II" + struct.pack("<HHHQ", 43, 8, 0, 0))
+        else:
+            self._fobj.write(b"II" + struct.pack("<HI", 42, 0))
+
+    def _encode_block(self, block, data):
+        if self.compress_level is None:
+            return np.ascontiguousarray(data)
+
+        nrows = data.shape[0]
+        differenced = _difference_rows(data.reshape(nrows, self.ncols * 3))
+        return zlib.compress(differenced, self.compress_level)
+
+    def _write_block(self, block, encoded):
+        self._offsets[block] = self._fobj.tell()
+        self._byte_counts[block] = memoryview(encoded).nbytes
+        self._fobj.write(encoded)
+
+    def _write_trailer(self):
+        fobj = self._fobj
+
+        if self.compress_level is None:
+            compression = TIFF_NONE
+        else:
+            compression = TIFF_DEFLATE
+
+        offset_type = LONG8 if self.bigtiff else LONG
+        entries = [
+            (IMAGE_WIDTH, LONG, [self.ncols]),
+            (IMAGE_LENGTH, LONG, [self.nrows]),
+            (BITS_PER_SAMPLE, SHORT, [8, 8, 8]),
+            (COMPRESSION, SHORT, [compression]),
+            (PHOTOMETRIC, SHORT, [2]),
+            (STRIP_OFFSETS, offset_type, self._offsets),
+            (SAMPLES_PER_PIXEL, SHORT, [3]),
+            (ROWS_PER_STRIP, LONG, [self.block_rows]),
+            (STRIP_BYTE_COUNTS, offset_type, self._byte_counts),
+            (PLANAR_CONFIG, SHORT, [1]),
+        ]
+        if compression == TIFF_DEFLATE:
+            # horizontal differencing
+            entries.append((PREDICTOR, SHORT, [2]))
+
+        # the directory starts on a word boundary
+        if fobj.tell() % 2 != 0:
+            fobj.write(b"\0")
+        ifd_offset = fobj.tell()
+
+        fobj.write(_pack_ifd(entries, ifd_offset, self.bigtiff))
+
+        if self.bigtiff:
+            fobj.seek(8)
+            fobj.write(struct.pack("<Q", ifd_offset))
+        else:
+            fobj.seek(4)
+            fobj.write(struct.pack("<I", ifd_offset))
+
+
+WRITERS = {
+    "jpg": JPEGStripWriter,
+    "jpeg": JPEGStripWriter,
+    "png": PNGStripWriter,
+    "tif": TIFFStripWriter,
+    "tiff": TIFFStripWriter,
+}
+
+
+def get_strip_writer(
+    fname, nrows, ncols, image_type=None, quality=None, compress_level=None,
+):
+    """
+    get a strip writer for the image type
+
+    parameters
+    ----------
+    fname: string
+        The output file
+    nrows, ncols: int
+        The image size
+    image_type: string, optional
+        jpg, png or tiff, default from the file name
+    quality: int, optional
+        jpg quality, default 90
+    compress_level: int, optional
+        zlib level for png, default 6, and for tiff, default uncompressed
+    """
+    if image_type is None:
+        image_type = fname.split(".")[-1]
+
+    image_type = image_type.lower()
+    if image_type not in WRITERS:
+        raise ValueError("no strip writer for image type '%s'" % image_type)
+
+    cls = WRITERS[image_type]
+    if cls is JPEGStripWriter:
+        return cls(fname, nrows, ncols, quality=quality)
+    else:
+        return cls(fname, nrows, ncols, compress_level=compress_level)
+
+
+def write_image(
+    fname, colorim, image_type=None, quality=None, compress_level=None,
+    strip_rows=DEFAULT_STRIP_ROWS,
+):
+    """
+    write a color image held in memory using a strip writer, so no copy of
+    the whole image is made
+
+    parameters
+    ----------
+    fname: string
+        The output file
+    colorim: array
+        uint8 array of shape (nrows, ncols, 3)
+    strip_rows: int, optional
+        rows sent to the writer at once, default 256
+
+    See get_strip_writer for the other parameters
+    """
+    nrows, ncols = colorim.shape[0:2]
+    with get_strip_writer(
+        fname, nrows, ncols, image_type=image_type, quality=quality,
+        compress_level=compress_level,
+    ) as writer:
+        for row_start in range(0, nrows, strip_rows):
+            writer.write(colorim[row_start:row_start + strip_rows])
+
+
+def _split_jpeg(data):
+    """
+    split the jpg data into the segments before the scan, including the scan
+    header, and the entropy coded data of the scan
+    """
+    pos = 2
+    while pos < len(data):
+        marker = data[pos + 1]
+        length, = struct.unpack(">H", data[pos + 2:pos + 4])
+        if marker == 0xDA:
+            scan_start = pos + 2 + length
+            if data[-2:] != b"\xff\xd9":
+                raise ValueError("jpg data does not end with EOI")
+            return data[2:scan_start], data[scan_start:-2]
+        pos += 2 + length
+
+    raise ValueError("no scan found in jpg data")
+
+
+def _make_jpeg_header(header, nrows, restart_interval):
+    """
+    make the file header from the header of a block, setting the image
+    height and adding the restart interval before the scan header
+    """
+    out = [b"\xff\xd8"]
+    pos = 0
+    while pos < len(header):
+        marker = header[pos + 1]
+        length, = struct.unpack(">H", header[pos + 2:pos + 4])
+        segment = header[pos:pos + 2 + length]
+
+        if marker in (0xC0, 0xC1, 0xC2):
+            segment = (
+                segment[0:5] + struct.pack(">H", nrows) + segment[7:]
+            )
+        elif marker == 0xDA:
+            out.append(struct.pack(">HHH", 0xFFDD, 4, restart_interval))
+
+        out.append(segment)
+        pos += 2 + length
+
+    return b"".join(out)
+
+
+def _png_filter(rows, filter):
+    """
+    filter the rows of bytes, adding the filter type at the start of each
+    row.  The first row can't use the row above, so it uses none in place of
+    up and sub in place of average and paeth.  For adaptive, each row uses
+    the filter with the smallest sum of absolute differences, the heuristic
+    used by libpng
+    """
+    nrows, nbytes = rows.shape
+
+    if filter == "adaptive":
+        ftypes = [0, 1, 2, 3, 4]
+    else:
+        ftypes = [PNG_FILTERS[filter]]
+
+    prior = np.zeros_like(rows)
+    prior[1:] = rows[:-1]
+
+    if len(ftypes) == 1:
+        ftype = ftypes[0]
+        first_ftype = FIRST_ROW_FILTERS[ftype]
+
+        out = np.empty((nrows, nbytes + 1), dtype="u1")
+        out[:, 0] = ftype
+        out[:, 1:] = _filter_rows(rows, prior, ftype)
+        out[0, 0] = first_ftype
+        out[0, 1:] = _filter_rows(rows[0:1], prior[0:1], first_ftype)
+        return out
+
+    filtered = np.zeros((len(ftypes), nrows, nbytes + 1), dtype="u1")
+    costs = np.zeros((len(ftypes), nrows))
+    for i, ftype in enumerate(ftypes):
+        filtered[i, :, 0] = ftype
+        filtered[i, :, 1:] = _filter_rows(rows, prior, ftype)
+
+        # the bytes as signed differences
+        diffs = filtered[i, :, 1:].astype("i2")
+        costs[i] = np.minimum(diffs, 256 - diffs).sum(axis=1)
+
+        if FIRST_ROW_FILTERS[ftype] != ftype:
+            costs[i, 0] = np.inf
+
+    best = costs.argmin(axis=0)
+    return filtered[best, np.arange(nrows)]
+
+
+# filters for the first row of a block, which can't use the row above
+FIRST_ROW_FILTERS = {0: 0, 1: 1, 2: 0, 3: 1, 4: 1}
+
+
+def _filter_rows(rows, prior, ftype):
+    """
+    apply a png filter to rows of bytes, given the row above each
+    """
+    if ftype == 0:
+        return rows
+
+    # the same color of the pixel to the left
+    left = np.zeros_like(rows)
+    left[:, 3:] = rows[:, :-3]
+
+    if ftype == 1:
+        return rows - left
+    elif ftype == 2:
+        return rows - prior
+    elif ftype == 3:
+        return rows - ((left.astype("u2") + prior) >> 1).astype("u1")
+
+    # paeth
+    a = left.astype("i2")
+    b = prior.astype("i2")
+    c = np.zeros_like(b)
+    c[:, 3:] = b[:, :-3]
+
+    p = a + b - c
+    pa = np.abs(p - a)
+    pb = np.abs(p - b)
+    pc = np.abs(p - c)
+    pred = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+    return rows - pred.astype("u1")
+
+
+def _difference_rows(rows):
+    """
+    difference each byte of the rows with the same color of the pixel to
+    the left, the tiff horizontal predictor
+    """
+    out = np.empty_like(rows)
+    out[:, 0:3] = rows[:, 0:3]
+    np.subtract(rows[:, 3:], rows[:, :-3], out=out[:, 3:])
+    return out
+
+
+def _get_zlib_header(level):
+    """
+    get the two byte zlib header for deflate with a 32k window
+    """
+    if level < 2:
+        flevel = 0
+    elif level < 6:
+        flevel = 1
+    elif level == 6:
+        flevel = 2
+    else:
+        flevel = 3
+
+    cmf = 0x78
+    flg = flevel << 6
+    flg += 31 - ((cmf << 8) + flg) % 31
+    return bytes([cmf, flg])
+
+
+def _adler32_combine(adler1, adler2, len2):
+    """
+    get the adler32 checksum of two pieces of data from their checksums and
+    the length of the second, as in zlib adler32_combine
+    """
+    base = 65521
+
+    rem = len2 % base
+    sum1 = adler1 & 0xFFFF
+    sum2 = (rem * sum1) % base
+    sum1 += (adler2 & 0xFFFF) + base - 1
+    sum2 += (adler1 >> 16) + (adler2 >> 16) + base - rem
+
+    if sum1 >= base:
+        sum1 -= base
+    if sum1 >= base:
+        sum1 -= base
+    if sum2 >= 2 * base:
+        sum2 -= 2 * base
+    if sum2 >= base:
+        sum2 -= base
+
+    return sum1 | (sum2 << 16)
+
+
+def _pack_ifd(entries, ifd_offset, bigtiff):
+    """
+    pack a tiff image directory followed by the values that do not fit in
+    the entries
+    """
+    if bigtiff:
+        count_fmt, entry_fmt, offset_fmt = "<Q", "<HHQ", "<Q"
+    else:
+        count_fmt, entry_fmt, offset_fmt = "<H", "<HHI", "<I"
+
+    field_size = struct.calcsize(offset_fmt)
+
+    entry_size = struct.calcsize(entry_fmt) + field_size
+    ifd_size = (
+        struct.calcsize(count_fmt) + entry_size * len(entries) + field_size
+    )
+    extra_offset = ifd_offset + ifd_size
+
+    ifd = [struct.pack(count_fmt, len(entries))]
+    extra = []
+    nextra = 0
+    for tag, ftype, values in entries:
+        data = _pack_values(ftype, values)
+
+        if len(data) <= field_size:
+            value_field = data + b"\0" * (field_size - len(data))
+        else:
+            value_field = struct.pack(offset_fmt, extra_offset + nextra)
+            extra.append(data)
+            nextra += len(data)
+
+        ifd.append(struct.pack(entry_fmt, tag, ftype, len(values)))
+        ifd.append(value_field)
+
+    ifd.append(b"\0" * field_size)
+
+    return b"".join(ifd + extra)
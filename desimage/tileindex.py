@@ -0,0 +1,394 @@
+"""
+index of coadd tile footprints, for finding the tile covering a sky
+position
+
+The index is built once per campaign from the WCS in the coadd headers and
+stored as a numpy array next to the coadd file list.  The tiles are sorted by
+their minimum declination so the candidates for a position can be found by
+binary search.
+
+The coadd tiles use the gnomonic (TAN) projection, which is implemented here
+so that the index holds all that is needed to convert positions to pixels.
+"""
+from __future__ import print_function
+
+import os
+import logging
+import numpy as np
+import fitsio
+
+from . import files
+
+logger = logging.getLogger(__name__)
+
+# the bounds are padded by this much, in degrees, so they are sure to
+# contain the tile
+BOUNDS_PAD = 1.0 / 60.0
+
+DTYPE = [
+    ("tilename", "U20"),
+    ("nrows", "i4"),
+    ("ncols", "i4"),
+    ("crval1", "f8"),
+    ("crval2", "f8"),
+    ("crpix1", "f8"),
+    ("crpix2", "f8"),
+    ("cd1_1", "f8"),
+    ("cd1_2", "f8"),
+    ("cd2_1", "f8"),
+    ("cd2_2", "f8"),
+    ("ra_min", "f8"),
+    ("ra_max", "f8"),
+    ("dec_min", "f8"),
+    ("dec_max", "f8"),
+]
+
+
+class TileIndex(object):
+    """
+    find the coadd tiles covering sky positions
+
+    parameters
+    ----------
+    data: array
+        The index data, as made by make_tile_index
+    """
+
+    def __init__(self, data):
+        self.data = np.sort(data, order="dec_min")
+
+        # no tile spans more than this in dec, so candidates for a position
+        # must have dec_min in [dec - max_height, dec]
+        if self.data.size > 0:
+            heights = self.data["dec_max"] - self.data["dec_min"]
+            self.max_height = heights.max()
+        else:
+            self.max_height = 0.0
+
+    def __len__(self):
+        return self.data.size
+
+    def find(self, ra, dec):
+        """
+        find the tiles containing the position
+
+        parameters
+        ----------
+        ra, dec: float
+            position in degrees
+
+        returns
+        -------
+        matches: list of (tilename, row, col)
+            The tiles containing the position and the zero-offset pixel
+            position in each.  They are ordered with the tile in which the
+            position is furthest from an edge first
+        """
+        return [
+            (str(self.data["tilename"][index]), row, col)
+            for index, row, col in self._find(ra, dec)
+        ]
+
+    def get_cutout(self, ra, dec, size):
+        """
+        get the tile and pixel ranges for a cutout centered on the position.
+        The ranges are clipped at the tile edges, so near an edge the
+        cutout is smaller and the position is no longer at its center; the
+        part that is kept is where it would be in the full size cutout
+
+        parameters
+        ----------
+        ra, dec: float
+            position in degrees
+        size: int
+            size of the cutout in pixels
+
+        returns
+        -------
+        tilename, ranges
+            ranges are the row and column slices
+        """
+        matches = self._find(ra, dec)
+        if len(matches) == 0:
+            raise ValueError("no tile contains ra, dec = %g, %g" % (ra, dec))
+
+        index, row, col = matches[0]
+        tile = self.data[index]
+
+        ranges = []
+        for cen, dim in [(row, tile["nrows"]), (col, tile["ncols"])]:
+            start = int(np.floor(cen + 0.5)) - size // 2
+            end = start + size
+            ranges.append(slice(max(start, 0), int(min(end, dim))))
+
+        return str(tile["tilename"]), tuple(ranges)
+
+    def _find(self, ra, dec):
+        """
+        find the tiles containing the position, as for find, but giving the
+        index of each tile in the data rather than its name
+        """
+        data = self.data
+
+        ilo = np.searchsorted(data["dec_min"], dec - self.max_height, "left")
+        ihi = np.searchsorted(data["dec_min"], dec, "right")
+
+        w, = np.where(
+            (dec <= data["dec_max"][ilo:ihi])
+            & _ra_in_range(
+                ra, data["ra_min"][ilo:ihi], data["ra_max"][ilo:ihi],
+            )
+        )
+
+        matches = []
+        for index in w + ilo:
+            tile = data[index]
+            row, col = sky2pix(tile, ra, dec)
+
+            # pixels extend half a pixel either side of their centers
+            if (
+                -0.5 <= row < tile["nrows"] - 0.5
+                and -0.5 <= col < tile["ncols"] - 0.5
+            ):
+                edge_dist = min(
+                    row, col, tile["nrows"] - 1 - row, tile["ncols"] - 1 - col,
+                )
+                matches.append((edge_dist, int(index), row, col))
+
+        matches.sort(reverse=True)
+        return [(index, row, col) for _, index, row, col in matches]
+
+
+_tile_indexes = {}
+
+
+def get_tile_index(campaign):
+    """
+    get the tile index for the campaign, reading it the first time
+    """
+    campaign = campaign.upper()
+    if campaign not in _tile_indexes:
+        _tile_indexes[campaign] = read_tile_index(campaign)
+
+    return _tile_indexes[campaign]
+
+
+def read_tile_index(campaign):
+    """
+    read the tile index for the campaign
+    """
+    fname = files.get_tile_index_file(campaign)
+    logger.info("reading: %s", fname)
+    return TileIndex(np.load(fname))
+
+
+def build_tile_index(campaign, source_dir, band="i"):
+    """
+    build the tile index for a campaign and write it to the location given
+    by files.get_tile_index_file
+
+    parameters
+    ----------
+    campaign: string
+        campaign, e.g. y6a1_coadd
+    source_dir: string
+        directory holding the coadd files at the paths given in the
+        campaign file list, for example a local mirror of the archive
+    band: string, optional
+        band from which to read the WCS, default i
+    """
+    from .imagemaker import get_flist
+
+    flist = get_flist(campaign)
+
+    tiles = []
+    suffix = "-%s" % band
+    for key in sorted(flist):
+        if not key.endswith(suffix):
+            continue
+
+        tilename = key[0:-len(suffix)]
+        fname = os.path.join(source_dir, flist[key])
+        tiles.append((tilename, fname))
+
+    data = make_tile_index(tiles)
+
+    index_file = files.get_tile_index_file(campaign)
+    logger.info("writing: %s", index_file)
+    np.save(index_file, data)
+
+
+def make_tile_index(tiles, image_ext=1):
+    """
+    make tile index data
+
+    parameters
+    ----------
+    tiles: list of (tilename, filename)
+        the tiles to index and a coadd file for each
+    image_ext: int or string, optional
+        HDU with the image, default 1
+
+    returns
+    -------
+    data: array
+        The index data, sorted by dec_min
+    """
+    data = np.zeros(len(tiles), dtype=DTYPE)
+
+    for i, (tilename, fname) in enumerate(tiles):
+        with fitsio.FITS(fname) as fits:
+            hdu = fits[image_ext]
+            header = hdu.read_header()
+            nrows, ncols = hdu.get_dims()
+
+        data["tilename"][i] = tilename
+        data["nrows"][i] = nrows
+        data["ncols"][i] = ncols
+        _set_wcs(data[i], header)
+        _set_bounds(data[i])
+
+    data.sort(order="dec_min")
+    return data
+
+
+def sky2pix(tile, ra, dec):
+    """
+    convert a sky position to zero-offset row, column in the tile
+
+    parameters
+    ----------
+    tile: array element
+        An entry in the tile index
+    ra, dec: float or array
+        position in degrees
+
+    returns
+    -------
+    row, col
+    """
+    ra0 = np.deg2rad(tile["crval1"])
+    dec0 = np.deg2rad(tile["crval2"])
+    ra = np.deg2rad(ra)
+    dec = np.deg2rad(dec)
+
+    dra = ra - ra0
+    sindec, cosdec = np.sin(dec), np.cos(dec)
+    sindec0, cosdec0 = np.sin(dec0), np.cos(dec0)
+
+    cosc = sindec * sindec0 + cosdec * cosdec0 * np.cos(dra)
+
+    x = np.rad2deg(cosdec * np.sin(dra) / cosc)
+    y = np.rad2deg((sindec * cosdec0 - cosdec * sindec0 * np.cos(dra)) / cosc)
+
+    # invert the CD matrix
+    det = tile["cd1_1"] * tile["cd2_2"] - tile["cd1_2"] * tile["cd2_1"]
+    px = (tile["cd2_2"] * x - tile["cd1_2"] * y) / det
+    py = (-tile["cd2_1"] * x + tile["cd1_1"] * y) / det
+
+    # FITS pixels are one-offset
+    col = px + tile["crpix1"] - 1
+    row = py + tile["crpix2"] - 1
+    return row, col
+
+
+def pix2sky(tile, row, col):
+    """
+    convert zero-offset row, column in the tile to ra, dec in degrees
+    """
+    px = col + 1 - tile["crpix1"]
+    py = row + 1 - tile["crpix2"]
+
+    xi = np.deg2rad(tile["cd1_1"] * px + tile["cd1_2"] * py)
+    eta = np.deg2rad(tile["cd2_1"] * px + tile["cd2_2"] * py)
+
+    ra0 = np.deg2rad(tile["crval1"])
+    dec0 = np.deg2rad(tile["crval2"])
+
+    denom = np.cos(dec0) - eta * np.sin(dec0)
+    ra = ra0 + np.arctan2(xi, denom)
+    dec = np.arctan2(
+        np.sin(dec0) + eta * np.cos(dec0),
+        np.sqrt(xi**2 + denom**2),
+    )
+
+    return np.rad2deg(ra) % 360.0, np.rad2deg(dec)
+
+
+def _set_wcs(tile, header):
+    ctype1 = header.get("CTYPE1", "RA---TAN").strip()
+    if not ctype1.endswith("TAN"):
+        raise ValueError("only TAN projection is supported, got '%s'" % ctype1)
+
+    for name in ["crval1", "crval2", "crpix1", "crpix2"]:
+        tile[name] = header[name.upper()]
+
+    if "CD1_1" in header:
+        for name in ["cd1_1", "cd1_2", "cd2_1", "cd2_2"]:
+            tile[name] = header.get(name.upper(), 0.0)
+    else:
+        tile["cd1_1"] = header["CDELT1"]
+        tile["cd2_2"] = header["CDELT2"]
+
+
+def _set_bounds(tile):
+    """
+    set the ra, dec bounds from points around the edge of the tile
+    """
+    nrows, ncols = tile["nrows"], tile["ncols"]
+
+    npts = 10
+    rows = np.linspace(-0.5, nrows - 0.5, npts)
+    cols = np.linspace(-0.5, ncols - 0.5, npts)
+    edge_rows = np.concatenate([
+        rows, rows, np.zeros(npts) - 0.5, np.zeros(npts) + nrows - 0.5,
+    ])
+    edge_cols = np.concatenate([
+        np.zeros(npts) - 0.5, np.zeros(npts) + ncols - 0.5, cols, cols,
+    ])
+
+    ra, dec = pix2sky(tile, edge_rows, edge_cols)
+
+    # a tile containing a pole covers all ra
+    pole_row, pole_col = sky2pix(tile, 0.0, 90.0 * np.sign(tile["crval2"]))
+    if (
+        np.abs(tile["crval2"]) > 45
+        and -0.5 <= pole_row < nrows - 0.5
+        and -0.5 <= pole_col < ncols - 0.5
+    ):
+        tile["ra_min"], tile["ra_max"] = 0.0, 360.0
+        if tile["crval2"] > 0:
+            tile["dec_min"], tile["dec_max"] = dec.min() - BOUNDS_PAD, 90.0
+        else:
+            tile["dec_min"], tile["dec_max"] = -90.0, dec.max() + BOUNDS_PAD
+        return
+
+    tile["dec_min"] = max(dec.min() - BOUNDS_PAD, -90.0)
+    tile["dec_max"] = min(dec.max() + BOUNDS_PAD, 90.0)
+
+    # measure ra relative to the center to handle wrapping at zero
+    max_absdec = max(abs(tile["dec_min"]), abs(tile["dec_max"]))
+    cosdec = np.cos(np.deg2rad(max_absdec))
+    ra_pad = min(BOUNDS_PAD / max(cosdec, 1.0e-6), 180.0)
+
+    dra = (ra - tile["crval1"] + 180.0) % 360.0 - 180.0
+    dra_min = dra.min() - ra_pad
+    dra_max = dra.max() + ra_pad
+    if dra_max - dra_min >= 360.0:
+        tile["ra_min"], tile["ra_max"] = 0.0, 360.0
+    else:
+        tile["ra_min"] = (tile["crval1"] + dra_min) % 360.0
+        tile["ra_max"] = (tile["crval1"] + dra_max) % 360.0
+
+
+def _ra_in_range(ra, ra_min, ra_max):
+    """
+    check if ra is in the ranges, which may wrap through zero
+    """
+    ra = ra % 360.0
+
+    return np.where(
+        ra_min <= ra_max,
+        (ra >= ra_min) & (ra <= ra_max),
+        (ra >= ra_min) | (ra <= ra_max),
+    )
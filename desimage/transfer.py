@@ -0,0 +1,315 @@
+"""
+getting the coadd files for a tile, and prefetching the files for upcoming
+tiles while the current one is processed
+
+A transfer is any object with a fetch(ifiles) method that puts the coadd
+files for a FilesAuto object at ifiles.get_local_files().  RsyncTransfer is
+the default; CopyTransfer copies from a local directory.  With a source
+cache the files are fetched one at a time, and the transfer also needs a
+fetch_file(path, local_file) method, which puts the file at path in the
+campaign file list at local_file.  Both transfers keep the modification
+times of the files, and have a stat_files(paths) method giving their sizes
+and modification times, which is used to find images made from inputs that
+have changed.
+"""
+from __future__ import print_function
+
+import os
+import time
+import errno
+import shutil
+import logging
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class RsyncTransfer(object):
+    """
+    rsync the files from $DESREMOTE_RSYNC
+    """
+
+    def fetch(self, ifiles):
+        """
+        sync the coadd images
+        """
+        odir = ifiles.get_temp_dir()
+        if not os.path.exists(odir):
+            os.makedirs(odir)
+
+        remote_url = ifiles.get_remote_coadd_file("g")
+
+        p = "_g,_r,_i"
+
+        if ifiles["ufile"] is not None:
+            p = "_u," + p
+
+        if ifiles["zfile"] is not None:
+            p = p + ",_z"
+
+        p = "{" + p + "}"
+
+        remote_url = remote_url.replace("_g", p)
+        cmd = r"""
+    rsync                                   \
+        -aP                                 \
+        --password-file $DES_RSYNC_PASSFILE \
+        %(remote_url)s \
+        %(local_dir)s/
+        """ % dict(
+            remote_url=remote_url,
+            local_dir=odir,
+        )
+
+        logger.info(cmd)
+        subprocess.check_call(cmd, shell=True)
+
+    def fetch_file(self, path, local_file):
+        """
+        sync a single file, at path in the file list, to local_file
+        """
+        remote_url = os.path.join(
+            os.path.expandvars("$DESREMOTE_RSYNC"), path,
+        )
+        cmd = r"""
+    rsync                                   \
+        -aP                                 \
+        --password-file $DES_RSYNC_PASSFILE \
+        %(remote_url)s \
+        %(local_file)s
+        """ % dict(
+            remote_url=remote_url,
+            local_file=local_file,
+        )
+
+        logger.info(cmd)
+        subprocess.check_call(cmd, shell=True)
+
+    def stat_files(self, paths):
+        """
+        get the [size, mtime] of the files at the paths in the file list,
+        with a single rsync listing.  Missing files get None
+        """
+        remote_urls = [
+            os.path.join(os.path.expandvars("$DESREMOTE_RSYNC"), path)
+            for path in paths
+        ]
+        cmd = r"""
+    rsync                                   \
+        --list-only                         \
+        --password-file $DES_RSYNC_PASSFILE \
+        %(remote_urls)s
+        """ % dict(remote_urls=" ".join(remote_urls))
+
+        proc = subprocess.run(
+            cmd, shell=True, stdout=subprocess.PIPE, universal_newlines=True,
+        )
+        # 23 is a partial transfer, here some files missing
+        if proc.returncode not in (0, 23):
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+        listed = _parse_rsync_listing(proc.stdout)
+        return [listed.get(os.path.basename(path)) for path in paths]
+
+
+class CopyTransfer(object):
+    """
+    copy the files from a local directory, for example a mounted copy of the
+    archive.  The files are found at the paths given in the campaign file
+    list, relative to the source directory
+
+    parameters
+    ----------
+    source_dir: string
+        The directory holding the coadd files
+    """
+
+    def __init__(self, source_dir):
+        self.source_dir = source_dir
+
+    def fetch(self, ifiles):
+        """
+        copy the coadd images
+        """
+        odir = ifiles.get_temp_dir()
+        if not os.path.exists(odir):
+            os.makedirs(odir)
+
+        paths = ifiles.get_input_paths()
+        local_files = ifiles.get_local_files()
+        for path, local_file in zip(paths, local_files):
+            # copy to a temporary name so partial files are never seen
+            tmp_file = local_file + ".part"
+            self.fetch_file(path, tmp_file)
+            os.rename(tmp_file, local_file)
+
+    def fetch_file(self, path, local_file):
+        """
+        copy a single file, at path in the file list, to local_file
+        """
+        source = os.path.join(self.source_dir, path)
+        logger.info("copying %s -> %s", source, local_file)
+        shutil.copy2(source, local_file)
+
+    def stat_files(self, paths):
+        """
+        get the [size, mtime] of the files at the paths in the file list.
+        Missing files get None
+        """
+        identities = []
+        for path in paths:
+            try:
+                st = os.stat(os.path.join(self.source_dir, path))
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+                identities.append(None)
+            else:
+                identities.append([st.st_size, int(st.st_mtime)])
+
+        return identities
+
+
+class Prefetcher(object):
+    """
+    fetch the files for a sequence of tiles in background threads, keeping
+    up to nprefetch tiles ahead of the one being processed
+
+    Call wait(i) before processing tile i and release(i) when done with it.
+
+    parameters
+    ----------
+    ifiles_list: list
+        FilesAuto objects for each tile, in the order they will be processed
+    nprefetch: int, optional
+        number of tiles to fetch ahead, default 2
+    max_bytes: int, optional
+        limit on the bytes of fetched files not yet released.  A new fetch
+        is only started if the largest tile seen so far would fit.  The tile
+        being waited for is always fetched
+    clean: bool, optional
+        If True, remove the files when released, default True
+    """
+
+    def __init__(self, ifiles_list, nprefetch=2, max_bytes=None, clean=True):
+        self.ifiles_list = ifiles_list
+        self.nprefetch = nprefetch
+        self.max_bytes = max_bytes
+        self.clean = clean
+
+        self._pool = ThreadPoolExecutor(max_workers=max(nprefetch, 1))
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._sizes = {}
+        self._next = 0
+        self._max_size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def wait(self, index):
+        """
+        wait for the files of tile index to be fetched, starting the fetch
+        if needed, and start fetching upcoming tiles
+
+        Errors from the fetch are raised here
+        """
+        while self._next <= index:
+            self._submit()
+
+        self._submit_ahead(index)
+        self._futures[index].result()
+
+    def release(self, index):
+        """
+        done with tile index; remove its files if clean is set and start
+        fetching upcoming tiles
+        """
+        future = self._futures.pop(index, None)
+        if future is not None:
+            # a fetch may still be running if wait raised
+            future.cancel()
+            if not future.cancelled():
+                try:
+                    future.result()
+                except Exception:
+                    pass
+
+        with self._lock:
+            self._sizes.pop(index, None)
+
+        if self.clean:
+            self.ifiles_list[index].clean()
+
+        self._submit_ahead(index)
+
+    def close(self):
+        """
+        stop fetching.  Files of tiles not released are not removed
+        """
+        for future in self._futures.values():
+            future.cancel()
+        self._pool.shutdown(wait=True)
+
+    def _submit_ahead(self, index):
+        while (
+            self._next < len(self.ifiles_list)
+            and self._next <= index + self.nprefetch
+            and self._have_room()
+        ):
+            self._submit()
+
+    def _have_room(self):
+        if self.max_bytes is None:
+            return True
+
+        with self._lock:
+            nfetching = len(self._futures) - len(self._sizes)
+            used = sum(self._sizes.values()) + nfetching * self._max_size
+
+            return used + self._max_size <= self.max_bytes
+
+    def _submit(self):
+        index = self._next
+        self._futures[index] = self._pool.submit(self._fetch, index)
+        self._next += 1
+
+    def _fetch(self, index):
+        ifiles = self.ifiles_list[index]
+        ifiles.sync()
+
+        size = sum(
+            os.path.getsize(f) for f in ifiles.get_local_files()
+            if os.path.exists(f)
+        )
+        with self._lock:
+            self._sizes[index] = size
+            self._max_size = max(self._max_size, size)
+
+
+def _parse_rsync_listing(text):
+    """
+    get the [size, mtime] of the files in rsync --list-only output, keyed by
+    file name.  The lines are like
+
+    -rw-r--r--    123,456,789 2019/05/01 12:34:56 DES0000+0209_g.fits.fz
+
+    with the time in the local time zone
+    """
+    listed = {}
+    for line in text.splitlines():
+        fields = line.split(None, 4)
+        if len(fields) != 5 or not fields[0].startswith("-"):
+            continue
+
+        mtime = time.mktime(
+            time.strptime(fields[2] + " " + fields[3], "%Y/%m/%d %H:%M:%S")
+        )
+        listed[fields[4]] = [int(fields[1].replace(",", "")), int(mtime)]
+
+    return listed
@@ -0,0 +1,496 @@
+"""
+long running workers that take tiles from a queue, so the imports and
+kernel compilation are paid once per worker rather than once per tile
+
+The queue is a directory, usually on a shared file system, holding a file
+for each tile in one of the subdirectories
+
+    pending/   waiting to be made
+    claimed/   being made by a worker
+    done/      made
+    failed/    failed; the file holds the error
+
+A worker claims a tile by renaming its file from pending/ to claimed/.  The
+rename is atomic, so only one worker gets each tile.  While the tile is made
+the worker touches the claimed file every HEARTBEAT_INTERVAL seconds, so
+requeue_stale only puts back tiles whose workers have died, as long as its
+max_age is well above the interval.  Workers exit when the queue is empty,
+or when a file named stop is put in the queue directory.
+"""
+from __future__ import print_function
+
+import os
+import time
+import errno
+import signal
+import socket
+import logging
+import threading
+
+from . import files
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+STATES = [PENDING, CLAIMED, DONE, FAILED]
+
+STOP_FILE = "stop"
+
+# seconds between updates of the claimed file while a tile is made
+HEARTBEAT_INTERVAL = 60.0
+
+
+class TileQueue(object):
+    """
+    a queue of tiles kept as files in a directory
+
+    parameters
+    ----------
+    queue_dir: string
+        The queue directory, made if it does not exist
+    """
+
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+
+        # the contents of the claimed file for each tile claimed here, used
+        # to check the claim was not lost to requeue_stale
+        self._claims = {}
+
+        for state in STATES:
+            dname = self._get_dir(state)
+            if not os.path.exists(dname):
+                try:
+                    os.makedirs(dname)
+                except OSError as err:
+                    # another worker may have made it
+                    if err.errno != errno.EEXIST:
+                        raise
+
+    def add(self, tilenames):
+        """
+        add tiles to the queue.  Tiles already pending or claimed are
+        skipped, and those done or failed are queued again
+
+        returns
+        -------
+        nadded: int
+        """
+        nadded = 0
+        for tilename in tilenames:
+            if self._exists(PENDING, tilename) or self._exists(
+                CLAIMED, tilename,
+            ):
+                continue
+
+            for state in [DONE, FAILED]:
+                _remove(self._get_file(state, tilename))
+
+            # write under a temporary name so workers never see a
+            # partial file
+            fname = self._get_file(PENDING, tilename)
+            tmp_file = os.path.join(
+                self.queue_dir, ".%s.%d.tmp" % (tilename, os.getpid()),
+            )
+            with open(tmp_file, "w") as fobj:
+                fobj.write("%s\n" % time.time())
+            os.rename(tmp_file, fname)
+            nadded += 1
+
+        return nadded
+
+    def claim(self):
+        """
+        claim the next pending tile
+
+        returns
+        -------
+        tilename: string or None
+            None if no tiles are pending
+        """
+        for tilename in sorted(os.listdir(self._get_dir(PENDING))):
+            pending_file = self._get_file(PENDING, tilename)
+            claimed_file = self._get_file(CLAIMED, tilename)
+            try:
+                # the rename keeps the time, which would otherwise be when
+                # the tile was added, so requeue_stale could take it back
+                # before the claim is written
+                os.utime(pending_file, None)
+                os.rename(pending_file, claimed_file)
+            except OSError as err:
+                # claimed by another worker
+                if err.errno == errno.ENOENT:
+                    continue
+                raise
+
+            # record who has it, written under a temporary name so the
+            # claimed file always holds either the pending time or the claim
+            claim = "%s %d %s\n" % (
+                socket.gethostname(), os.getpid(), time.time(),
+            )
+            tmp_file = os.path.join(
+                self.queue_dir, ".%s.%d.claim" % (tilename, os.getpid()),
+            )
+            with open(tmp_file, "w") as fobj:
+                fobj.write(claim)
+            os.rename(tmp_file, claimed_file)
+
+            self._claims[tilename] = claim
+            return tilename
+
+        return None
+
+    def heartbeat(self, tilename):
+        """
+        update the time of a tile claimed here, so requeue_stale does not
+        put it back
+
+        returns
+        -------
+        True if the tile is still claimed here
+        """
+        if not self._owns(tilename):
+            return False
+
+        try:
+            os.utime(self._get_file(CLAIMED, tilename), None)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return False
+
+        return True
+
+    def finish(self, tilename):
+        """
+        mark a claimed tile as done
+
+        returns
+        -------
+        True if the tile was marked, False if the claim was lost because the
+        tile was put back in the queue
+        """
+        return self._move_claimed(tilename, DONE)
+
+    def fail(self, tilename, error):
+        """
+        mark a claimed tile as failed, recording the error
+
+        returns
+        -------
+        True if the tile was marked, False if the claim was lost because the
+        tile was put back in the queue
+        """
+        if not self._move_claimed(tilename, FAILED):
+            return False
+
+        with open(self._get_file(FAILED, tilename), "a") as fobj:
+            fobj.write("%r\n" % (error,))
+        return True
+
+    def requeue_stale(self, max_age):
+        """
+        put tiles claimed more than max_age seconds ago back in the queue,
+        for example those claimed by workers that were killed.  Tiles whose
+        claim has not been written yet are given twice as long, since the
+        worker is normally just about to write it
+
+        returns
+        -------
+        tilenames: list
+            the tiles put back
+        """
+        now = time.time()
+        requeued = []
+        for tilename in sorted(os.listdir(self._get_dir(CLAIMED))):
+            fname = self._get_file(CLAIMED, tilename)
+            try:
+                age = now - os.path.getmtime(fname)
+                if age > max_age and not _has_claim(fname):
+                    age *= 0.5
+
+                if age > max_age:
+                    os.rename(fname, self._get_file(PENDING, tilename))
+                    requeued.append(tilename)
+            except OSError as err:
+                # finished in the mean time
+                if err.errno != errno.ENOENT:
+                    raise
+
+        return requeued
+
+    def get_counts(self):
+        """
+        get the number of tiles in each state
+        """
+        return {
+            state: len(os.listdir(self._get_dir(state))) for state in STATES
+        }
+
+    def stop_requested(self):
+        """
+        check for the stop file
+        """
+        return os.path.exists(os.path.join(self.queue_dir, STOP_FILE))
+
+    def _move_claimed(self, tilename, state):
+        """
+        move a tile claimed here to the state.  If it was put back in the
+        queue, or since claimed by another worker, it is left alone
+        """
+        moved = False
+        if self._owns(tilename):
+            try:
+                os.rename(
+                    self._get_file(CLAIMED, tilename),
+                    self._get_file(state, tilename),
+                )
+                moved = True
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+
+        self._claims.pop(tilename, None)
+        if not moved:
+            logger.warning(
+                "lost the claim on %s, it was put back in the queue",
+                tilename,
+            )
+        return moved
+
+    def _owns(self, tilename):
+        """
+        check the tile is claimed, and by this queue object
+        """
+        claim = self._claims.get(tilename)
+        if claim is None:
+            return False
+
+        try:
+            with open(self._get_file(CLAIMED, tilename)) as fobj:
+                return fobj.read() == claim
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return False
+
+    def _exists(self, state, tilename):
+        return os.path.exists(self._get_file(state, tilename))
+
+    def _get_dir(self, state):
+        return os.path.join(self.queue_dir, state)
+
+    def _get_file(self, state, tilename):
+        return os.path.join(self.queue_dir, state, tilename)
+
+
+def get_queue(campaign, queue_dir=None):
+    """
+    get the queue for a campaign, by default in the location given by
+    files.get_queue_dir
+    """
+    if queue_dir is None:
+        queue_dir = files.get_queue_dir(campaign)
+    return TileQueue(queue_dir)
+
+
+def run_worker(
+    queue,
+    campaign=None,
+    types=None,
+    bands=None,
+    nthreads=None,
+    manifest=False,
+    transfer=None,
+    clean=True,
+    idle_timeout=0.0,
+    poll_interval=10.0,
+    max_tiles=None,
+    stretch=None,
+    autoscale=False,
+    render_cache=None,
+    source_cache=None,
+    heartbeat_interval=HEARTBEAT_INTERVAL,
+):
+    """
+    make the images for tiles from the queue until it is empty
+
+    The kernels are compiled, or loaded from the cache, once at the start.
+    On SIGTERM or SIGINT, or when the stop file appears, the worker exits
+    after the current tile
+
+    parameters
+    ----------
+    queue: TileQueue
+        The queue
+    idle_timeout: float, optional
+        Seconds to keep polling an empty queue for new tiles before
+        exiting, default 0
+    poll_interval: float, optional
+        Seconds between polls of an empty queue, default 10
+    max_tiles: int, optional
+        Exit after this many tiles
+    heartbeat_interval: float, optional
+        Seconds between updates of the claimed file while a tile is made,
+        default HEARTBEAT_INTERVAL
+
+    See imagemaker.make_image_auto for the other parameters
+
+    returns
+    -------
+    ndone, nfailed: int
+    """
+    from . import images
+    from . import imagemaker
+
+    if types is None:
+        types = ["jpg"]
+
+    images.warmup(parallel=nthreads is not None and nthreads > 1)
+
+    stopper = _Stopper()
+
+    ndone, nfailed, nlost = 0, 0, 0
+    idle_start = None
+    with stopper:
+        while not stopper.stop and not queue.stop_requested():
+            if max_tiles is not None and ndone + nfailed >= max_tiles:
+                break
+
+            tilename = queue.claim()
+            if tilename is None:
+                if idle_start is None:
+                    idle_start = time.time()
+                if time.time() - idle_start >= idle_timeout:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            idle_start = None
+            logger.info("making %s", tilename)
+            tm0 = time.time()
+            try:
+                with _Heartbeat(queue, tilename, heartbeat_interval):
+                    imagemaker.make_image_auto(
+                        tilename,
+                        campaign=campaign,
+                        type=types,
+                        bands=bands,
+                        nthreads=nthreads,
+                        manifest=manifest,
+                        transfer=transfer,
+                        clean=clean,
+                        stretch=stretch,
+                        autoscale=autoscale,
+                        render_cache=render_cache,
+                        source_cache=source_cache,
+                    )
+            except Exception as err:
+                logger.error("failed %s: %r", tilename, err)
+                if not queue.fail(tilename, err):
+                    nlost += 1
+                nfailed += 1
+            else:
+                logger.info(
+                    "done %s in %.1f seconds", tilename, time.time() - tm0,
+                )
+                if not queue.finish(tilename):
+                    nlost += 1
+                ndone += 1
+
+    logger.info(
+        "worker made %d tiles, %d failed, %d claims lost",
+        ndone, nfailed, nlost,
+    )
+    return ndone, nfailed
+
+
+class _Heartbeat(object):
+    """
+    touch the claimed file of a tile every interval seconds while in use
+    """
+
+    def __init__(self, queue, tilename, interval):
+        self._queue = queue
+        self._tilename = tilename
+        self._interval = interval
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self._done.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._done.wait(self._interval):
+            try:
+                if not self._queue.heartbeat(self._tilename):
+                    logger.warning(
+                        "lost the claim on %s while making it",
+                        self._tilename,
+                    )
+                    return
+            except OSError as err:
+                # try again next time, e.g. after a file system hiccup
+                logger.warning(
+                    "could not update the claim on %s: %r",
+                    self._tilename, err,
+                )
+
+
+class _Stopper(object):
+    """
+    catch SIGTERM and SIGINT while in use, setting the stop flag so the
+    worker can finish the current tile
+    """
+
+    def __init__(self):
+        self.stop = False
+        self._old_handlers = {}
+
+    def __enter__(self):
+        for signum in [signal.SIGTERM, signal.SIGINT]:
+            try:
+                self._old_handlers[signum] = signal.signal(
+                    signum, self._handle,
+                )
+            except ValueError:
+                # not in the main thread
+                pass
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        for signum, handler in self._old_handlers.items():
+            signal.signal(signum, handler)
+
+    def _handle(self, signum, frame):
+        if self.stop:
+            # a second signal stops at once
+            raise KeyboardInterrupt()
+        logger.info("got signal %d, stopping after the current tile", signum)
+        self.stop = True
+
+
+def _remove(fname):
+    try:
+        os.remove(fname)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+
+
+def _has_claim(fname):
+    """
+    check the claimed file holds the claim, host pid time, rather than the
+    time the tile was added
+    """
+    with open(fname) as fobj:
+        return len(fobj.read().split()) == 3
@@ -5,6 +5,12 @@ scripts = [
     'des-make-image',
     'des-make-image-fromfiles',
     'des-make-image-batch',
+    'des-image-server',
+    'des-make-cutout',
+    'des-make-tile-index',
+    'des-image-benchmark',
+    'des-image-worker',
+    'des-make-mosaic',
 ]
 scripts = [os.path.join('bin', s) for s in scripts]
 
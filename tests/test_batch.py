@@ -0,0 +1,135 @@
+import os
+
+import fitsio
+import numpy as np
+
+from desimage import batch, benchmark, files, imagemaker, transfer
+
+
+def test_pack_tiles():
+    tilenames = ["DES%04d-0000" % i for i in range(7)]
+
+    tasks = batch.pack_tiles(tilenames, 3)
+    assert tasks == [tilenames[0:3], tilenames[3:6], tilenames[6:7]]
+
+    assert batch.pack_tiles(tilenames, 1) == [[t] for t in tilenames]
+    assert batch.pack_tiles(tilenames, 10) == [tilenames]
+    assert batch.pack_tiles([], 3) == []
+
+
+def test_get_tiles_per_task():
+    assert batch.get_tiles_per_task(10, 1, 1000) == 1
+    assert batch.get_tiles_per_task(1000, 1, 1000) == 1
+    assert batch.get_tiles_per_task(1001, 1, 1000) == 2
+    assert batch.get_tiles_per_task(50000, 1, 1000) == 50
+    assert batch.get_tiles_per_task(50000, 80, 1000) == 80
+
+
+def _write_slurm(tmp_path, monkeypatch, tilenames, **kw):
+    monkeypatch.setenv("DESDATA", str(tmp_path))
+
+    maker = batch.ScriptMaker("slurm", campaign="y6a1_coadd", **kw)
+    maker._write_slurm(tilenames)
+
+    bands = ["g", "r", "i"]
+    slurm_file = files.get_slurm_file("y6a1_coadd", bands)
+    tiles_file = files.get_slurm_tiles_file("y6a1_coadd", bands)
+    return slurm_file, tiles_file
+
+
+def test_write_slurm(tmp_path, monkeypatch):
+    tilenames = ["DES%04d-0000" % i for i in range(5)]
+
+    slurm_file, tiles_file = _write_slurm(
+        tmp_path, monkeypatch, tilenames, tiles_per_task=2, max_running=3,
+    )
+
+    with open(tiles_file) as fobj:
+        lines = fobj.read().splitlines()
+    assert [line.split() for line in lines] == batch.pack_tiles(tilenames, 2)
+
+    with open(slurm_file) as fobj:
+        text = fobj.read()
+
+    assert "#SBATCH --array=0-2%3\n" in text
+    assert "#SBATCH --time=%d\n" % (2 * batch.SLURM_MINUTES_PER_TILE) in text
+    assert tiles_file in text
+    assert "des-make-image --types=jpg" in text
+    assert os.path.isdir(files.get_slurm_log_dir("y6a1_coadd"))
+
+
+def test_write_slurm_max_array_size(tmp_path, monkeypatch):
+    tilenames = ["DES%04d-0000" % i for i in range(25)]
+
+    slurm_file, tiles_file = _write_slurm(
+        tmp_path, monkeypatch, tilenames, max_array_size=10,
+    )
+
+    with open(tiles_file) as fobj:
+        lines = fobj.read().splitlines()
+    assert len(lines) == 9
+    assert sum(len(line.split()) for line in lines) == 25
+
+    with open(slurm_file) as fobj:
+        text = fobj.read()
+    assert "#SBATCH --array=0-8\n" in text
+    assert "#SBATCH --time=%d\n" % (3 * batch.SLURM_MINUTES_PER_TILE) in text
+
+
+def test_write_slurm_nothing_to_make(tmp_path, monkeypatch):
+    slurm_file, tiles_file = _write_slurm(
+        tmp_path, monkeypatch, ["DES0000-0000"],
+    )
+    assert os.path.exists(slurm_file)
+
+    _write_slurm(tmp_path, monkeypatch, [])
+    assert not os.path.exists(slurm_file)
+    assert not os.path.exists(tiles_file)
+
+
+def _make_archive(tmp_path, monkeypatch, tilenames):
+    """
+    write coadd files for the tiles to an archive directory, and the
+    campaign file list giving their paths in it
+    """
+    monkeypatch.setenv("DESDATA", str(tmp_path / "desdata"))
+    monkeypatch.setattr(imagemaker.FlistCache, "_flists", {})
+
+    source_dir = tmp_path / "archive"
+    keys, paths = [], []
+    for i, tilename in enumerate(tilenames):
+        fnames = benchmark.make_test_files(
+            str(source_dir / tilename), nrows=60, ncols=50,
+            tilename=tilename, seed=i,
+        )
+        for band, fname in sorted(fnames.items()):
+            keys.append("%s-%s" % (tilename, band))
+            paths.append(os.path.relpath(fname, str(source_dir)))
+
+    data = np.zeros(len(keys), dtype=[("key", "S20"), ("path", "S100")])
+    data["key"] = keys
+    data["path"] = paths
+
+    flist_file = files.get_flist_file("y6a1_coadd")
+    os.makedirs(os.path.dirname(flist_file))
+    fitsio.write(flist_file, data)
+
+    return str(source_dir)
+
+
+def test_run_local_transfer(tmp_path, monkeypatch):
+    tilenames = ["DES0000-0000", "DES0001-0000"]
+    source_dir = _make_archive(tmp_path, monkeypatch, tilenames)
+
+    maker = batch.ScriptMaker(
+        "local", campaign="y6a1_coadd", njobs=1,
+        transfer=transfer.CopyTransfer(source_dir),
+    )
+    assert maker.go() == []
+
+    for tilename in tilenames:
+        assert os.path.exists(
+            files.get_output_file(
+                "y6a1_coadd", tilename, ["g", "r", "i"], ext="jpg",
+            )
+        )
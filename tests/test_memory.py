@@ -0,0 +1,43 @@
+import sys
+
+import pytest
+
+from desimage import benchmark, instrument
+
+# peak memory per megapixel of input for a full render of three bands.  The
+# float32 bands take 12 MB per megapixel; a float64 copy of them would add
+# as much again
+MAX_MB_PER_MPIX = 30.0
+
+# in strip mode only strip_rows rows of the bands are in memory at once
+MAX_MB_PER_MPIX_STRIPS = 8.0
+
+NROWS = 2000
+NCOLS = 2000
+
+pytestmark = pytest.mark.skipif(
+    not sys.platform.startswith("linux") or not instrument.reset_peak_rss(),
+    reason="needs the peak memory to be reset after compiling",
+)
+
+
+@pytest.fixture(scope="module")
+def fnames(tmp_path_factory):
+    dirname = str(tmp_path_factory.mktemp("memory"))
+    return benchmark.make_test_files(dirname, nrows=NROWS, ncols=NCOLS, seed=1)
+
+
+def test_memory_full_render(fnames, tmp_path):
+    results = benchmark.measure_memory(fnames, str(tmp_path))
+
+    assert results["npix"] == NROWS * NCOLS
+    assert results["mb_per_mpix"] < MAX_MB_PER_MPIX, results
+
+
+def test_memory_strips(fnames, tmp_path):
+    results = benchmark.measure_memory(
+        fnames, str(tmp_path), strip_rows=100,
+    )
+
+    assert results["npix"] == NROWS * NCOLS
+    assert results["mb_per_mpix"] < MAX_MB_PER_MPIX_STRIPS, results
@@ -0,0 +1,53 @@
+import pytest
+
+from desimage import benchmark, tileindex
+
+NROWS = 200
+NCOLS = 150
+SIZE = 21
+
+
+@pytest.fixture(scope="module")
+def index(tmp_path_factory):
+    dirname = str(tmp_path_factory.mktemp("tileindex"))
+    fnames = benchmark.make_test_files(
+        dirname, nrows=NROWS, ncols=NCOLS, bands="i", compress=False, seed=1,
+    )
+    data = tileindex.make_tile_index([("DES0000+0000", fnames["i"])])
+    return tileindex.TileIndex(data)
+
+
+@pytest.mark.parametrize(
+    "row, col, rows, cols",
+    [
+        # within half a cutout of the bottom, top, left and right edges
+        (3, 75, (0, 14), (65, 86)),
+        (NROWS - 4, 75, (NROWS - 14, NROWS), (65, 86)),
+        (100, 3, (90, 111), (0, 14)),
+        (100, NCOLS - 4, (90, 111), (NCOLS - 14, NCOLS)),
+        # on the corner pixels, at their centers and near their outer edges
+        (0, 0, (0, 11), (0, 11)),
+        (-0.4, -0.4, (0, 11), (0, 11)),
+        (NROWS - 1, NCOLS - 1, (NROWS - 11, NROWS), (NCOLS - 11, NCOLS)),
+        (NROWS - 0.6, NCOLS - 0.6, (NROWS - 11, NROWS), (NCOLS - 11, NCOLS)),
+        # away from the edges
+        (100, 75, (90, 111), (65, 86)),
+    ],
+)
+def test_get_cutout_edges(index, row, col, rows, cols):
+    tile = index.data[0]
+    ra, dec = tileindex.pix2sky(tile, row, col)
+
+    tilename, ranges = index.get_cutout(ra, dec, SIZE)
+
+    assert tilename == "DES0000+0000"
+    assert (ranges[0].start, ranges[0].stop) == rows
+    assert (ranges[1].start, ranges[1].stop) == cols
+
+
+def test_get_cutout_outside(index):
+    tile = index.data[0]
+    ra, dec = tileindex.pix2sky(tile, -0.6, 75)
+
+    with pytest.raises(ValueError):
+        index.get_cutout(ra, dec, SIZE)
@@ -0,0 +1,52 @@
+import os
+import time
+
+from desimage import worker
+
+
+def _set_age(fname, age):
+    tm = time.time() - age
+    os.utime(fname, (tm, tm))
+
+
+def test_claim_old_tile(tmp_path):
+    queue = worker.TileQueue(str(tmp_path))
+    queue.add(["DES0000-0000"])
+
+    # added long before it is claimed
+    _set_age(os.path.join(str(tmp_path), "pending", "DES0000-0000"), 1000)
+
+    assert queue.claim() == "DES0000-0000"
+    assert queue.requeue_stale(100) == []
+    assert queue.get_counts()["claimed"] == 1
+    assert queue.finish("DES0000-0000")
+
+
+def test_requeue_unwritten_claim(tmp_path):
+    queue = worker.TileQueue(str(tmp_path))
+    queue.add(["DES0000-0000"])
+
+    # renamed by a worker that has not written the claim yet
+    claimed_file = os.path.join(str(tmp_path), "claimed", "DES0000-0000")
+    os.rename(
+        os.path.join(str(tmp_path), "pending", "DES0000-0000"), claimed_file,
+    )
+
+    _set_age(claimed_file, 150)
+    assert queue.requeue_stale(100) == []
+
+    _set_age(claimed_file, 250)
+    assert queue.requeue_stale(100) == ["DES0000-0000"]
+
+
+def test_requeue_stale_claim(tmp_path):
+    queue = worker.TileQueue(str(tmp_path))
+    queue.add(["DES0000-0000"])
+    assert queue.claim() == "DES0000-0000"
+
+    _set_age(os.path.join(str(tmp_path), "claimed", "DES0000-0000"), 150)
+    assert queue.requeue_stale(100) == ["DES0000-0000"]
+
+    # the claim was lost
+    assert not queue.finish("DES0000-0000")
+    assert queue.get_counts()["pending"] == 1